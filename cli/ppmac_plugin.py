@@ -28,6 +28,8 @@ from ppmac.util import PpmacExport
 from ppmac.pp_comm import (PPComm, TimeoutError)
 from ppmac.pp_comm import GPError
 import ppmac.gather as gather
+import ppmac.gather_store as gather_store
+import ppmac.lod_plot as lod_plot
 import ppmac.completer as completer
 import ppmac.tune as tune_mod
 import ppmac.const as const
@@ -97,6 +99,7 @@ class PpmacCore(Configurable):
 
     gather_config_file = traitlets.Unicode('/var/ftp/gather/GatherSetting.txt', config=True)
     gather_output_file = traitlets.Unicode('/var/ftp/gather/GatherFile.txt', config=True)
+    gather_cache_size = traitlets.Int(4, config=True)
 
     default_servo_period = traitlets.Float(0.442673749446657994 * 1e-3, config=True)
     use_completer_db = traitlets.Bool(True, config=True)
@@ -224,8 +227,26 @@ class PpmacCore(Configurable):
         """
         Set and then get the gpascii variable
         """
-        self._gpascii.set_variable(var, value)
-        print('%s=%s' % (var, self._gpascii.get_variable(var)))
+        self.set_many_verbose([(var, value)])
+
+    def set_many_verbose(self, pairs):
+        """
+        Set gpascii variables in one batch, verify them, and print the
+        information
+
+        pairs: a sequence of (variable, value)
+        """
+        mismatches = self._gpascii.set_variables(pairs, verify=True)
+        for var, value in pairs:
+            try:
+                requested, actual = mismatches[var.lower()]
+            except KeyError:
+                print('%s=%s' % (var, value))
+            else:
+                if isinstance(actual, GPError):
+                    print(actual)
+                else:
+                    print('%s=%s (requested %s)' % (var, actual, requested))
 
     @magic_arguments()
     @argument('cmd', nargs='+', type=unicode,
@@ -361,13 +382,14 @@ class PpmacCore(Configurable):
         else:
             pattern, value = args.pattern, None
 
-        for i in range(args.low, args.high + 1):
-            var = pattern % i
+        variables = [pattern % i for i in range(args.low, args.high + 1)]
+        if value is not None:
+            self.set_many_verbose([(var, value) for var in variables])
+            return
+
+        for var in variables:
             try:
-                if value is None:
-                    self.get_verbose(var)
-                else:
-                    self.set_verbose(var, value)
+                self.get_verbose(var)
             except GPError as ex:
                 print(ex)
 
@@ -451,10 +473,25 @@ class PpmacCore(Configurable):
         gather.gather_and_plot(self.comm.gpascii, addr,
                                duration=args.duration, period=args.period)
 
+    def _gather_cache_size_changed(self, name, old, new):
+        gather.gather_cache.max_entries = new
+
+    def _get_gather_settings(self, settings_file=None):
+        if settings_file is None:
+            # Addresses last configured through this connection, if known
+            config = gather.get_gather_config(self.comm.gpascii)
+            if config.addresses is not None:
+                return {'gather.addr': util.InsList(config.addresses),
+                        'gather.period': config.period,
+                        'gather.maxsamples': config.samples,
+                        }
+
+        return gather.read_settings_file(self.comm, settings_file)
+
     def get_gather_results(self, settings_file=None, verbose=True):
         if verbose:
             print('Reading gather settings...')
-        settings = gather.read_settings_file(self.comm, settings_file)
+        settings = self._get_gather_settings(settings_file)
         if 'gather.addr' not in settings:
             raise KeyError('gather.addr: Unable to read addresses from settings file (%s)' % settings_file)
 
@@ -464,7 +501,7 @@ class PpmacCore(Configurable):
             sys.stdout.flush()
 
         addresses = settings['gather.addr']
-        data = gather.get_gather_results(self.comm, addresses)
+        data = gather.get_cached_gather_results(self.comm, addresses)
         if verbose:
             print('done')
 
@@ -479,6 +516,10 @@ class PpmacCore(Configurable):
               help='Character(s) to put between columns (tab is default)')
     @argument('-n', '--numpy', action='store_true',
               help='Store in numpy format (no metadata/column information)')
+    @argument('-s', '--store', action='store_true',
+              help='Save as a chunked binary gather store (directory)')
+    @argument('-z', '--compress', action='store_true',
+              help='Compress the gather store')
     def gather_save(self, magic_args, arg):
         """
         Save gather data to a file
@@ -492,6 +533,12 @@ class PpmacCore(Configurable):
             data = np.load('filename.npz')
             data['addr']  # the gathered variable addresses
             data['data']  # the gathered data
+        If `--store` is used, the data will be saved as a gather store
+        directory, with all gather metadata, which can be loaded (fully or
+        partially) by:
+            from ppmac.gather_store import GatherStore
+            store = GatherStore('dirname')
+            store.read(['Motor[1].ActPos'], start=0.1, stop=0.2)
         """
         args = parse_argstring(self.gather_save, arg)
 
@@ -513,14 +560,17 @@ class PpmacCore(Configurable):
 
         if args.save_to is not None:
             print('Saving to', args.save_to)
-            if args.numpy:
+            if args.store:
+                gather_store.save_gather(args.save_to, data,
+                                         compress=args.compress)
+            elif args.numpy:
                 np.savez(args.save_to,
                          addr=addresses, data=data)
             else:
                 gather.gather_data_to_file(args.save_to, addresses, data, delim=delim)
         else:
-            if args.numpy:
-                print('Error: Must specify a filename for numpy data', file=sys.stderr)
+            if args.numpy or args.store:
+                print('Error: Must specify a filename for numpy/store data', file=sys.stderr)
                 return
 
             print(' '.join('%20s' % addr for addr in addresses))
@@ -536,12 +586,18 @@ class PpmacCore(Configurable):
               help='Time, per point in table [microseconds]')
     @argument('settings_file', type=unicode, nargs='?',
               help='Gather settings filename')
+    @argument('-e', '--extra', type=unicode, action='append',
+              help='Additional address to save (multi-channel table)')
+    @argument('-t', '--type', type=unicode, default='f8',
+              help='Multi-channel table value type (e.g., i4, f4, f8)')
     def gather_saveinterp(self, magic_args, arg):
         """
         Save gather data to a simple binary file, interpolated over
         a regularly spaced interval
 
-        Saves in big endian format, only supports integers
+        Saves in big endian format. A single address is saved as integers
+        (readable by misc/dac_read); with extra addresses, a multi-channel
+        table of the given type is saved.
         """
         args = parse_argstring(self.gather_saveinterp, arg)
 
@@ -555,8 +611,13 @@ class PpmacCore(Configurable):
             return
 
         addresses = settings['gather.addr']
-        gather.save_interp(args.save_to, addresses, data, args.address,
-                           point_time=args.point_time)
+        if args.extra:
+            col = [args.address] + args.extra
+        else:
+            col = args.address
+
+        gather.save_interp(args.save_to, addresses, data, col,
+                           point_time=args.point_time, dtypes=args.type)
 
     def custom_tune(self, script, magic_args, range_var=None, range_values=None):
         if not self.check_comm():
@@ -578,12 +639,12 @@ class PpmacCore(Configurable):
             return tune_mod.tune_range(self.comm.gpascii, fn, range_var, range_values,
                                        **kwargs)
         else:
-            gather_vars, data = tune_mod.custom_tune(self.comm.gpascii, fn, **kwargs)
+            frame = tune_mod.custom_tune(self.comm.gpascii, fn, **kwargs)
             plot = hasattr(magic_args, 'no_plot') and not magic_args.no_plot
             if plot:
-                self._tune_plot(magic_args.motor1, gathered=(gather_vars, data))
+                self._tune_plot(magic_args.motor1, gathered=frame)
 
-            return gather_vars, data
+            return frame
 
     @magic_arguments()
     @argument('filename', type=unicode, nargs='?',
@@ -627,7 +688,7 @@ class PpmacCore(Configurable):
         Plot the most recent gather data for `motor`
         """
         if gathered is not None:
-            addresses, data = gathered
+            addresses, data = gathered.addresses, gathered
         else:
             try:
                 settings, data = self.get_gather_results(settings_file)
@@ -637,8 +698,6 @@ class PpmacCore(Configurable):
 
             addresses = settings['gather.addr']
 
-        data = np.array(data)
-
         desired_addr = 'motor[%d].despos.a' % motor
         actual_addr = 'motor[%d].actpos.a' % motor
 
@@ -654,8 +713,9 @@ class PpmacCore(Configurable):
         x_axis = np.array(x_axis) - x_axis[0]
 
         fig, ax1 = plt.subplots()
-        ax1.plot(x_axis, desired, color='black', label='Desired')
-        ax1.plot(x_axis, actual, color='b', alpha=0.5, label='Actual')
+        lod_plot.plot(ax1, x_axis, desired, color='black', label='Desired')
+        lod_plot.plot(ax1, x_axis, actual, color='b', alpha=0.5,
+                      label='Actual')
         ax1.set_xlabel('Time (s)')
         ax1.set_ylabel('Position (motor units)')
         for tl in ax1.get_yticklabels():
@@ -663,7 +723,8 @@ class PpmacCore(Configurable):
 
         error = desired - actual
         ax2 = ax1.twinx()
-        ax2.plot(x_axis, error, color='r', alpha=0.4, label='Following error')
+        lod_plot.plot(ax2, x_axis, error, color='r', alpha=0.4,
+                      label='Following error')
         ax2.set_ylabel('Error (motor units)')
         for tl in ax2.get_yticklabels():
             tl.set_color('r')
@@ -1245,6 +1306,8 @@ class PpmacCore(Configurable):
               help='Motor assignment')
     @argument('-M', '--macro', nargs='*', type=unicode,
               help='Macros')
+    @argument('-F', '--force', action='store_true',
+              help='Send the script even if unchanged since the last run')
     def prog_run(self, magic_self, arg):
         """
         Run a motion program in a coordinate system.
@@ -1287,7 +1350,7 @@ class PpmacCore(Configurable):
         gpascii = self.comm.gpascii
         prog_run(gpascii, coord=args.coord, program=args.program,
                  variables=args.variables, macros=macros, motors=motors,
-                 filename=args.filename)
+                 filename=args.filename, force=args.force)
 
     @magic_arguments()
     @argument('variables', nargs='+', type=unicode,
@@ -1633,7 +1696,7 @@ def build_utility(comm, source_files, output_name,
 
 
 def prog_run(gpascii, filename='', coord=0, program=1, variables=[],
-             motors={}, macros={}):
+             motors={}, macros={}, force=False):
     '''
     Run a motion program in a coordinate system.
 
@@ -1653,6 +1716,9 @@ def prog_run(gpascii, filename='', coord=0, program=1, variables=[],
 
     Prior to evaluating the script, macros in the script file in
     the form of '$(variable)' will be replaced with 'value'
+
+    The script is not sent if it is unchanged since it was last sent to
+    the program buffer, unless `force` is set.
     '''
     gpascii.send_line('&%dabort' % (coord, ))
     gpascii.sync()
@@ -1673,16 +1739,15 @@ def prog_run(gpascii, filename='', coord=0, program=1, variables=[],
 
             script = script.split('\n')
 
-        for line in script:
-            if line.rstrip():
-                print(line.rstrip())
-            try:
-                gpascii.send_line(line.strip())
-            except GPError as ex:
-                print('Failed to send script: %s' % ex)
-                return
+        try:
+            downloaded = gpascii.send_script(script, force=force,
+                                             verbose=True)
+        except GPError as ex:
+            print('Failed to send script: %s' % ex)
+            return
 
-        gpascii.sync()
+        if not downloaded.get(program, True):
+            print('Script unchanged since last sent')
 
     if motors:
         coords = {coord: motors}
@@ -187,6 +187,104 @@ void send_data(int client, bool phase) {
     send_all(client, (char*)buffer, (line_length * samples));
 }
 
+// Send the lines gathered since ring index `since`, for gathers running as
+// a ring buffer (Gather.Enable=3). The client passes back the returned
+// index on its next request. Lines are sent in order, in at most two parts
+// if the buffer wrapped. Overruns (the buffer wrapping past `since` between
+// requests) are not detected here; the client checks the continuity of
+// Sys.ServoCount for that.
+//
+// Packet: R (uint32 index) (uint32 wrap lines) (uint32 lines) (data)
+void send_ring_data(int client, bool phase, unsigned int since) {
+    GATHER *gather;
+    gather = &pshm->Gather;
+    unsigned int buf_len, index, wrap, lines, first, *buffer;
+    unsigned int max_samples, max_lines, line_length;
+    unsigned int error_code;
+
+    if (phase) {
+        index = gather->PhaseIndex;
+        max_samples = gather->PhaseMaxSamples;
+        max_lines = gather->PhaseMaxLines;
+        buffer = gather->PhaseBuffer;
+        line_length = gather->PhaseLineLength << 2;
+    } else {
+        index = gather->Index;
+        max_samples = gather->MaxSamples;
+        max_lines = gather->MaxLines;
+        buffer = gather->Buffer;
+        line_length = gather->LineLength << 2;
+    }
+
+    // The ring wraps at MaxSamples, limited by the buffer size
+    wrap = (max_samples < max_lines) ? max_samples : max_lines;
+    if (wrap == 0 || since >= wrap || index >= wrap) {
+        error_code = 1;
+        buf_len = sizeof(unsigned int) + 1;
+        send_all(client, (char*)&buf_len, sizeof(unsigned int));
+        send_str(client, "E");
+        send_all(client, (char*)&error_code, sizeof(unsigned int));
+        return;
+    }
+
+    lines = (index + wrap - since) % wrap;
+    buf_len = 3 * sizeof(unsigned int) + (line_length * lines) + 1;
+
+    send_all(client, (char*)&buf_len, sizeof(unsigned int));
+    send_str(client, "R");
+    send_all(client, (char*)&index, sizeof(unsigned int));
+    send_all(client, (char*)&wrap, sizeof(unsigned int));
+    send_all(client, (char*)&lines, sizeof(unsigned int));
+
+    if (lines == 0) {
+        return;
+    }
+
+    if (since + lines <= wrap) {
+        send_all(client, (char*)buffer + since * line_length,
+                 line_length * lines);
+    } else {
+        first = wrap - since;
+        send_all(client, (char*)buffer + since * line_length,
+                 line_length * first);
+        send_all(client, (char*)buffer, line_length * (lines - first));
+    }
+}
+
+// Send the sample count and the last gathered line only, allowing clients
+// to cheaply check whether the gathered data changed since they last read
+// it (the first item is typically Sys.ServoCount).
+//
+// Packet: L (uint32 samples) (last line, if any)
+void send_tail(int client, bool phase) {
+    GATHER *gather;
+    gather = &pshm->Gather;
+    unsigned int buf_len, samples, line_length, *buffer;
+
+    if (phase) {
+        samples = gather->PhaseSamples;
+        buffer = gather->PhaseBuffer;
+        line_length = gather->PhaseLineLength << 2;
+    } else {
+        samples = gather->Samples;
+        buffer = gather->Buffer;
+        line_length = gather->LineLength << 2;
+    }
+
+    if (samples == 0) {
+        line_length = 0;
+    }
+
+    buf_len = sizeof(unsigned int) + line_length + 1;
+    send_all(client, (char*)&buf_len, sizeof(unsigned int));
+    send_str(client, "L");
+    send_all(client, (char*)&samples, sizeof(unsigned int));
+    if (samples > 0) {
+        send_all(client, (char*)buffer + (samples - 1) * line_length,
+                 line_length);
+    }
+}
+
 // Strip off CR/LF from the client buffer
 void strip_buffer(char buf[], int buf_size) {
     int i;
@@ -230,6 +328,18 @@ int handle_client(int client) {
             if (send_types(client, phase)) {
                 send_data(client, phase); 
             }
+        } else if (!strcmp(buf, "both")) {
+            // Servo then phase types and data, in one exchange
+            if (send_types(client, false)) {
+                send_data(client, false);
+            }
+            if (send_types(client, true)) {
+                send_data(client, true);
+            }
+        } else if (!strcmp(buf, "tail")) {
+            send_tail(client, phase);
+        } else if (!strncmp(buf, "ring ", 5)) {
+            send_ring_data(client, phase, strtoul(buf + 5, NULL, 10));
         }
 
         buf[0] = 0;
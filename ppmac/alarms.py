@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.alarms` -- Motor and coordinate system alarm engine
+===============================================================
+
+.. module:: ppmac.alarms
+   :synopsis: Watch the status of all motors and coordinate systems at once,
+              firing callbacks on alarm transitions (e.g., FeFatal, AmpFault,
+              limits, EncLoss) and on Coord[].ErrorStatus changes.
+
+              Rather than reading one status field per round trip, the
+              32-bit Status[0] words of every motor and coordinate system
+              are read in bulk -- a single pipelined gpascii request or, if
+              available, one var_server snapshot -- and all fields are
+              decoded at once with numpy. Transitions are detected and
+              reported within the poll in which they are first seen.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import time
+import logging
+import threading
+from collections import namedtuple
+
+import numpy as np
+import six
+
+from . import const
+
+
+logger = logging.getLogger(__name__)
+
+MOTOR = 'motor'
+COORD = 'coord'
+
+AlarmEvent = namedtuple('AlarmEvent', 'time kind index field active value '
+                                      'description')
+
+
+def decode_bits(words, shifts):
+    """
+    Decode status bits from an array of status words
+
+    words: array of status words (N)
+    shifts: bit positions (M)
+
+    Returns: N x M boolean array
+    """
+    words = np.asarray(words, dtype=np.uint32)
+    shifts = np.asarray(shifts, dtype=np.uint32)
+    return ((words[:, np.newaxis] >> shifts[np.newaxis, :]) & 1).astype(bool)
+
+
+class _StatusTable(object):
+    """
+    Status words of one kind (motors or coordinate systems), decoded into
+    watched fields
+    """
+
+    def __init__(self, kind, indices, fields, bits, normal):
+        unknown = [field for field in fields if field not in bits]
+        if unknown:
+            raise ValueError('Unknown %s status fields: %s' %
+                             (kind, ', '.join(unknown)))
+
+        self.kind = kind
+        self.indices = np.asarray(list(indices), dtype=int)
+        self.fields = list(fields)
+        self.shifts = np.array([bits[field] for field in fields])
+        self.normal = np.array([bool(normal.get(field, 0))
+                                for field in fields])
+        self.abnormal = None
+        self.words = None
+
+    @property
+    def prefix(self):
+        return 'Motor' if self.kind == MOTOR else 'Coord'
+
+    @property
+    def variables(self):
+        return ['%s[%d].Status[0]' % (self.prefix, i) for i in self.indices]
+
+    def update(self, words, t):
+        """
+        Decode new status words, returning the list of AlarmEvents for all
+        fields that changed state since the last update
+        """
+        words = np.asarray(words, dtype=np.uint32)
+        abnormal = decode_bits(words, self.shifts) != self.normal
+        last, self.abnormal, self.words = self.abnormal, abnormal, words
+
+        if last is None:
+            # Report alarms that are already active on the first update
+            changed = abnormal
+        else:
+            changed = abnormal != last
+
+        events = []
+        for row, col in zip(*np.nonzero(changed)):
+            field = self.fields[col]
+            active = bool(abnormal[row, col])
+            events.append(AlarmEvent(t, self.kind, int(self.indices[row]),
+                                     field, active, int(words[row]),
+                                     '%s[%d].%s %s' %
+                                     (self.prefix, self.indices[row], field,
+                                      'active' if active else 'cleared')))
+        return events
+
+    def active(self):
+        if self.abnormal is None:
+            return []
+
+        return [(self.kind, int(self.indices[row]), self.fields[col])
+                for row, col in zip(*np.nonzero(self.abnormal))]
+
+
+class AlarmEngine(object):
+    """
+    Watch motors and coordinate systems for alarm transitions
+
+    >> engine = AlarmEngine(comm.gpascii, motors=range(1, 257))
+    >> engine.add_callback(lambda event: print(event.description))
+    >> engine.start(period=0.05)
+
+    fields: motor/coordinate system Status[0] fields to watch (see
+            const.motor_status_bits). An alarm is active when a field
+            differs from its const.motor_normal/const.coord_normal value.
+    client: optional var_server VariableClient; if given, status words are
+            read as binary snapshots instead of through gpascii
+    """
+
+    def __init__(self, gpascii, motors=range(1, 33), coords=range(1, 17),
+                 motor_fields=const.alarm_fields,
+                 coord_fields=const.alarm_fields, client=None, timeout=1.0):
+        self.gpascii = gpascii
+        self.client = client
+        self.timeout = timeout
+        self.motors = _StatusTable(MOTOR, motors, motor_fields,
+                                   const.motor_status_bits, const.motor_normal)
+        self.coords = _StatusTable(COORD, coords, coord_fields,
+                                   const.coord_status_bits, const.coord_normal)
+
+        self.error_vars = ['Coord[%d].ErrorStatus' % i
+                           for i in self.coords.indices]
+        self.variables = (self.motors.variables + self.coords.variables +
+                          self.error_vars)
+        self.error_status = None
+        self._last_words = None
+
+        self.poll_count = 0
+        self.last_poll_time = 0.0
+        self._callbacks = []
+        self._thread = None
+        self._stop_event = threading.Event()
+
+        if client is not None:
+            client.resolve(gpascii, self.variables, types='uint32')
+
+    def add_callback(self, callback, kind=None, fields=None):
+        """
+        Add a callback, called as callback(event) for each AlarmEvent
+
+        kind: only report MOTOR or COORD events
+        fields: only report these fields ('ErrorStatus' for coordinate system
+                errors)
+        """
+        if fields is not None:
+            fields = set(fields)
+
+        self._callbacks.append((callback, kind, fields))
+
+    def remove_callback(self, callback):
+        self._callbacks = [entry for entry in self._callbacks
+                           if entry[0] is not callback]
+
+    def read_words(self):
+        """
+        Read all status words and error statuses in a single request
+
+        Returns: numpy array of uint32, in the order of self.variables
+        Failed reads are given the last known value.
+        """
+        if self.client is not None:
+            servo_count, values = self.client.read()
+            return np.array(values, dtype=np.uint32)
+
+        values = self.gpascii.get_variables_batch(self.variables, type_=int,
+                                                  timeout=self.timeout,
+                                                  raise_errors=False)
+        words = np.zeros(len(values), dtype=np.uint32)
+        last = self._last_words
+        for i, value in enumerate(values):
+            if isinstance(value, six.integer_types):
+                words[i] = value & 0xFFFFFFFF
+            elif last is not None:
+                words[i] = last[i]
+
+        return words
+
+    def _error_events(self, errors, t):
+        last, self.error_status = self.error_status, errors
+        if last is None:
+            changed = np.nonzero(errors)[0]
+        else:
+            changed = np.nonzero(errors != last)[0]
+
+        events = []
+        for i in changed:
+            code = int(errors[i])
+            coord = int(self.coords.indices[i])
+            if code:
+                name, desc = const.coord_errors.get(code,
+                                                    ('Unknown', 'Unknown'))
+                description = ('Coord[%d] error %d (%s): %s' %
+                               (coord, code, name, desc))
+            else:
+                description = 'Coord[%d] error cleared' % coord
+
+            events.append(AlarmEvent(t, COORD, coord, 'ErrorStatus',
+                                     code != 0, code, description))
+        return events
+
+    def poll(self):
+        """
+        Read all status words once, firing callbacks for any transitions
+
+        Returns: list of AlarmEvents
+        """
+        t = time.time()
+        words = self.read_words()
+        self._last_words = words
+
+        n_motors = len(self.motors.indices)
+        n_coords = len(self.coords.indices)
+        events = self.motors.update(words[:n_motors], t)
+        events.extend(self.coords.update(words[n_motors:n_motors + n_coords],
+                                         t))
+        events.extend(self._error_events(words[n_motors + n_coords:], t))
+
+        self.poll_count += 1
+        self.last_poll_time = time.time() - t
+
+        for event in events:
+            self._fire(event)
+
+        return events
+
+    def _fire(self, event):
+        for callback, kind, fields in self._callbacks:
+            if kind is not None and kind != event.kind:
+                continue
+            if fields is not None and event.field not in fields:
+                continue
+
+            try:
+                callback(event)
+            except Exception as ex:
+                logger.error('Alarm callback failed', exc_info=ex)
+
+    def active_alarms(self):
+        """
+        Currently active alarms
+
+        Returns: list of (kind, index, field)
+        """
+        alarms = self.motors.active() + self.coords.active()
+        if self.error_status is not None:
+            alarms.extend((COORD, int(self.coords.indices[i]), 'ErrorStatus')
+                          for i in np.nonzero(self.error_status)[0])
+        return alarms
+
+    def _run(self, period):
+        next_time = time.time()
+        while not self._stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as ex:
+                logger.error('Alarm poll failed', exc_info=ex)
+
+            next_time += period
+            delay = next_time - time.time()
+            if delay < 0:
+                logger.debug('Alarm poll overran its period by %.1fms',
+                             -delay * 1000.)
+                next_time = time.time()
+                delay = 0.0
+
+            self._stop_event.wait(delay)
+
+    def start(self, period=0.05):
+        """
+        Poll in a background thread every `period` seconds
+        """
+        if self._thread is not None:
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(period, ))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+
+def test():
+    from .pp_comm import PPComm
+
+    comm = PPComm()
+    engine = AlarmEngine(comm.gpascii, motors=range(1, 257))
+
+    def print_event(event):
+        print(time.strftime('%H:%M:%S', time.localtime(event.time)),
+              event.description)
+
+    engine.add_callback(print_event)
+
+    t0 = time.time()
+    for i in range(20):
+        engine.poll()
+    print('Average poll time: %.1fms' % ((time.time() - t0) / 20. * 1000.))
+
+    try:
+        engine.start(0.05)
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        engine.stop()
+
+
+if __name__ == '__main__':
+    test()
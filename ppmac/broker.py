@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.broker` -- Local connection broker
+==============================================
+
+.. module:: ppmac.broker
+   :synopsis: A local daemon that owns the SSH/gpascii connection to each
+              Power PMAC and serves any number of local client processes
+              over a Unix socket. Concurrent variable reads from all clients
+              are coalesced into pipelined batches, identical reads share a
+              single request, and values are cached for clients that accept
+              slightly stale data.
+
+              BrokerComm is the client side, with an API compatible with the
+              commonly-used parts of PPComm (comm.gpascii.get_variable, etc.)
+
+              Start the broker with:
+                  python -m ppmac.broker [socket_path]
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import hashlib
+import socket
+import logging
+import threading
+
+from six.moves import queue
+
+from . import config
+from . import pp_comm
+from .pp_comm import (GPError, PPCommError, TimeoutError)
+
+
+logger = logging.getLogger(__name__)
+
+# Longest time, in seconds, that a request waits for the controller worker
+# when the client does not give a timeout of its own
+REQUEST_TIMEOUT = 60.0
+# Extra time a client waits for the broker itself to reply
+REPLY_MARGIN = 5.0
+
+
+class BrokerError(PPCommError):
+    pass
+
+
+def _send_message(sock, message):
+    sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+class _LineReader(object):
+    """
+    Reads newline-delimited JSON messages from a socket
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b''
+
+    def read(self):
+        while b'\n' not in self.buf:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise BrokerError('Connection closed')
+            self.buf += chunk
+
+        line, self.buf = self.buf.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+
+class _Pending(object):
+    """
+    A request waiting on the controller worker thread
+    """
+    def __init__(self, method, args):
+        self.method = method
+        self.args = args
+        self.result = None
+        self.error = None
+        self.event = threading.Event()
+
+    def set_result(self, result):
+        self.result = result
+        self.event.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.event.set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+        if not self.event.is_set():
+            raise TimeoutError('Broker request timed out')
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class ControllerSession(object):
+    """
+    The broker's connection to a single Power PMAC
+
+    All requests are executed in order by a single worker thread. Variable
+    reads queued up while the worker is busy are combined into one batch,
+    and identical reads already in flight are shared.
+    """
+
+    def __init__(self, host, port, user, password):
+        self.key = (host, port, user)
+        self.comm = pp_comm.PPComm(host=host, port=port, user=user,
+                                   password=password)
+        self.cache = {}
+        self._queue = queue.Queue()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def read(self, variables, max_age=0.0, timeout=REQUEST_TIMEOUT):
+        """
+        Read variables (as strings), from the cache if no older than max_age
+
+        Returns a list of values, with GPError instances for failed reads.
+        Raises TimeoutError if the worker does not respond within timeout.
+        """
+        now = time.time()
+        deadline = now + timeout
+        values = {}
+        waiting = {}
+
+        with self._lock:
+            for var in set(variables):
+                try:
+                    value, timestamp = self.cache[var]
+                except KeyError:
+                    pass
+                else:
+                    if max_age > 0.0 and (now - timestamp) <= max_age:
+                        values[var] = value
+                        continue
+
+                if var not in self._in_flight:
+                    self._in_flight[var] = _Pending('read', var)
+                    self._queue.put(self._in_flight[var])
+
+                waiting[var] = self._in_flight[var]
+
+        for var, pending in waiting.items():
+            try:
+                values[var] = pending.wait(max(deadline - time.time(), 0.0))
+            except GPError as ex:
+                values[var] = ex
+
+        return [values[var] for var in variables]
+
+    def call(self, method, args, timeout=REQUEST_TIMEOUT):
+        """
+        Execute a (non-read) request on the worker thread, raising
+        TimeoutError if it does not complete within timeout
+        """
+        pending = _Pending(method, args)
+        self._queue.put(pending)
+        return pending.wait(timeout)
+
+    def _worker(self):
+        while True:
+            pending = self._queue.get()
+            if pending.method != 'read':
+                self._execute(pending)
+                continue
+
+            # Combine all reads queued up since the last batch
+            reads = [pending]
+            deferred = []
+            while True:
+                try:
+                    next_ = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if next_.method == 'read':
+                    reads.append(next_)
+                else:
+                    deferred.append(next_)
+
+            self._read_batch(reads)
+
+            for pending in deferred:
+                self._execute(pending)
+
+    def _read_batch(self, reads):
+        variables = [pending.args for pending in reads]
+        try:
+            values = self.comm.gpascii.get_variables_batch(variables,
+                                                           raise_errors=False)
+        except Exception as ex:
+            values = [GPError('%s: %s' % (var, ex)) for var in variables]
+
+        now = time.time()
+        with self._lock:
+            for pending, value in zip(reads, values):
+                var = pending.args
+                del self._in_flight[var]
+                if isinstance(value, GPError):
+                    pending.set_error(value)
+                else:
+                    self.cache[var] = (value, now)
+                    pending.set_result(value)
+
+    def _execute(self, pending):
+        method, args = pending.method, pending.args
+        gpascii = self.comm.gpascii
+
+        try:
+            if method == 'set_variables':
+                with self._lock:
+                    for var, value in args['pairs']:
+                        self.cache.pop(var.lower(), None)
+
+                mismatches = gpascii.set_variables(args['pairs'],
+                                                   verify=args['verify'])
+                result = dict((var, (requested, str(actual)))
+                              for var, (requested, actual)
+                              in mismatches.items())
+            elif method == 'send_lines':
+                with self._lock:
+                    # Arbitrary commands may change any value
+                    self.cache.clear()
+
+                gpascii.send_lines(args['lines'], sync=args['sync'])
+                result = None
+            elif method == 'read_file':
+                result = self.comm.read_file(args['filename'])
+            elif method == 'write_file':
+                self.comm.write_file(args['filename'], args['contents'])
+                result = None
+            elif method == 'file_exists':
+                result = self.comm.file_exists(args['filename'])
+            elif method == 'shell_command':
+                result = self.comm.shell_command(args['command'])
+            elif method == 'gpascii_file':
+                with self._lock:
+                    self.cache.clear()
+
+                result = self.comm.gpascii_file(args['filename'],
+                                                check_errors=False)
+            else:
+                raise BrokerError('Unknown method: %s' % method)
+        except Exception as ex:
+            pending.set_error(ex)
+        else:
+            pending.set_result(result)
+
+
+class Broker(object):
+    """
+    Local connection broker, serving clients over a Unix socket
+
+    Each client connection is handled by its own thread; requests for the
+    same controller, with the same credentials, share one
+    ControllerSession.
+    """
+
+    def __init__(self, socket_path=config.broker_socket):
+        self.socket_path = socket_path
+        self.sessions = {}
+        self._salt = os.urandom(16)
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def _session_key(self, host, port, user, password):
+        """
+        Sessions are only shared by clients giving the same credentials; the
+        password is part of the key as a salted hash
+        """
+        password = ('%s' % password).encode('utf-8')
+        digest = hashlib.sha256(self._salt + password).hexdigest()
+        return (host, port, user, digest)
+
+    def get_session(self, host, port, user, password):
+        key = self._session_key(host, port, user, password)
+        with self._lock:
+            if key not in self.sessions:
+                logger.info('Connecting to %s@%s:%d', user, host, port)
+                self.sessions[key] = ControllerSession(host, port, user,
+                                                       password)
+            return self.sessions[key]
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        # Sessions hold controller credentials: only the owner may connect.
+        # The umask makes the socket private from the moment it is created.
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self._sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_path, 0o600)
+        self._sock.listen(16)
+        logger.info('Broker listening on %s', self.socket_path)
+
+        try:
+            while True:
+                client, _ = self._sock.accept()
+                thread = threading.Thread(target=self._handle_client,
+                                          args=(client, ))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self._sock.close()
+            os.unlink(self.socket_path)
+
+    def _handle_client(self, client):
+        reader = _LineReader(client)
+        session = None
+
+        while True:
+            try:
+                request = reader.read()
+            except Exception:
+                break
+
+            response = {'id': request.get('id')}
+            try:
+                method = request['method']
+                args = request.get('args', {})
+                timeout = request.get('timeout') or REQUEST_TIMEOUT
+                if method == 'connect':
+                    session = self.get_session(args['host'], args['port'],
+                                               args['user'], args['password'])
+                    result = None
+                elif session is None:
+                    raise BrokerError('Not connected to a controller')
+                elif method == 'read':
+                    values = session.read(args['variables'],
+                                          max_age=args.get('max_age', 0.0),
+                                          timeout=timeout)
+                    result = [{'error': str(value)}
+                              if isinstance(value, GPError)
+                              else {'value': value}
+                              for value in values]
+                else:
+                    result = session.call(method, args, timeout=timeout)
+            except Exception as ex:
+                response['error'] = str(ex)
+                response['error_type'] = ex.__class__.__name__
+            else:
+                response['result'] = result
+
+            try:
+                _send_message(client, response)
+            except Exception:
+                break
+
+        client.close()
+
+
+class BrokerGpascii(object):
+    """
+    Client-side stand-in for GpasciiChannel, going through the broker
+    """
+
+    def __init__(self, comm, max_age=0.0):
+        self._comm = comm
+        self.lock = threading.RLock()
+        self.max_age = max_age
+
+    def _read(self, variables, max_age=None, timeout=None):
+        if max_age is None:
+            max_age = self.max_age
+
+        return self._comm._request('read', timeout=timeout,
+                                   variables=[var.lower()
+                                              for var in variables],
+                                   max_age=max_age)
+
+    def get_variable(self, var, type_=str, timeout=2.0, max_age=None):
+        result, = self._read([var], max_age=max_age, timeout=timeout)
+        if 'error' in result:
+            raise GPError(result['error'])
+        return pp_comm._parse_value(result['value'], type_)
+
+    def get_variables_batch(self, variables, type_=str, timeout=2.0,
+                            raise_errors=True, max_age=None):
+        values = []
+        for var, result in zip(variables, self._read(variables,
+                                                     max_age=max_age,
+                                                     timeout=timeout)):
+            if 'error' in result:
+                error = GPError(result['error'])
+                if raise_errors:
+                    raise error
+                values.append(error)
+            else:
+                values.append(pp_comm._parse_value(result['value'], type_))
+
+        return values
+
+    def get_variables(self, variables, type_=str, timeout=0.2,
+                      cb=None, error_cb=None):
+        ret = []
+        values = self.get_variables_batch(variables, type_=type_,
+                                          raise_errors=False)
+        for var, value in zip(variables, values):
+            if isinstance(value, GPError):
+                if error_cb is None:
+                    ret.append('Error: %s' % (value, ))
+                else:
+                    ret.append(error_cb(var, value))
+                continue
+
+            if cb is not None:
+                try:
+                    value = cb(var, value)
+                except:
+                    pass
+
+            ret.append(value)
+
+        return ret
+
+    def set_variables(self, mapping, verify=True, timeout=2.0):
+        if hasattr(mapping, 'items'):
+            mapping = mapping.items()
+
+        pairs = [(var, '%s' % value) for var, value in mapping]
+        mismatches = self._comm._request('set_variables', timeout=timeout,
+                                         pairs=pairs, verify=verify)
+        return dict((var, tuple(value)) for var, value in mismatches.items())
+
+    def set_variable(self, var, value, check=True):
+        self.set_variables([(var, value)], verify=False)
+        if check:
+            return self.get_variable(var)
+
+    def send_lines(self, lines, delim='\n', sync=False):
+        self._comm._request('send_lines', lines=list(lines), sync=sync)
+
+    def send_line(self, line, delim='\n', sync=False):
+        self.send_lines([line], sync=sync)
+
+    def sync(self, verbose=False, timeout=0.01):
+        pass
+
+    @property
+    def servo_period(self):
+        """
+        The servo period, in seconds
+        """
+        period = self.get_variable('Sys.ServoPeriod', type_=float)
+        return period * 1e-3
+
+    @property
+    def servo_frequency(self):
+        """
+        The servo frequency, in Hz
+        """
+        return 1.0 / self.servo_period
+
+
+class BrokerComm(object):
+    """
+    Power PMAC communication through the local broker
+
+    Compatible with the commonly-used parts of PPComm: variable access
+    through `comm.gpascii`, file access and shell commands. Interactive
+    channels are not available through the broker.
+    """
+
+    def __init__(self, host=config.hostname, port=config.port,
+                 user=config.username, password=config.password,
+                 socket_path=config.broker_socket, max_age=0.0):
+        self._host = host
+        self._port = port
+        self._user = user
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._reader = _LineReader(self._sock)
+
+        self._request('connect', host=host, port=port, user=user,
+                      password=password)
+        self.gpascii = BrokerGpascii(self, max_age=max_age)
+
+    def _request(self, method, timeout=None, **args):
+        """
+        Send a request and wait for its response
+
+        timeout: time the broker waits on the controller (defaults to
+                 REQUEST_TIMEOUT); TimeoutError is raised if it expires, or
+                 if the broker itself does not reply
+        """
+        if timeout is None:
+            timeout = REQUEST_TIMEOUT
+
+        with self._lock:
+            self._next_id += 1
+            _send_message(self._sock, {'id': self._next_id,
+                                       'method': method,
+                                       'args': args,
+                                       'timeout': timeout})
+
+            # Responses to earlier requests which timed out are discarded
+            self._sock.settimeout(timeout + REPLY_MARGIN)
+            try:
+                response = self._reader.read()
+                while response.get('id') != self._next_id:
+                    response = self._reader.read()
+            except socket.timeout:
+                raise TimeoutError('No response from the broker to %s' %
+                                   method)
+            finally:
+                self._sock.settimeout(None)
+
+        if 'error' in response:
+            error_type = response.get('error_type')
+            if error_type == 'GPError':
+                raise GPError(response['error'])
+            elif error_type == 'TimeoutError':
+                raise TimeoutError(response['error'])
+            raise BrokerError(response['error'])
+
+        return response['result']
+
+    def close(self):
+        self._sock.close()
+
+    def read_file(self, filename, encoding='ascii'):
+        """
+        Read a remote file, result is a list of lines
+        """
+        return self._request('read_file', filename=filename)
+
+    def write_file(self, filename, contents):
+        """
+        Write a remote file with the given contents
+        """
+        self._request('write_file', filename=filename, contents=contents)
+
+    def file_exists(self, remote):
+        """
+        Check to see if a remote file exists
+        """
+        return self._request('file_exists', filename=remote)
+
+    def shell_command(self, command, verbose=False, **kwargs):
+        """
+        Execute a command in a remote shell
+        """
+        lines = self._request('shell_command', command=command)
+        for line in lines:
+            pp_comm.vlog(verbose, line.rstrip())
+        return lines
+
+    def gpascii_file(self, filename, check_errors=True, **kwargs):
+        """
+        Execute a gpascii script by remote filename (see
+        PPComm.gpascii_file)
+        """
+        ret = self._request('gpascii_file', filename=filename)
+        for line in ret:
+            pp_comm.vlog(kwargs.get('verbose', False), line.rstrip())
+
+        if not check_errors:
+            return ret
+
+        for line in ret:
+            if 'error' in line:
+                raise GPError(line)
+
+        return ret
+
+    @property
+    def fast_gather(self):
+        return None
+
+
+def main(socket_path=config.broker_socket):
+    logging.basicConfig()
+    logger.setLevel(logging.INFO)
+
+    Broker(socket_path).serve_forever()
+
+
+if __name__ == '__main__':
+    # Usage: broker.py [socket_path]
+    main(*sys.argv[1:])
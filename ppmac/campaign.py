@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.campaign` -- Pipelined motion test campaigns
+========================================================
+
+.. module:: ppmac.campaign
+   :synopsis: Run a queue of motion test jobs (program, macros, coordinate
+              system setup, gathered addresses) back to back, overlapping
+              the stages of consecutive jobs:
+
+              * the program for job N+1 is uploaded (on a second gpascii
+                channel) while job N is running
+              * once job N finishes, only the raw gather data is downloaded
+                before job N+1 is configured and started
+              * parsing and analysis of job N happen in a background worker
+
+              A per-stage timing report is kept for every job.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import time
+import logging
+import threading
+
+from six.moves import queue
+
+from . import gather as gather_mod
+from .pp_comm import vlog
+from .util import InsList
+
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('upload', 'setup', 'run', 'download', 'analyze')
+
+
+class Job(object):
+    """
+    A single motion test
+
+    script/filename: program text (string or list of lines) or local
+                     filename; macros are expanded with str.format, as in
+                     `GpasciiChannel.send_program`
+    coord: coordinate system to run in
+    motors: optional coordinate system assignment, {motor: axis}
+    addresses: gather addresses (Sys.ServoCount.a is added if missing)
+    analyze: optional callback, analyze(job, addresses, data), run in the
+             background worker. Its return value is stored in job.result.
+    prog: program buffer number; by default the campaign alternates between
+          its own buffers so the next program can be uploaded during a run
+    """
+
+    def __init__(self, script=None, filename=None, coord=1, motors=None,
+                 macros=None, addresses=None, gather_period=1,
+                 samples=gather_mod.max_samples, analyze=None, prog=None,
+                 name=None):
+        if script is None and filename is None:
+            raise ValueError('Must specify script text or filename')
+
+        self.script = script
+        self.filename = filename
+        self.coord = coord
+        self.motors = motors
+        self.macros = macros or {}
+        self.addresses = InsList(addresses or [])
+        self.gather_period = gather_period
+        self.samples = samples
+        self.analyze = analyze
+        self.prog = prog
+        self.name = name
+
+        if 'sys.servocount.a' not in self.addresses:
+            self.addresses.insert(0, 'Sys.ServoCount.a')
+
+        self.timing = dict((stage, 0.0) for stage in STAGES)
+        self.error_status = None
+        self.data = None
+        self.result = None
+        self.exception = None
+
+    def __repr__(self):
+        return '<Job %s coord=%d prog=%s>' % (self.name, self.coord, self.prog)
+
+
+class _Timer(object):
+    def __init__(self, job, stage):
+        self.job = job
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.time()
+
+    def __exit__(self, type_, value, traceback):
+        self.job.timing[self.stage] += time.time() - self.t0
+
+
+class Campaign(object):
+    """
+    Pipelined executor for a queue of `Job`s
+
+    >> campaign = Campaign(comm)
+    >> campaign.run([Job(script='X1', motors={1: 'x'}, addresses=[...]),
+                     ...])
+    >> campaign.report()
+    """
+
+    def __init__(self, comm, programs=(998, 999), verbose=True):
+        self.comm = comm
+        self.gpascii = comm.gpascii
+        self.programs = programs
+        self.verbose = verbose
+        self.jobs = []
+        self.elapsed = 0.0
+
+        self._upload_channel = None
+        self._analysis_queue = queue.Queue()
+        self._worker = None
+        self._last_motors = {}
+
+    @property
+    def upload_channel(self):
+        if self._upload_channel is None:
+            self._upload_channel = self.comm.gpascii_channel()
+        return self._upload_channel
+
+    def _upload(self, job):
+        with _Timer(job, 'upload'):
+            self.upload_channel.download_program(job.prog,
+                                                 macros=job.macros,
+                                                 filename=job.filename,
+                                                 script=job.script)
+
+    def _try_upload(self, job):
+        """
+        Upload a job's program (possibly in a background thread), marking
+        the job as failed on error
+        """
+        try:
+            self._upload(job)
+        except Exception as ex:
+            logger.error('Upload for %s failed', job, exc_info=ex)
+            job.exception = ex
+
+    def _setup(self, job):
+        gpascii = self.gpascii
+        with _Timer(job, 'setup'):
+            if job.motors and self._last_motors.get(job.coord) != job.motors:
+                gpascii.set_coords({job.coord: job.motors},
+                                   undefine_coord=True)
+                self._last_motors[job.coord] = dict(job.motors)
+
+            config = gather_mod.get_gather_config(gpascii)
+            config.configure(job.addresses, job.gather_period,
+                             samples=job.samples)
+
+    def _run(self, job):
+        gpascii = self.gpascii
+        with _Timer(job, 'run'):
+            gpascii.set_variable('gather.enable', 2, check=False)
+            try:
+                job.error_status = gpascii.run_and_wait(job.coord, job.prog,
+                                                        verbose=False)
+            finally:
+                gpascii.set_variable('gather.enable', 0, check=False)
+
+    def _download(self, job):
+        with _Timer(job, 'download'):
+            return gather_mod.download_gather(self.comm)
+
+    def _analysis_worker(self):
+        while True:
+            item = self._analysis_queue.get()
+            if item is None:
+                break
+
+            job, downloaded = item
+            try:
+                with _Timer(job, 'analyze'):
+                    job.data = gather_mod.parse_downloaded_gather(
+                        downloaded, job.addresses, self._servo_period,
+                        job.gather_period)
+                    if job.analyze is not None:
+                        job.result = job.analyze(job, job.addresses, job.data)
+            except Exception as ex:
+                logger.error('Analysis of %s failed', job, exc_info=ex)
+                job.exception = ex
+
+    def _assign_programs(self, jobs):
+        for i, job in enumerate(jobs):
+            if job.prog is None:
+                job.prog = self.programs[i % len(self.programs)]
+            if job.name is None:
+                job.name = '%d' % i
+
+    def run(self, jobs, stop_on_error=False):
+        """
+        Run all jobs, pipelining upload/setup/run/download/analysis
+
+        Returns: the list of jobs, with data, result and timing filled in
+        """
+        jobs = list(jobs)
+        self._assign_programs(jobs)
+        self.jobs.extend(jobs)
+        if not jobs:
+            return jobs
+
+        self._servo_period = self.gpascii.servo_period
+        self._worker = threading.Thread(target=self._analysis_worker)
+        self._worker.daemon = True
+        self._worker.start()
+
+        t0 = time.time()
+        try:
+            self._try_upload(jobs[0])
+            for i, job in enumerate(jobs):
+                next_job = jobs[i + 1] if (i + 1) < len(jobs) else None
+                vlog(self.verbose, 'Job %d/%d: %s' % (i + 1, len(jobs), job))
+
+                if job.exception is not None:
+                    # The program upload failed; the buffer holds another
+                    # program, so the job cannot run
+                    if stop_on_error:
+                        raise job.exception
+                    if next_job is not None:
+                        self._try_upload(next_job)
+                    continue
+
+                uploader = None
+                try:
+                    self._setup(job)
+
+                    # Upload the next program while this one runs, unless it
+                    # would overwrite the running program buffer
+                    if next_job is not None and next_job.prog != job.prog:
+                        uploader = threading.Thread(target=self._try_upload,
+                                                    args=(next_job, ))
+                        uploader.start()
+
+                    self._run(job)
+                    downloaded = self._download(job)
+                except Exception as ex:
+                    logger.error('Job %s failed', job, exc_info=ex)
+                    job.exception = ex
+                    if stop_on_error:
+                        raise
+                else:
+                    self._analysis_queue.put((job, downloaded))
+                finally:
+                    if uploader is not None:
+                        uploader.join()
+
+                if next_job is not None and uploader is None:
+                    self._try_upload(next_job)
+        finally:
+            self._analysis_queue.put(None)
+            self._worker.join()
+            self.elapsed += time.time() - t0
+
+        return jobs
+
+    def report(self, f=None):
+        """
+        Print the per-stage timing of all jobs, and the totals
+        """
+        print('%-10s' % 'job' + ''.join('%10s' % stage for stage in STAGES),
+              file=f)
+        totals = dict((stage, 0.0) for stage in STAGES)
+        for job in self.jobs:
+            print('%-10s' % job.name +
+                  ''.join('%10.3f' % job.timing[stage] for stage in STAGES),
+                  file=f)
+            for stage in STAGES:
+                totals[stage] += job.timing[stage]
+
+        print('%-10s' % 'total' +
+              ''.join('%10.3f' % totals[stage] for stage in STAGES), file=f)
+
+        sequential = sum(totals.values())
+        print('Elapsed %.3f s (sequential stages would take %.3f s)' %
+              (self.elapsed, sequential), file=f)
+        return totals
@@ -115,24 +115,53 @@ def set_global_phase(devices, phase_freq, servo_divider, verbose=True,
                                      **kwargs)
 
     gpascii = devices[0].gpascii
+    script = [line for line in script if line]
+
+    if verbose:
+        assignments = [line.split('=') for line in script if '=' in line]
+        current = gpascii.get_variables_batch([var for var, value
+                                               in assignments],
+                                              raise_errors=False)
+        current = dict(zip([var for var, value in assignments], current))
+
+        for line in script:
+            if '=' in line:
+                var, value = line.split('=')
+                print('Setting %s=%s (current value=%s)' %
+                      (var, value, current[var]))
+            else:
+                print('Sending %s' % line)
+
+    if dry_run:
+        return
+
+    def set_batch(pairs):
+        try:
+            mismatches = gpascii.set_variables(pairs)
+        except Exception as ex:
+            print('* Failed: %s' % ex)
+            return
+
+        for var, (requested, actual) in sorted(mismatches.items()):
+            print('* Failed: %s=%s (is: %s)' % (var, requested, actual))
+
     with util.WpKeySave(gpascii, verbose=True):
+        # Assignments are sent in batches, in script order, up to each
+        # non-assignment command
+        pairs = []
         for line in script:
-            if not line:
+            if '=' in line:
+                pairs.append(line.split('='))
                 continue
 
-            if verbose:
-                if '=' in line:
-                    var, value = line.split('=')
-                    print('Setting %s=%s (current value=%s)' %
-                          (var, value, gpascii.get_variable(var)))
-                else:
-                    print('Sending %s' % line)
-
-            if not dry_run:
-                try:
-                    gpascii.send_line(line, sync=True)
-                except Exception as ex:
-                    print('* Failed: %s' % ex)
+            set_batch(pairs)
+            pairs = []
+            try:
+                gpascii.send_line(line, sync=True)
+            except Exception as ex:
+                print('* Failed: %s' % ex)
+
+        set_batch(pairs)
 
 
 def test():
@@ -12,7 +12,17 @@ username = os.environ.get('PPMAC_USER', 'root')
 password = os.environ.get('PPMAC_PASS', 'deltatau')
 
 fast_gather_port = int(os.environ.get('PPMAC_GATHER_PORT', '2332'))
+var_server_port = int(os.environ.get('PPMAC_VAR_PORT', '2333'))
+broker_socket = os.environ.get('PPMAC_BROKER_SOCKET', '/tmp/ppmac_broker.sock')
+# Sys.Udata index at which program hashes are recorded on the controller
+# (see pp_comm.PROGRAM_HASH_VARIABLE); unset keeps them host-side only
+program_hash_base = os.environ.get('PPMAC_PROGRAM_HASH_BASE', None)
+if program_hash_base is not None:
+    program_hash_base = int(program_hash_base)
+historian_path = os.environ.get('PPMAC_HISTORIAN_PATH',
+                                os.path.expanduser('~/.ppmac_history'))
 
 logger.debug('Power PMAC default host: %s:%d', hostname, port)
 logger.debug('Power PMAC default login: %s/%s', username, password)
 logger.debug('Power PMAC default fast gather port: %d', fast_gather_port)
+logger.debug('Power PMAC default variable server port: %d', var_server_port)
@@ -209,6 +209,71 @@ coord_normal = {'TriggerMove': 0,
                 }
 
 
+# Bit positions of the status fields in the Motor[].Status[0] and
+# Coord[].Status[0] words (from the Power PMAC Software Reference)
+motor_status_bits = {'TriggerMove': 31,
+                     'HomeInProgress': 30,
+                     'MinusLimit': 29,
+                     'PlusLimit': 28,
+                     'FeWarn': 27,
+                     'FeFatal': 26,
+                     'LimitStop': 25,
+                     'AmpFault': 24,
+                     'SoftMinusLimit': 23,
+                     'SoftPlusLimit': 22,
+                     'I2tFault': 21,
+                     'TriggerNotFound': 20,
+                     'AmpWarn': 19,
+                     'EncLoss': 18,
+                     'HomeComplete': 15,
+                     'DesVelZero': 14,
+                     'ClosedLoop': 13,
+                     'AmpEna': 12,
+                     'InPos': 11,
+                     'BlockRequest': 9,
+                     'PhaseFound': 8,
+                     'TriggerSpeedSel': 7,
+                     'GantryHomed': 6,
+                     }
+
+coord_status_bits = {'TriggerMove': 31,
+                     'HomeInProgress': 30,
+                     'MinusLimit': 29,
+                     'PlusLimit': 28,
+                     'FeWarn': 27,
+                     'FeFatal': 26,
+                     'LimitStop': 25,
+                     'AmpFault': 24,
+                     'SoftMinusLimit': 23,
+                     'SoftPlusLimit': 22,
+                     'I2tFault': 21,
+                     'TriggerNotFound': 20,
+                     'AmpWarn': 19,
+                     'EncLoss': 18,
+                     'TimerEnabled': 16,
+                     'HomeComplete': 15,
+                     'DesVelZero': 14,
+                     'ClosedLoop': 13,
+                     'AmpEna': 12,
+                     'InPos': 11,
+                     'BlockRequest': 9,
+                     }
+
+# Status fields considered alarms by default
+alarm_fields = ['FeFatal',
+                'FeWarn',
+                'AmpFault',
+                'AmpWarn',
+                'I2tFault',
+                'MinusLimit',
+                'PlusLimit',
+                'SoftMinusLimit',
+                'SoftPlusLimit',
+                'LimitStop',
+                'EncLoss',
+                ]
+
+
 # Part numbers to string identifiers, compiled from the documentation
 parts = {
     # Gate 3
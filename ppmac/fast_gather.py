@@ -24,7 +24,8 @@ import time
 import numpy as np
 
 from . import config
-from .gather_types import GATHER_TYPES
+from .gather_frame import GatherFrame
+from .gather_types import (GATHER_TYPES, NUMPY_TYPES)
 
 
 class TCPSocket(object):
@@ -65,7 +66,7 @@ class TCPSocket(object):
         packet = []
         received = 0
         while received < expected:
-            chunk = self.sock.recv(expected - len(packet))
+            chunk = self.sock.recv(expected - received)
             if len(chunk) == 0:
                 raise RuntimeError("Connection lost")
 
@@ -140,6 +141,33 @@ class GatherClient(TCPSocket):
         samples, = struct.unpack('>I', buf[:4])
         return samples, buf[4:]
 
+    def query_ring_data(self, since):
+        """
+        Query the server for the lines gathered since ring index `since`,
+        for gathers running as a ring buffer (gather.enable=3)
+
+        Returns: (current ring index, ring size in lines, line count,
+                  raw data)
+        """
+        self.send(('ring %d\n' % since).encode('ascii'))
+        buf = self._recv_packet(b'R')
+
+        index, wrap, lines = struct.unpack('>III', buf[:12])
+        return index, wrap, lines, buf[12:]
+
+    def query_tail(self):
+        """
+        Query the sample count and the raw data of the last gathered line
+        only, e.g. to check whether the gathered data changed
+
+        Returns: sample count (lines), raw last line
+        """
+        self.send(b'tail\n')
+        buf = self._recv_packet(b'L')
+
+        samples, = struct.unpack('>I', buf[:4])
+        return samples, buf[4:]
+
     def set_phase_mode(self):
         """
         Instruct the server to return gathered phase data
@@ -163,19 +191,35 @@ class GatherClient(TCPSocket):
         slower. This method is more efficient, requesting both at the same time.
         """
         self.send(b'all\n')
+        return self._recv_types_and_raw_data()
+
+    def _recv_types_and_raw_data(self):
         type_buf = self._recv_packet(b'T')
         n_items, = struct.unpack('B', type_buf[:1])
         types = struct.unpack('>' + 'H' * n_items, type_buf[1:])
 
         if n_items == 0:
             return types, 0, []
-        else:
-            assert(n_items == len(types))
-            data_buf = self._recv_packet(b'D')
-            samples, = struct.unpack('>I', data_buf[:4])
-            return types, samples, data_buf[4:]
 
-    def _get_type(self, type_):
+        data_buf = self._recv_packet(b'D')
+        samples, = struct.unpack('>I', data_buf[:4])
+        return types, samples, data_buf[4:]
+
+    def query_servo_and_phase(self):
+        """
+        Query types and raw data of both the servo and phase gathers, in a
+        single request
+
+        Returns: ((servo types, servo samples, servo raw data),
+                  (phase types, phase samples, phase raw data))
+        """
+        self.send(b'both\n')
+        servo = self._recv_types_and_raw_data()
+        phase = self._recv_types_and_raw_data()
+        return servo, phase
+
+    @classmethod
+    def _get_type(cls, type_):
         """
         Return type information for a numeric Gather type
 
@@ -199,15 +243,16 @@ class GatherClient(TCPSocket):
         # Undocumented types -- a certain number of bits and such
         # see gather_serve.c or:
         #   http://forums.deltatau.com/archive/index.php?thread-933.html
-        start = (type_ & self.START_MASK) >> 11
-        count = (type_ & self.BIT_MASK)
+        start = (type_ & cls.START_MASK) >> 11
+        count = (type_ & cls.BIT_MASK)
         count = 32 - (count >> 6)
 
         ret = (4, 'I', make_conv_bits(start, count))
         GATHER_TYPES[type_] = ret
         return ret
 
-    def _parse_raw_data(self, types, raw_data):
+    @classmethod
+    def _parse_raw_data(cls, types, raw_data):
         """
         Combines type information and raw data into a 1D array of processed
         data
@@ -218,7 +263,7 @@ class GatherClient(TCPSocket):
         """
         n_items = len(types)
 
-        types = [self._get_type(type_) for type_ in types]
+        types = [cls._get_type(type_) for type_ in types]
 
         line_size = sum(size for (size, format_, conv) in types)
         line_count = int(len(raw_data) / line_size)
@@ -242,6 +287,97 @@ class GatherClient(TCPSocket):
         # import pdb; pdb.set_trace()
         return ret_data, n_items, line_count
 
+    @classmethod
+    def _get_numpy_type(cls, type_):
+        """
+        Return numpy type information for a numeric Gather type
+
+        Returns: (big-endian dtype, vectorized post-processing conversion
+                  function)
+        """
+        if type_ in NUMPY_TYPES:
+            return NUMPY_TYPES[type_]
+
+        start = (type_ & cls.START_MASK) >> 11
+        count = (type_ & cls.BIT_MASK)
+        count = 32 - (count >> 6)
+        mask = ((1 << count) - 1)
+
+        def conv_bits(values):
+            return (values >> start) & mask
+
+        ret = ('>u4', conv_bits)
+        NUMPY_TYPES[type_] = ret
+        return ret
+
+    @classmethod
+    def _parse_columns(cls, types, raw_data):
+        """
+        Convert raw data to one contiguous numpy array per address
+
+        The raw data is read in place (np.frombuffer); each column is then
+        converted to native byte order in a single copy, keeping its
+        gathered type (e.g., int32, float32 or float64).
+        """
+        types = [cls._get_numpy_type(type_) for type_ in types]
+        fields = ['f%d' % i for i in range(len(types))]
+
+        raw_dtype = np.dtype([(field, dtype)
+                              for field, (dtype, conv) in zip(fields, types)])
+        line_count = int(len(raw_data) / raw_dtype.itemsize)
+        raw = np.frombuffer(raw_data, dtype=raw_dtype, count=line_count)
+
+        columns = []
+        for field, (dtype, conv) in zip(fields, types):
+            column = raw[field].astype(np.dtype(dtype).newbyteorder('='))
+            if conv is not None:
+                column = conv(column)
+            columns.append(column)
+
+        return columns
+
+    @classmethod
+    def frame_from_raw(cls, addresses, types, samples, raw_data):
+        """
+        GatherFrame from types and raw data (see query_types_and_raw_data)
+
+        addresses: gathered addresses, used as column names (defaults to
+                   Gather.Addr[0], Gather.Addr[1], ...)
+        """
+        if addresses is None:
+            addresses = ['Gather.Addr[%d]' % i for i in range(len(types))]
+
+        if samples == 0:
+            return GatherFrame.from_rows(addresses, [])
+
+        return GatherFrame(addresses, cls._parse_columns(types, raw_data))
+
+    def get_frame(self, addresses=None):
+        """
+        Query the server for all gather data, as a GatherFrame
+
+        addresses: gathered addresses, used as column names (defaults to
+                   Gather.Addr[0], Gather.Addr[1], ...)
+        """
+        return self.frame_from_raw(addresses,
+                                   *self.query_types_and_raw_data())
+
+    def to_pandas(self, addresses=None, **kwargs):
+        """
+        Query the server for all gather data, as a pandas DataFrame
+
+        See GatherFrame.to_pandas
+        """
+        return self.get_frame(addresses).to_pandas(**kwargs)
+
+    def to_arrow(self, addresses=None, **kwargs):
+        """
+        Query the server for all gather data, as a pyarrow Table
+
+        See GatherFrame.to_arrow
+        """
+        return self.get_frame(addresses).to_arrow(**kwargs)
+
     def _query_all(self):
         """
         Queries the server for type and raw data, and does a bit of processing
@@ -282,7 +418,7 @@ class GatherClient(TCPSocket):
                   ...]
         """
         if as_numpy:
-            return self.get_rows(as_numpy=as_numpy).T
+            return self.get_columns(as_numpy=as_numpy).T
         else:
             data, n_items, samples = self._query_all()
 
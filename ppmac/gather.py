@@ -13,17 +13,23 @@ import os
 import time
 import re
 import sys
-import ast
-import struct
 import functools
 import logging
+import threading
+import warnings
+from collections import OrderedDict
 
 import matplotlib.pyplot as plt
 import numpy as np
+from six.moves import queue
 
 from . import pp_comm
 from .pp_comm import vlog
 from .util import InsList
+from .gather_frame import GatherFrame
+from . import interp_table
+from . import lod_plot
+from . import unwrap
 
 
 logger = logging.getLogger(__name__)
@@ -114,94 +120,588 @@ def read_settings_file(comm, fn=None):
     return settings
 
 
-def parse_gather(addresses, lines, delim=' '):
-    def fix_line(line):
+def _parse_column(column, col_index, dtype):
+    """
+    Convert a column of gather strings to numbers, falling back to integer
+    parsing for hex values ($ or 0x prefixed)
+    """
+    try:
+        return column.astype(dtype)
+    except ValueError:
+        pass
+
+    values = np.zeros(len(column), dtype=dtype)
+    for row, cell in enumerate(column.tolist()):
         try:
-            return [ast.literal_eval(num) for num in line]
-        except Exception as ex:
-            raise RuntimeError('Unable to parse gather results (%s): %s [%s]' %
-                               (ex.__class__.__name__, ex, line))
+            if cell.startswith('$'):
+                values[row] = int(cell[1:], 16)
+            elif cell.lstrip('+-')[:2].lower() == '0x':
+                values[row] = int(cell, 16)
+            else:
+                values[row] = float(cell)
+        except ValueError as ex:
+            raise RuntimeError('Unable to parse gather results (row %d, '
+                               'column %d): %s [%r]' %
+                               (row, col_index, ex, cell))
 
+    return values
+
+
+def parse_gather(addresses, lines, delim=' ', dtype=float):
+    """
+    Parse text gather data into a 2D array (samples x addresses)
+
+    All rows are converted in a single pass with numpy. Rows which do not
+    have one value per address are skipped and reported.
+    """
     count = len(addresses)
-    data = [fix_line(line.split(delim))
-            for line in lines
-            if line.count(delim) == (count - 1)]
+    if not isinstance(lines, list):
+        lines = list(lines)
+
+    good = [line.count(delim) == (count - 1) for line in lines]
+    malformed = [i for i, (ok, line) in enumerate(zip(good, lines))
+                 if not ok and line.strip()]
+    if malformed:
+        logger.warning('Skipped %d malformed gather rows (lines %s%s)',
+                       len(malformed),
+                       ', '.join(str(i) for i in malformed[:10]),
+                       '...' if len(malformed) > 10 else '')
+
+    rows = [line for ok, line in zip(good, lines) if ok]
+    if len(rows) == 0:
+        if len(lines) > 2:
+            raise RuntimeError('Gather results inconsistent with settings file'
+                               '(wrong file or addresses incorrect?)')
+        return np.zeros((0, count), dtype=dtype)
+
+    text = delim.join(rows)
+    try:
+        # Fast path: numpy's C text parser handles integer and decimal values
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            data = np.fromstring(text, dtype=dtype, sep=delim)
+    except (ValueError, DeprecationWarning):
+        pass
+    else:
+        if data.size == len(rows) * count:
+            return data.reshape(-1, count)
 
-    if len(data) == 0 and len(lines) > 2:
-        raise RuntimeError('Gather results inconsistent with settings file'
-                           '(wrong file or addresses incorrect?)')
+    # Slow path for hex values and error reporting
+    cells = np.array(text.split(delim)).reshape(-1, count)
+
+    data = np.zeros(cells.shape, dtype=dtype)
+    for col in range(count):
+        data[:, col] = _parse_column(cells[:, col], col, dtype)
 
     return data
 
 
-def setup_gather(gpascii, addresses, duration=0.1, period=1,
-                 output_file=gather_output_file):
-    comm = gpascii._comm
+class GatherConfig(object):
+    """
+    Gather configuration state of a gpascii channel
+
+    Remembers the gather addresses, period and sample count last set on
+    the controller, so that reconfiguring sends only the settings which
+    changed, as a single batch over the open channel. If nothing changed,
+    the controller is not reconfigured at all.
+
+    The state is unknown until the first `configure` (which then sends
+    everything), and after `invalidate`. Each `configure` first checks the
+    known state against gather.items, period, maxsamples and maxlines on
+    the controller (a single batched read), and reconfigures everything if
+    the gather was changed elsewhere (e.g., by the IDE, another program, a
+    settings file or a reset). A change of addresses alone, keeping the
+    same count and settings, is not detected; call `invalidate` then.
+
+    Changes are read back before being taken as the known state; if the
+    controller reports an error (e.g., for a bad address), GPError is
+    raised and the state is invalidated.
+
+    settings_file: when the configuration changes, the full settings are
+                   recorded to this file on the controller (as read by
+                   `read_settings_file`); None to disable
+    phase: configure the phase gather (Gather.PhaseAddr, ...) instead of
+           the servo gather
+
+    >> config = get_gather_config(comm.gpascii)
+    >> config.configure(['Motor[1].ActPos.a'], period=1, samples=1000)
+    1000
+    """
 
-    servo_period = gpascii.servo_period
+    SERVO_VARIABLES = {'addr': 'gather.addr',
+                       'items': 'gather.items',
+                       'period': 'gather.Period',
+                       'max_samples': 'gather.MaxSamples',
+                       'max_lines': 'gather.maxlines',
+                       'enable': 'gather.enable',
+                       }
+
+    PHASE_VARIABLES = {'addr': 'gather.PhaseAddr',
+                       'items': 'gather.PhaseItems',
+                       'period': 'gather.PhasePeriod',
+                       'max_samples': 'gather.PhaseMaxSamples',
+                       'max_lines': 'gather.PhaseMaxLines',
+                       'enable': 'gather.PhaseEnable',
+                       }
+
+    def __init__(self, gpascii, settings_file=gather_config_file,
+                 phase=False):
+        self.gpascii = gpascii
+        self.settings_file = settings_file
+        self.phase = phase
+        if phase:
+            self.variables = self.PHASE_VARIABLES
+        else:
+            self.variables = self.SERVO_VARIABLES
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Forget the known state, forcing a full reconfiguration
+        """
+        self.addresses = None
+        self.period = None
+        self.samples = None
+        self.max_lines = None
+
+    def validate(self):
+        """
+        Check the known state against the controller, invalidating it if
+        the gather was reconfigured elsewhere
+
+        Returns: True if the known state is still valid
+        """
+        if self.addresses is None:
+            return False
+
+        names = self.variables
+        keys = ['items', 'period', 'max_samples', 'max_lines']
+        expected = [len(self.addresses), self.period, self.samples,
+                    self.max_lines]
+        try:
+            actual = self.gpascii.get_variables_batch([names[key]
+                                                       for key in keys],
+                                                      type_=int)
+        except pp_comm.PPCommError as ex:
+            logger.warning('Unable to check the gather configuration: %s',
+                           ex)
+            actual = None
+
+        if actual != expected:
+            logger.info('Gather configuration changed on the controller; '
+                        'reconfiguring')
+            self.invalidate()
+            return False
+
+        return True
+
+    def _changed_settings(self, addresses, period):
+        """
+        Settings which differ from the known state
+        """
+        names = self.variables
+        known = self.addresses
+        settings = []
+        for i, addr in enumerate(addresses):
+            if (known is None or i >= len(known) or
+                    known[i].lower() != addr.lower()):
+                settings.append('%s[%d]=%s' % (names['addr'], i, addr))
+
+        if known is None or len(known) != len(addresses):
+            settings.append('%s=%d' % (names['items'], len(addresses)))
+
+        if self.period != period:
+            settings.append('%s=%d' % (names['period'], period))
+
+        return settings
+
+    def configure(self, addresses, period=1, samples=None):
+        """
+        Configure the gather (leaving it disabled)
+
+        samples: number of samples to gather; defaults to (and is limited
+                 by) gather.maxlines
+
+        Returns: number of samples which will be gathered
+        """
+        gpascii = self.gpascii
+        names = self.variables
+        enable = names['enable']
+        addresses = list(addresses)
+
+        # A new gather is about to replace any cached results
+        gather_cache.invalidate()
+        period = int(period)
+        self.validate()
+
+        settings = self._changed_settings(addresses, period)
+        try:
+            if settings or self.max_lines is None:
+                # Enabling the gather updates gather.maxlines for the new
+                # address layout. Errors in the settings (e.g., a bad
+                # address) are raised by the batch read, which follows
+                # their responses.
+                settings = (['%s=0' % enable] + settings +
+                            ['%s=1' % enable, '%s=0' % enable])
+                gpascii.send_lines(settings)
+                self.max_lines, = gpascii.get_variables_batch(
+                    [names['max_lines']], type_=int)
+            else:
+                gpascii.set_variable(enable, 0, check=False)
 
-    total_samples = get_sample_count(servo_period, period, duration)
+            if samples is None or samples > self.max_lines:
+                samples = self.max_lines
 
-    settings = get_settings(servo_period, addresses, duration=duration,
-                            gather_period=period)
+            if samples != self.samples:
+                gpascii.set_variable(names['max_samples'], samples,
+                                     check=False)
 
-    settings = '\n'.join(settings)
+            if settings or samples != self.samples:
+                self._check(addresses, period, samples)
+        except Exception:
+            self.invalidate()
+            raise
 
-    comm.write_file(gather_config_file, settings)
+        changed = (addresses != self.addresses or period != self.period or
+                   samples != self.samples)
 
-    logger.debug('Wrote configuration to: %s', gather_config_file)
+        self.addresses = addresses
+        self.period = period
+        self.samples = samples
 
-    comm.gpascii_file(gather_config_file)
+        if changed:
+            logger.debug('Gather reconfigured: %s', settings)
+            if self.settings_file is not None:
+                self._record()
+        else:
+            logger.debug('Gather configuration unchanged')
+
+        return samples
+
+    def _check(self, addresses, period, samples):
+        """
+        Read back the configuration just written, raising GPError on any
+        error or if it was not applied
+        """
+        names = self.variables
+        keys = ['items', 'period', 'max_samples']
+        expected = [len(addresses), period, samples]
+        actual = self.gpascii.get_variables_batch([names[key]
+                                                   for key in keys],
+                                                  type_=int)
+        if actual != expected:
+            raise pp_comm.GPError('Gather configuration not applied: %s' %
+                                  ', '.join('%s=%s (expected %s)' %
+                                            (names[key], value, exp)
+                                            for key, value, exp
+                                            in zip(keys, actual, expected)
+                                            if value != exp))
+
+    def _record(self):
+        names = self.variables
+        settings = ['%s[%d]=%s' % (names['addr'], i, addr)
+                    for i, addr in enumerate(self.addresses)]
+        settings.extend(['%s=%d' % (names['items'], len(self.addresses)),
+                         '%s=%d' % (names['period'], self.period),
+                         '%s=%d' % (names['max_samples'], self.samples)])
+
+        try:
+            self.gpascii._comm.write_file(self.settings_file,
+                                          '\n'.join(settings))
+        except Exception as ex:
+            logger.warning('Unable to record gather settings to %s: %s',
+                           self.settings_file, ex)
+
+
+def get_gather_config(gpascii, phase=False):
+    """
+    The servo (or phase) GatherConfig of a gpascii channel (created on
+    first use)
+    """
+    attr = '_phase_gather_config' if phase else '_gather_config'
+    config = getattr(gpascii, attr, None)
+    if config is None:
+        if phase:
+            config = GatherConfig(gpascii, settings_file=None, phase=True)
+        else:
+            config = GatherConfig(gpascii)
+        setattr(gpascii, attr, config)
+    return config
+
+
+def setup_gather(gpascii, addresses, duration=0.1, period=1,
+                 output_file=gather_output_file):
+    """
+    Configure the gather for `duration` seconds of data (see `GatherConfig`)
+
+    Returns: number of samples to be gathered
+    """
+    servo_period = gpascii.servo_period
 
-    max_lines = gpascii.get_variable('gather.maxlines', type_=int)
-    if max_lines < total_samples:
-        total_samples = max_lines
+    requested = get_sample_count(servo_period, period, duration)
+    total_samples = get_gather_config(gpascii).configure(addresses, period,
+                                                         samples=requested)
+    if total_samples < requested:
+        max_lines = total_samples
         duration = get_duration(servo_period, period, total_samples)
-        gpascii.set_variable('gather.maxsamples', total_samples)
 
         logger.warning('* Warning: Buffer not large enough.')
         logger.warning('  Maximum count with the current addresses: %d',
                        max_lines)
         logger.warning('  New duration is: %.2f s', duration)
+        logger.warning('  (see gather_stream.GatherStream for longer '
+                       'captures)')
 
     return total_samples
 
 
-def gather(gpascii, addresses, duration=0.1, period=1,
-           output_file=gather_output_file, verbose=True, f=sys.stdout):
+class GatherCancelled(Exception):
+    pass
 
-    total_samples = setup_gather(gpascii, addresses, duration=duration,
-                                 period=period, output_file=output_file)
 
-    gpascii.set_variable('gather.enable', 2)
-    samples = 0
+class GatherHandle(object):
+    """
+    Handle for a gather run by `gather_async`, similar to a future
+
+    >> handle = gather_async(comm.gpascii, addresses, duration=5.0)
+    >> handle.progress
+    (1234, 5000)
+    >> frame = handle.result()
+    """
+    PENDING, RUNNING, DOWNLOADING, DONE, CANCELLED, FAILED = \
+        ('pending', 'running', 'downloading', 'done', 'cancelled', 'failed')
+
+    def __init__(self, gpascii, addresses, duration=0.1, period=1,
+                 output_file=gather_output_file):
+        self.gpascii = gpascii
+        self.addresses = list(addresses)
+        self.duration = duration
+        self.period = period
+        self.output_file = output_file
+
+        self.state = self.PENDING
+        self.samples = 0
+        self.total_samples = None
+        self._result = None
+        self._exception = None
+        self._stop_requested = False
+        self._done_event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<GatherHandle %s %s>' % (self.state, self.progress)
+
+    @property
+    def progress(self):
+        """
+        (samples gathered, total samples)
+        """
+        return (self.samples, self.total_samples)
+
+    @property
+    def fraction(self):
+        if not self.total_samples:
+            return 0.0
+        return min(float(self.samples) / self.total_samples, 1.0)
+
+    def running(self):
+        return self.state in (self.RUNNING, self.DOWNLOADING)
+
+    def done(self):
+        return self._done_event.is_set()
+
+    def cancelled(self):
+        return self.state == self.CANCELLED
+
+    def cancel(self):
+        """
+        Cancel the gather
+
+        A pending gather is removed from the queue. A running gather is
+        stopped early; its result will hold the data gathered so far.
+
+        Returns: True if the gather was pending or running
+        """
+        with self._lock:
+            if self.state == self.PENDING:
+                self.state = self.CANCELLED
+            elif self.state == self.RUNNING:
+                self._stop_requested = True
+                return True
+            else:
+                return False
+
+        self._finish()
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Wait for completion
+
+        Returns: True if done
+        """
+        return self._done_event.wait(timeout)
+
+    def result(self, timeout=None):
+        """
+        Wait for and return the gathered data (GatherFrame)
+
+        Raises GatherCancelled if cancelled before starting, TimeoutError
+        if not done within `timeout`, or the exception raised by the gather
+        """
+        if not self._done_event.wait(timeout):
+            raise pp_comm.TimeoutError('Gather not done')
+        if self.state == self.CANCELLED:
+            raise GatherCancelled('Gather cancelled')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done_event.wait(timeout):
+            raise pp_comm.TimeoutError('Gather not done')
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(handle) when done (immediately, if already done)
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+
+        fn(self)
+
+    def _finish(self):
+        with self._lock:
+            self._done_event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as ex:
+                logger.error('Gather callback failed', exc_info=ex)
+
+    def _run(self):
+        with self._lock:
+            if self.state != self.PENDING:
+                return
+            self.state = self.RUNNING
+
+        gpascii = self.gpascii
+        try:
+            self.total_samples = setup_gather(gpascii, self.addresses,
+                                              duration=self.duration,
+                                              period=self.period,
+                                              output_file=self.output_file)
+
+            gpascii.set_variable('gather.enable', 2)
+            logger.info('Waiting for %d samples', self.total_samples)
+            try:
+                while (self.samples < self.total_samples and
+                       not self._stop_requested):
+                    self.samples = gpascii.get_variable('gather.samples',
+                                                        type_=int)
+                    time.sleep(0.1)
+            finally:
+                gpascii.set_variable('gather.enable', 0)
+
+            self.state = self.DOWNLOADING
+            self._result = get_gather_results(gpascii._comm, self.addresses,
+                                              self.output_file)
+            self.state = self.DONE
+        except Exception as ex:
+            logger.error('Gather failed', exc_info=ex)
+            self._exception = ex
+            self.state = self.FAILED
+        finally:
+            self._finish()
+
+
+class _GatherWorker(object):
+    """
+    Runs queued gathers one at a time in a background thread
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            handle = self.queue.get()
+            handle._run()
+
+    def submit(self, handle):
+        self.queue.put(handle)
+        return handle
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _get_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = _GatherWorker()
+        return _worker
+
+
+def gather_async(gpascii, addresses, duration=0.1, period=1,
+                 output_file=gather_output_file, callback=None):
+    """
+    Gather in the background, returning immediately
+
+    Gathers are queued and run one at a time: setup, polling, download and
+    parsing all happen on a worker thread.
+
+    callback: optional, called with the handle when done
+
+    Returns: GatherHandle
+    """
+    handle = GatherHandle(gpascii, addresses, duration=duration,
+                          period=period, output_file=output_file)
+    if callback is not None:
+        handle.add_done_callback(callback)
+    return _get_worker().submit(handle)
+
+
+def gather(gpascii, addresses, duration=0.1, period=1,
+           output_file=gather_output_file, verbose=True, f=sys.stdout):
+    handle = gather_async(gpascii, addresses, duration=duration,
+                          period=period, output_file=output_file)
 
-    logger.info('Waiting for %d samples', total_samples)
     try:
-        while samples < total_samples:
-            samples = gpascii.get_variable('gather.samples', type_=int)
-            if total_samples != 0 and verbose:
-                percent = 100. * (float(samples) / total_samples)
+        while not handle.wait(0.1):
+            samples, total_samples = handle.progress
+            if total_samples and verbose:
+                percent = 100. * handle.fraction
                 print('%-6d/%-6d (%.2f%%)' % (samples, total_samples,
                                               percent),
                       end='\r', file=f)
                 f.flush()
-            time.sleep(0.1)
     except KeyboardInterrupt:
-        pass
+        handle.cancel()
     finally:
         print(file=f)
 
-    gpascii.set_variable('gather.enable', 0)
-
-    comm = gpascii._comm
-    return get_gather_results(comm, addresses, output_file)
+    return handle.result()
 
 
 def get_columns(all_columns, data, *to_get):
     if data is None or len(data) == 0:
         return [np.zeros(1) for col in to_get]
 
+    if isinstance(data, GatherFrame):
+        return data.columns(*to_get)
+
     if isinstance(data, list):
         data = np.array(data)
 
@@ -211,64 +711,59 @@ def get_columns(all_columns, data, *to_get):
     return [data[:, idx] for idx in indices]
 
 
-INTERP_MAGIC = (ord('I') << 16) + (ord('N') << 8) + ord('T')
+INTERP_MAGIC = interp_table.MAGIC_V1
 
 
 def save_interp(fn, addresses, data, col,
-                point_time=1000, format_='I'):
+                point_time=1000, format_='I', dtypes='f8', scales=1.0):
     """
     Save gather data to a simple binary file, interpolated over
     a regularly spaced interval (defined by point_time usec)
 
-    Saves big endian, 32-bit unsigned integers (by default)
-    """
-    x, y = get_columns(addresses, data,
-                       'sys.servocount.a', col)
-
-    point_time = int(point_time)
-    start_t = x[0]
-    end_t = x[-1]
-    step_t = 1e-6 * point_time
-    new_x = np.arange(start_t, end_t, step_t)
-
-    y = np.interp(new_x, x, y)
-
-    # Store as big endian
-    format_ = '>%s' % format_
+    col: a single address saves the original single-channel format of big
+         endian, 32-bit unsigned integers (by default; format_='i' for
+         signed), as read by misc/dac_read.
+         A list of addresses saves a multi-channel table (see
+         `interp_table.write_table`) with per-channel dtypes and scale
+         factors.
 
-    with open(fn, 'wb') as f:
-        f.write(struct.pack(format_, INTERP_MAGIC))
-        f.write(struct.pack(format_, len(y)))
-        f.write(struct.pack(format_, point_time))
-        y.astype(format_).tofile(f)
+    The table is interpolated and written in chunks.
+    """
+    if isinstance(col, (list, tuple)):
+        columns = get_columns(addresses, data, 'sys.servocount.a', *col)
+        x, columns = columns[0], columns[1:]
+        interp_table.write_table(fn, x, columns, point_time=point_time,
+                                 dtypes=dtypes, scales=scales,
+                                 names=list(col))
+    else:
+        x, y = get_columns(addresses, data,
+                           'sys.servocount.a', col)
+        interp_table.write_table_v1(fn, x, y, point_time=point_time,
+                                    format_=format_)
 
 
-def load_interp(fn, format_='I'):
+def load_interp(fn, format_='I', raw=False):
     """
     Load gather data from an interpolated binary file (see save_interp)
-    """
-
-    header_st = struct.Struct('>III')
-    with open(fn, 'rb') as f:
-        header = f.read(header_st.size)
-        magic, points, point_time = header_st.unpack(header)
-
-        if magic != INTERP_MAGIC:
-            raise RuntimeError('Invalid file (magic=%x should be=%x)' %
-                               (magic, INTERP_MAGIC))
-
-        raw_data = f.read()
 
-    # Stored as big endian
-    format_ = '>%d%s' % (points, format_)
-
-    data = struct.unpack(format_, raw_data)
+    The file is memory mapped. Returns (t, data) where data is a single
+    column for single-channel files, or a list of columns (one per
+    channel) otherwise; stack them (np.column_stack) if needed, at the
+    cost of reading the whole table into memory.
+    raw: return the stored values without applying the scale factors, so
+         that every column remains memory mapped (scaled columns of
+         channels with a scale factor other than 1 are computed in memory)
+    """
+    table = interp_table.InterpTable(fn)
+    if table.version == 1 and format_ != 'I':
+        table.dtypes = [np.dtype(interp_table.V1_FORMATS[format_])]
 
-    point_time = 1.e-6 * point_time
-    t_end = point_time * points
-    t = np.arange(0, t_end, point_time)
+    if table.channels == 1:
+        data = table.channel(0, raw=raw)
+    else:
+        data = [table.channel(i, raw=raw) for i in range(table.channels)]
 
-    return t, np.array(data)
+    return table.times, data
 
 
 def get_addr_index(addresses, addr):
@@ -282,40 +777,130 @@ def get_addr_index(addresses, addr):
             return addresses.index(addr)
 
 
-def _check_times(gpascii, addresses, rows):
-    if rows is None or len(rows) == 0:
-        return rows
+def reconstruct_times(counts, servo_period, gather_period=1):
+    """
+    Reconstruct the time axis from gathered Sys.ServoCount values
 
-    if 'Sys.ServoCount.a' in addresses:
-        idx = get_addr_index(addresses, 'Sys.ServoCount.a')
-        servo_period = gpascii.servo_period
+    The counter is unwrapped across rollovers, and samples which do not
+    follow the previous one by the gather period (i.e., samples were
+    skipped) are flagged.
+
+    Returns: (float64 times in seconds, boolean gap mask)
+    """
+    counts, offset = unwrap.unwrap_counter(counts, bits=32)
+    if not len(counts):
+        return np.zeros(0), np.zeros(0, dtype=bool)
+
+    gap_mask = np.zeros(len(counts), dtype=bool)
+    gap_mask[1:] = np.diff(counts) != gather_period
+    return counts * float(servo_period), gap_mask
+
+
+def _valid_samples(counts):
+    """
+    Number of valid samples: trailing samples with a servo count of zero
+    were never filled in (e.g., when the gather buffer rolls over)
+    """
+    nonzero = np.nonzero(counts)[0]
+    if not len(nonzero):
+        return len(counts)
+    return nonzero[-1] + 1
 
-        times = [row[idx] for row in rows]
-        if isinstance(rows[0], tuple):
-            # TODO fast gather returns list of tuples
-            rows = [list(row) for row in rows]
 
+def _check_times(gpascii, frame, servo_period=None, gather_period=None):
+    """
+    Replace the Sys.ServoCount column of a frame with times in seconds
+
+    Returns: GatherFrame, with its gap mask set
+    """
+    if not len(frame) or 'Sys.ServoCount.a' not in frame:
+        return frame
+
+    if servo_period is None:
+        servo_period = gpascii.servo_period
+    if gather_period is None:
         gather_period = gpascii.get_variable('gather.period', type_=int)
-        if 0 in times:
-            # This happens when the gather buffer rolls over, iirc
-            logger.warning('Gather data issue, trimming data...')
-            last_time = times.index(0)
 
-            times = np.arange(0, len(rows) * gather_period, gather_period)
+    idx = frame.index('Sys.ServoCount.a')
+    counts = frame.column(idx)
+    valid = _valid_samples(counts)
+    if valid < len(frame):
+        logger.warning('Gather data issue, trimming %d unfilled samples',
+                       len(frame) - valid)
+        frame = frame[:valid]
+        counts = counts[:valid]
+
+    times, gap_mask = reconstruct_times(counts, servo_period, gather_period)
+    if gap_mask.any():
+        logger.warning('Gathered data has %d gap(s) (skipped samples)',
+                       np.count_nonzero(gap_mask))
+
+    columns = [frame.column(i) for i in range(len(frame.addresses))]
+    columns[idx] = times
+    return GatherFrame.from_columns(frame.addresses, columns,
+                                    servo_period=servo_period,
+                                    gather_period=gather_period,
+                                    gap_mask=gap_mask)
+
+
+def download_gather(comm, output_file=gather_output_file):
+    """
+    Download the raw gathered data, without parsing it
+
+    The result can be parsed later (e.g., in another thread, after the
+    gather buffer has been reconfigured) with `parse_downloaded_gather`.
+    """
+    if comm.fast_gather is not None:
+        # Use the 'fast gather' server
+        return ('fast', comm.fast_gather.query_types_and_raw_data())
+    else:
+        # Use the Delta Tau-supplied 'gather' program
+
+        # -u is for upload
+        comm.shell_command('gather "%s" -u' % (output_file, ))
+        return ('text', comm.read_file(output_file))
 
-            rows = rows[:last_time]
 
-        for row, t0 in zip(rows, times):
-            row[idx] = t0 * servo_period
+def _frame_from_raw(addresses, types, samples, raw_data):
+    """
+    GatherFrame from fast_gather types and raw data
+    """
+    from .fast_gather import GatherClient
+    return GatherClient.frame_from_raw(addresses, types, samples, raw_data)
 
-    return rows
+
+def parse_downloaded_gather(downloaded, addresses, servo_period,
+                            gather_period):
+    """
+    Parse data from `download_gather`
+
+    Returns: GatherFrame
+    """
+    kind, raw = downloaded
+    if kind == 'fast':
+        frame = _frame_from_raw(addresses, *raw)
+    else:
+        lines = [line.strip() for line in raw]
+        frame = GatherFrame.from_rows(addresses,
+                                      parse_gather(addresses, lines))
+
+    return _check_times(None, frame, servo_period=servo_period,
+                        gather_period=gather_period)
 
 
 def get_gather_results(comm, addresses, output_file=gather_output_file):
+    """
+    Read back gathered data
+
+    Returns: GatherFrame
+    """
+    gpascii = comm.gpascii
+    servo_period = gpascii.servo_period
+    gather_period = gpascii.get_variable('gather.period', type_=int)
+
     if comm.fast_gather is not None:
         # Use the 'fast gather' server
-        client = comm.fast_gather
-        rows = client.get_rows()
+        frame = comm.fast_gather.get_frame(addresses)
     else:
         # Use the Delta Tau-supplied 'gather' program
 
@@ -323,9 +908,329 @@ def get_gather_results(comm, addresses, output_file=gather_output_file):
         comm.shell_command('gather "%s" -u' % (output_file, ))
 
         lines = [line.strip() for line in comm.read_file(output_file)]
-        rows = parse_gather(addresses, lines)
+        frame = GatherFrame.from_rows(addresses,
+                                      parse_gather(addresses, lines))
+
+    return _check_times(gpascii, frame, servo_period=servo_period,
+                        gather_period=gather_period)
+
+
+PHASE_TIME_ADDRESS = 'Sys.PhaseCount.a'
+
+
+def reconstruct_phase_times(phase_counts, servo_counts, servo_period,
+                            phase_period, gather_period=1):
+    """
+    Place phase gather samples on the servo gather time axis (seconds, from
+    Sys.ServoCount as in `reconstruct_times`)
+
+    Sys.PhaseCount, gathered at phase rate, gives the time between samples.
+    Sys.ServoCount, gathered alongside it, anchors those times to the servo
+    clock: the first sample after the servo count increments is taken to
+    be at that servo interrupt. The result is accurate to within a phase
+    period.
+
+    phase_period: phase clock period, in seconds (the servo period times
+                  Sys.PhaseOverServoPeriod)
+
+    Returns: (float64 times in seconds, boolean gap mask)
+    """
+    phase_counts, offset = unwrap.unwrap_counter(phase_counts, bits=32)
+    servo_counts, offset = unwrap.unwrap_counter(servo_counts, bits=32)
+    if not len(phase_counts):
+        return np.zeros(0), np.zeros(0, dtype=bool)
+
+    ticks = np.nonzero(np.diff(servo_counts) > 0)[0] + 1
+    ref = ticks[0] if len(ticks) else 0
+
+    times = (servo_counts[ref] * float(servo_period) +
+             (phase_counts - phase_counts[ref]) * float(phase_period))
+
+    gap_mask = np.zeros(len(phase_counts), dtype=bool)
+    gap_mask[1:] = np.diff(phase_counts) != gather_period
+    return times, gap_mask
+
+
+def _check_phase_times(frame, servo_period, phase_period, gather_period):
+    """
+    Replace the Sys.PhaseCount and Sys.ServoCount columns of a phase gather
+    frame with times in seconds, on the servo gather time axis
+
+    Returns: GatherFrame, with its gap mask set
+    """
+    if (not len(frame) or PHASE_TIME_ADDRESS not in frame or
+            'Sys.ServoCount.a' not in frame):
+        return frame
+
+    phase_idx = frame.index(PHASE_TIME_ADDRESS)
+    servo_idx = frame.index('Sys.ServoCount.a')
+
+    valid = _valid_samples(frame.column(phase_idx))
+    if valid < len(frame):
+        logger.warning('Phase gather data issue, trimming %d unfilled '
+                       'samples', len(frame) - valid)
+        frame = frame[:valid]
+
+    servo_counts = frame.column(servo_idx)
+    times, gap_mask = reconstruct_phase_times(frame.column(phase_idx),
+                                              servo_counts, servo_period,
+                                              phase_period, gather_period)
+    if gap_mask.any():
+        logger.warning('Phase gathered data has %d gap(s) (skipped samples)',
+                       np.count_nonzero(gap_mask))
+
+    columns = [frame.column(i) for i in range(len(frame.addresses))]
+    columns[phase_idx] = times
+    columns[servo_idx] = reconstruct_times(servo_counts, servo_period)[0]
+
+    # The phase clock is the base clock of the phase gather
+    return GatherFrame.from_columns(frame.addresses, columns,
+                                    servo_period=phase_period,
+                                    gather_period=gather_period,
+                                    time_address=PHASE_TIME_ADDRESS,
+                                    gap_mask=gap_mask)
+
+
+def _phase_addresses(phase_addresses):
+    """
+    Phase gather addresses, with Sys.ServoCount and Sys.PhaseCount first
+    """
+    addresses = InsList(phase_addresses)
+    for addr in ('Sys.PhaseCount.a', 'Sys.ServoCount.a'):
+        if addr.lower() not in addresses:
+            addresses.insert(0, addr)
+    return list(addresses)
+
+
+def get_phase_gather_results(comm, servo_addresses, phase_addresses):
+    """
+    Read back the servo and phase gathers, in a single fast_gather request
 
-    return _check_times(comm.gpascii, addresses, rows)
+    The phase frame times are on the servo frame time axis (see
+    `reconstruct_phase_times`); its sample_period is the phase gather
+    period.
+
+    Returns: (servo GatherFrame, phase GatherFrame)
+    """
+    if comm.fast_gather is None:
+        raise ValueError('Phase gathering requires the fast_gather server')
+
+    gpascii = comm.gpascii
+    (servo_period, phase_ratio, gather_period,
+     phase_gather_period) = gpascii.get_variables_batch(
+        ['Sys.ServoPeriod', 'Sys.PhaseOverServoPeriod', 'gather.Period',
+         'gather.PhasePeriod'], type_=float)
+
+    servo_period *= 1e-3
+    phase_period = servo_period * phase_ratio
+
+    servo, phase = comm.fast_gather.query_servo_and_phase()
+
+    servo_frame = _check_times(gpascii, _frame_from_raw(servo_addresses,
+                                                        *servo),
+                               servo_period=servo_period,
+                               gather_period=int(gather_period))
+    phase_frame = _check_phase_times(_frame_from_raw(phase_addresses, *phase),
+                                     servo_period, phase_period,
+                                     int(phase_gather_period))
+    return servo_frame, phase_frame
+
+
+def phase_gather(gpascii, servo_addresses, phase_addresses, duration=0.1,
+                 period=1, phase_period=1):
+    """
+    Gather servo-rate and phase-rate data simultaneously
+
+    Sys.ServoCount.a is added to both gathers and Sys.PhaseCount.a to the
+    phase gather, to align them on a common time axis. The fast_gather
+    server is required.
+
+    period: servo gather period, in servo cycles
+    phase_period: phase gather period, in phase cycles
+
+    Returns: (servo GatherFrame, phase GatherFrame)
+    """
+    comm = gpascii._comm
+    if comm.fast_gather is None:
+        raise ValueError('Phase gathering requires the fast_gather server')
+
+    servo_addresses = InsList(servo_addresses)
+    if 'sys.servocount.a' not in servo_addresses:
+        servo_addresses.insert(0, 'Sys.ServoCount.a')
+    servo_addresses = list(servo_addresses)
+    phase_addresses = _phase_addresses(phase_addresses)
+
+    servo_period, phase_ratio = gpascii.get_variables_batch(
+        ['Sys.ServoPeriod', 'Sys.PhaseOverServoPeriod'], type_=float)
+    servo_period *= 1e-3
+    phase_clock = servo_period * phase_ratio
+
+    servo_samples = get_gather_config(gpascii).configure(
+        servo_addresses, period,
+        samples=get_sample_count(servo_period, period, duration))
+    phase_samples = get_gather_config(gpascii, phase=True).configure(
+        phase_addresses, phase_period,
+        samples=get_sample_count(phase_clock, phase_period, duration))
+
+    logger.info('Gathering %d servo and %d phase samples', servo_samples,
+                phase_samples)
+
+    gpascii.send_lines(['gather.PhaseEnable=2', 'gather.enable=2'])
+    try:
+        while True:
+            samples = gpascii.get_variables_batch(
+                ['gather.Samples', 'gather.PhaseSamples'], type_=int)
+            if samples[0] >= servo_samples and samples[1] >= phase_samples:
+                break
+            time.sleep(0.1)
+    finally:
+        gpascii.send_lines(['gather.enable=0', 'gather.PhaseEnable=0'])
+
+    return get_phase_gather_results(comm, servo_addresses, phase_addresses)
+
+
+def align_servo_to_phase(servo_frame, phase_frame):
+    """
+    Combine servo and phase gathered data on the phase time axis
+
+    Each servo sample is held until the next one (as servo-rate values are
+    constant over a servo cycle). Phase samples outside of the servo
+    gather are dropped.
+
+    Returns: GatherFrame with the phase columns followed by the servo
+             columns (except Sys.ServoCount, already in the phase frame)
+    """
+    servo_times = servo_frame.times
+    phase_times = phase_frame.times
+    if not len(servo_times) or not len(phase_times):
+        keep = np.zeros(len(phase_times), dtype=bool)
+        idx = np.zeros(len(phase_times), dtype=int)
+    else:
+        idx = np.searchsorted(servo_times, phase_times, 'right') - 1
+        end = servo_times[-1] + (servo_frame.sample_period or 0.0)
+        keep = (idx >= 0) & (phase_times < end)
+
+    idx = idx[keep]
+
+    addresses = list(phase_frame.addresses)
+    columns = [phase_frame.column(i)[keep] for i in range(len(addresses))]
+    for i, addr in enumerate(servo_frame.addresses):
+        if addr in phase_frame:
+            continue
+        addresses.append(addr)
+        columns.append(servo_frame.column(i)[idx])
+
+    return GatherFrame.from_columns(addresses, columns,
+                                    servo_period=phase_frame.servo_period,
+                                    gather_period=phase_frame.gather_period,
+                                    time_address=phase_frame.time_address)
+
+
+class GatherCache(object):
+    """
+    Bounded LRU cache of parsed gather results
+
+    Entries are keyed by the identity of the gather on the controller: the
+    host, addresses, gather period and sample count and, with the
+    fast_gather server, the raw last gathered line (which includes its
+    Sys.ServoCount). Checking the identity takes a single pipelined
+    gpascii request (and a small fast_gather request), so repeated reads
+    of unchanged data avoid the transfer and parsing.
+
+    Without the fast_gather server, a new gather with the same settings and
+    sample count cannot be told apart; gathers started through this module
+    invalidate the cache for that reason.
+
+    Cached frames are read-only.
+    """
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return ('<GatherCache entries=%d/%d hits=%d misses=%d>' %
+                (len(self._entries), self.max_entries, self.hits,
+                 self.misses))
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def identity(self, comm, addresses):
+        """
+        Identity of the gathered data on the controller
+
+        Returns: (identity, gather running)
+        """
+        samples, period, enable = comm.gpascii.get_variables_batch(
+            ['gather.Samples', 'gather.Period', 'gather.Enable'], type_=int)
+
+        tail = None
+        if comm.fast_gather is not None:
+            tail_samples, tail = comm.fast_gather.query_tail()
+            tail = (tail_samples, bytes(tail))
+
+        key = (getattr(comm, '_host', None),
+               tuple(addr.lower() for addr in addresses),
+               period, samples, tail)
+        return key, (enable != 0)
+
+    def get(self, comm, addresses, output_file=gather_output_file):
+        """
+        Gathered data (see `get_gather_results`), from the cache if it has
+        not changed on the controller
+
+        Returns: GatherFrame
+        """
+        key, running = self.identity(comm, addresses)
+        with self._lock:
+            if not running and key in self._entries:
+                # Most recently used entries are kept last
+                frame = self._entries.pop(key)
+                self._entries[key] = frame
+                self.hits += 1
+                logger.debug('Gather cache hit')
+                return frame
+
+        self.misses += 1
+        frame = get_gather_results(comm, addresses, output_file)
+        if running:
+            # Still gathering; the data is incomplete
+            return frame
+
+        frame.set_read_only()
+        if frame.gap_mask is not None:
+            frame.gap_mask.flags.writeable = False
+
+        with self._lock:
+            self._entries[key] = frame
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return frame
+
+
+gather_cache = GatherCache()
+
+
+def get_cached_gather_results(comm, addresses, output_file=gather_output_file,
+                              cache=None):
+    """
+    Read back gathered data, using a GatherCache (the module-wide
+    `gather_cache` by default)
+
+    Returns: GatherFrame (read-only)
+    """
+    if cache is None:
+        cache = gather_cache
+    return cache.get(comm, addresses, output_file)
 
 
 def gather_data_to_file(fn, addr, data, delim='\t'):
@@ -341,13 +1246,16 @@ def gather_data_from_file(fn, delim='\t'):
         addresses = f.readline()
         addresses = addresses.strip().split(delim)
 
-        lines = [line.strip() for line in f.readlines()]
+        lines = [line.strip() for line in f]
 
     return addresses, parse_gather(addresses, lines, delim=delim)
 
 
 def plot(addr, data):
-    x_idx = get_addr_index(addr, 'Sys.ServoCount.a')
+    if isinstance(data, GatherFrame):
+        x_idx = data.index('Sys.ServoCount.a')
+    else:
+        x_idx = get_addr_index(addr, 'Sys.ServoCount.a')
 
     data = np.array(data)
     x_axis = data[:, x_idx] - data[0, x_idx]
@@ -356,7 +1264,7 @@ def plot(addr, data):
             pass
         else:
             plt.figure(i)
-            plt.plot(x_axis, data[:, i], label=addr[i])
+            lod_plot.plot(plt.gca(), x_axis, data[:, i], label=addr[i])
             plt.legend()
 
     logger.debug('Plotting')
@@ -413,13 +1321,11 @@ def plot_tune_results(columns, data,
                             'Desired', 'Actual',
                             'Velocity']):
 
-    data = np.array(data)
-    idx = [columns.index(key) for key in keys]
-    x_axis, desired, actual, velocity = [data[:, i] for i in idx]
+    x_axis, desired, actual, velocity = get_columns(columns, data, *keys)
 
     fig, ax1 = plt.subplots()
-    ax1.plot(x_axis, desired, color='black', label='Desired')
-    ax1.plot(x_axis, actual, color='b', label='Actual')
+    lod_plot.plot(ax1, x_axis, desired, color='black', label='Desired')
+    lod_plot.plot(ax1, x_axis, actual, color='b', label='Actual')
     ax1.set_xlabel('Time (s)')
     ax1.set_ylabel('Position (motor units)')
     for tl in ax1.get_yticklabels():
@@ -427,7 +1333,8 @@ def plot_tune_results(columns, data,
 
     error = desired - actual
     ax2 = ax1.twinx()
-    ax2.plot(x_axis, error, color='r', alpha=0.4, label='Following error')
+    lod_plot.plot(ax2, x_axis, error, color='r', alpha=0.4,
+                  label='Following error')
     ax2.set_ylabel('Error (motor units)')
     for tl in ax2.get_yticklabels():
         tl.set_color('r')
@@ -497,9 +1404,15 @@ def geterrors_motor(motor, time_=0.3, abort_cmd='', m_mask=0x7ac, c_mask=0x7ac,
 def run_and_gather(gpascii, script_text, prog=999, coord_sys=0,
                    gather_vars=[], period=1, samples=max_samples,
                    cancel_callback=None, check_active=False,
-                   verbose=True):
+                   verbose=True, force_download=False):
     """
     Run a motion program and read back the gathered data
+
+    Program buffers opened in script_text which are unchanged since they
+    were last sent are not downloaded again, unless force_download is set
+    (see GpasciiChannel.send_script).
+
+    Returns: GatherFrame (gathered variables are in frame.addresses)
     """
 
     if 'gather.enable' not in script_text.lower():
@@ -509,27 +1422,18 @@ def run_and_gather(gpascii, script_text, prog=999, coord_sys=0,
                                  ])
 
     comm = gpascii._comm
-    gpascii.set_variable('gather.enable', '0')
 
     gather_vars = InsList(gather_vars)
 
     if 'sys.servocount.a' not in gather_vars:
         gather_vars.insert(0, 'Sys.ServoCount.a')
 
-    settings = get_settings(gpascii.servo_period, gather_vars,
-                            gather_period=period,
-                            samples=samples)
-
-    settings = '\n'.join(settings)
-
-    comm.write_file(gather_config_file, settings)
+    get_gather_config(gpascii).configure(gather_vars, period, samples=samples)
 
-    logger.info('Wrote configuration to %s', gather_config_file)
-
-    comm.gpascii_file(gather_config_file, verbose=verbose)
-
-    for line in script_text.split('\n'):
-        gpascii.send_line(line.lstrip())
+    script_lines = script_text.split('\n')
+    # Program buffers unchanged since last sent are skipped; other lines
+    # are always sent
+    gpascii.send_script(script_lines, force=force_download, verbose=verbose)
 
     gpascii.program(coord_sys, prog, start=True)
 
@@ -569,23 +1473,17 @@ def run_and_gather(gpascii, script_text, prog=999, coord_sys=0,
     except pp_comm.TimeoutError:
         pass
 
-    data = get_gather_results(comm, gather_vars, gather_output_file)
-    return gather_vars, data
+    return get_gather_results(comm, gather_vars, gather_output_file)
 
 
 def check_servocapt_rollover(scapt, rollover=1e6):
-    ret = np.zeros(len(scapt), dtype=float)
-    last_raw = scapt[0]
-    offset = 0
-    for i, raw_s in enumerate(scapt):
-        if abs(raw_s - last_raw) > rollover:
-            offset += last_raw - raw_s
-
-        ret[i] = offset + raw_s
-
-        last_raw = raw_s
+    """
+    Join ServoCapt data across rollovers (jumps larger than `rollover`)
 
-    return ret
+    See `unwrap.unwrap_counter` to unwrap counters of a known bit width.
+    """
+    unwrapped, offset = unwrap.unwrap_counter(scapt, threshold=rollover)
+    return unwrapped.astype(float)
 
 
 def main():
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.gather_frame` -- Gather result container
+====================================================
+
+.. module:: ppmac.gather_frame
+   :synopsis: GatherFrame holds the result of a gather: the gathered
+              addresses, one numpy column per address (each keeping its own
+              dtype) and the time axis metadata (servo and gather periods).
+
+              Each column is stored as its own numpy array (contiguous,
+              except for frames viewing a file of records), so columns and
+              slices of the frame are views rather than copies. Rows are
+              built on demand. Columns are looked up by address in constant
+              time, case-insensitively and with or without the `.a` suffix.
+
+              For compatibility with code expecting a 2D array of samples,
+              np.array(frame) returns a (samples x addresses) array.
+              Frames can be exported to pandas and Arrow (`to_pandas`,
+              `to_arrow`) without copying the columns; both are optional
+              dependencies.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import six
+
+
+logger = logging.getLogger(__name__)
+
+TIME_ADDRESS = 'Sys.ServoCount.a'
+# Name of the time index/column in pandas and Arrow exports
+TIME_NAME = 'Time'
+
+
+def _address_keys(address):
+    """
+    Lookup keys for an address: lower-case, with and without the .a suffix
+    """
+    key = address.lower()
+    if key.endswith('.a'):
+        return [key, key[:-2]]
+    return [key, key + '.a']
+
+
+class GatherFrame(object):
+    """
+    Gathered data, indexed by address
+
+    >> frame = gather.get_gather_results(comm, addresses)
+    >> frame['Motor[1].ActPos']          # column view (.a suffix optional)
+    >> frame[10]                         # row (a tuple of values)
+    >> frame.times                       # time axis, in seconds
+    >> frame.time_slice(0.1, 0.2)        # frame view of a time window
+    >> np.array(frame)                   # 2D array (samples x addresses)
+
+    addresses: gathered addresses
+    data: list of 1D numpy arrays, one per address, all the same length
+          (used as given, without copying). A structured array with one
+          field per address is also accepted; its fields are used as
+          columns. See `from_columns` and `from_rows` for other layouts.
+    servo_period: servo period, in seconds
+    gather_period: gather period, in servo cycles
+    time_address: address of the time column, which holds seconds (as
+                  rewritten from Sys.ServoCount by gather._check_times)
+    gap_mask: boolean array, True for samples preceded by skipped samples
+              (see gather.reconstruct_times)
+    """
+
+    def __init__(self, addresses, data, servo_period=None, gather_period=1,
+                 time_address=TIME_ADDRESS, gap_mask=None):
+        addresses = list(addresses)
+        if isinstance(data, np.ndarray) and data.dtype.names is not None:
+            data = [data[name] for name in data.dtype.names]
+
+        columns = [np.asarray(column) for column in data]
+        if len(columns) != len(addresses):
+            raise ValueError('Number of columns (%d) does not match number '
+                             'of addresses (%d)' % (len(columns),
+                                                    len(addresses)))
+
+        if len(set(len(column) for column in columns)) > 1:
+            raise ValueError('Columns differ in length')
+
+        self.addresses = addresses
+        self._columns = columns
+        self.servo_period = servo_period
+        self.gather_period = gather_period
+        self.gap_mask = gap_mask
+
+        self._index = {}
+        for i, address in enumerate(addresses):
+            for key in _address_keys(address):
+                self._index.setdefault(key, i)
+
+        if time_address is not None and time_address.lower() in self._index:
+            self.time_address = time_address
+        else:
+            self.time_address = None
+
+    @staticmethod
+    def _field(i):
+        return 'f%d' % i
+
+    @classmethod
+    def from_columns(cls, addresses, columns, **kwargs):
+        """
+        Create a frame from a list of columns, one per address
+
+        The dtype of each column is preserved. Numpy arrays are used without
+        copying; columns longer than the shortest are truncated (as views).
+        """
+        columns = [np.asarray(column) for column in columns]
+        samples = min(len(column) for column in columns) if columns else 0
+        return cls(addresses, [column[:samples] for column in columns],
+                   **kwargs)
+
+    @classmethod
+    def from_rows(cls, addresses, rows, **kwargs):
+        """
+        Create a frame from rows of samples (a 2D array or a list of row
+        sequences)
+        """
+        addresses = list(addresses)
+        if isinstance(rows, np.ndarray) and rows.ndim == 2:
+            columns = [np.ascontiguousarray(column) for column in rows.T]
+        elif rows is None or len(rows) == 0:
+            columns = [np.zeros(0) for address in addresses]
+        else:
+            columns = list(zip(*rows))
+
+        return cls.from_columns(addresses, columns, **kwargs)
+
+    @classmethod
+    def from_array(cls, addresses, array, **kwargs):
+        """
+        Create a frame from any supported layout: a GatherFrame, a
+        structured array, a 2D array or a list of rows
+        """
+        if isinstance(array, GatherFrame):
+            return array
+        elif isinstance(array, np.ndarray) and array.dtype.names is not None:
+            return cls(addresses, array, **kwargs)
+        return cls.from_rows(addresses, array, **kwargs)
+
+    def index(self, address):
+        """
+        Column index of an address (case-insensitive, .a suffix optional)
+        """
+        if isinstance(address, six.integer_types):
+            return address
+
+        try:
+            return self._index[address.lower()]
+        except KeyError:
+            raise KeyError('Address not gathered: %s' % address)
+
+    def __contains__(self, address):
+        return address.lower() in self._index
+
+    def column(self, address):
+        """
+        Column view for an address (or column index)
+        """
+        return self._columns[self.index(address)]
+
+    def columns(self, *addresses):
+        return [self.column(address) for address in addresses]
+
+    def row(self, i):
+        """
+        Row i, as a tuple of values
+        """
+        return tuple(column[i] for column in self._columns)
+
+    def rows(self):
+        """
+        Iterate over rows
+        """
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def _view(self, key):
+        gap_mask = self.gap_mask
+        if gap_mask is not None:
+            gap_mask = gap_mask[key]
+
+        return GatherFrame(self.addresses,
+                           [column[key] for column in self._columns],
+                           servo_period=self.servo_period,
+                           gather_period=self.gather_period,
+                           time_address=self.time_address,
+                           gap_mask=gap_mask)
+
+    def __getitem__(self, key):
+        if isinstance(key, six.string_types):
+            return self.column(key)
+        elif isinstance(key, tuple):
+            # 2D array-style indexing: frame[rows, columns]
+            return self.values[key]
+        elif isinstance(key, six.integer_types + (np.integer, )):
+            return self.row(key)
+        # Slices (views), index arrays and boolean masks (copies)
+        return self._view(key)
+
+    def __len__(self):
+        if not self._columns:
+            return 0
+        return len(self._columns[0])
+
+    def __iter__(self):
+        return self.rows()
+
+    @property
+    def shape(self):
+        return (len(self), len(self.addresses))
+
+    @property
+    def dtypes(self):
+        return [column.dtype for column in self._columns]
+
+    @property
+    def data(self):
+        """
+        Data as a structured array, with one field per address (a copy;
+        see `to_records`)
+        """
+        return self.to_records()
+
+    def to_records(self, dtype=None):
+        """
+        Copy the data into a structured array, with one field per address
+
+        dtype: structured dtype of the result (defaults to the column
+               dtypes, with fields named f0, f1, ...)
+        """
+        if dtype is None:
+            dtype = np.dtype([(self._field(i), column.dtype)
+                              for i, column in enumerate(self._columns)])
+
+        records = np.empty(len(self), dtype=dtype)
+        for name, column in zip(records.dtype.names, self._columns):
+            records[name] = column
+        return records
+
+    def set_read_only(self):
+        """
+        Mark all columns as read-only
+        """
+        for column in self._columns:
+            column.flags.writeable = False
+
+    @property
+    def values(self):
+        """
+        Data as a 2D array (samples x addresses), a copy in the common dtype
+        of all columns
+        """
+        if not self._columns:
+            return np.zeros((0, 0))
+        return np.column_stack(self._columns)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.values
+        if dtype is not None:
+            values = values.astype(dtype)
+        return values
+
+    @property
+    def sample_period(self):
+        """
+        Time between samples, in seconds
+        """
+        if self.servo_period is None:
+            return None
+        return self.servo_period * self.gather_period
+
+    @property
+    def times(self):
+        """
+        Time of each sample, in seconds
+
+        Taken from the time column if gathered, otherwise generated from the
+        servo and gather periods
+        """
+        if self.time_address is not None:
+            return self.column(self.time_address)
+
+        period = self.sample_period
+        if period is None:
+            period = 1.0
+        return np.arange(len(self)) * period
+
+    def time_slice(self, start=None, stop=None):
+        """
+        Frame view of the samples with start <= time < stop
+        """
+        times = self.times
+        i0 = 0 if start is None else np.searchsorted(times, start, 'left')
+        i1 = len(times) if stop is None else np.searchsorted(times, stop,
+                                                             'left')
+        return self._view(slice(i0, i1))
+
+    @property
+    def gaps(self):
+        """
+        Indices of samples preceded by skipped samples
+        """
+        if self.gap_mask is None:
+            return np.zeros(0, dtype=int)
+        return np.nonzero(self.gap_mask)[0]
+
+    def to_dict(self):
+        """
+        Columns as a dictionary of {address: column view}
+        """
+        return dict((address, self.column(i))
+                    for i, address in enumerate(self.addresses))
+
+    def _export_columns(self):
+        """
+        (address, column view) of each column other than the time column
+        """
+        time_index = None
+        if self.time_address is not None:
+            time_index = self.index(self.time_address)
+
+        return [(address, self.column(i))
+                for i, address in enumerate(self.addresses)
+                if i != time_index]
+
+    def to_pandas(self, time_index=True):
+        """
+        Export as a pandas DataFrame, with one column per address
+
+        The columns (and the time index) are views of the frame's column
+        arrays rather than copies. pandas is only imported when this is
+        called.
+
+        time_index: index the rows by sample time (`times`, in seconds), in
+                    place of the time column; otherwise, all columns are kept
+                    and the index is the sample number
+        """
+        import pandas as pd
+
+        if time_index:
+            columns = self._export_columns()
+            index = pd.Index(self.times, name=TIME_NAME, copy=False)
+        else:
+            columns = [(address, self.column(i))
+                       for i, address in enumerate(self.addresses)]
+            index = None
+
+        names = [address for address, column in columns]
+        return pd.DataFrame(OrderedDict(columns), columns=names, index=index,
+                            copy=False)
+
+    def to_arrow(self):
+        """
+        Export as a pyarrow Table, with a leading time column (`times`, in
+        seconds) and one column per address
+
+        Columns are shared with Arrow without copying; only strided columns
+        (of frames viewing a file of records, see `from_array`) are copied.
+        The servo and gather periods are stored in the schema metadata.
+        pyarrow is only imported when this is called.
+        """
+        import pyarrow as pa
+
+        columns = [(TIME_NAME, self.times)] + self._export_columns()
+        names = [name for name, column in columns]
+        arrays = [pa.array(np.ascontiguousarray(column))
+                  for name, column in columns]
+
+        metadata = {'servo_period': repr(self.servo_period),
+                    'gather_period': repr(self.gather_period),
+                    }
+        return pa.Table.from_arrays(arrays, names=names, metadata=metadata)
+
+    def __repr__(self):
+        return ('<GatherFrame samples=%d addresses=%s>' %
+                (len(self), self.addresses))
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.gather_stats` -- Streaming statistics of gathered data
+==================================================================
+
+.. module:: ppmac.gather_stats
+   :synopsis: Online, mergeable statistics over gather columns: count,
+              mean, RMS, standard deviation, min/max, peak-to-peak and
+              approximate percentiles, plus the following error
+              (DesPos - ActPos) of every motor with both gathered.
+
+              Statistics are updated one chunk at a time (e.g., streamed
+              blocks or gather store chunks), using vectorized reductions
+              per chunk. Partial results from several chunks or workers
+              combine exactly, except for the percentiles, which are
+              estimated from a bottom-k random sample of fixed size (also
+              mergeable).
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import re
+import sys
+import logging
+
+import numpy as np
+
+from .gather_frame import GatherFrame
+
+
+logger = logging.getLogger(__name__)
+
+# Number of samples kept per column for percentile estimates
+SAMPLE_SIZE = 2048
+
+_MOTOR_POS_RE = re.compile(r'^(motor\[\d+\])\.(despos|actpos)(\.a)?$',
+                           re.IGNORECASE)
+
+
+class ColumnStats(object):
+    """
+    Mergeable statistics of a single column
+
+    >> stats = ColumnStats()
+    >> for chunk in chunks:
+    ..     stats.update(chunk)
+    >> stats.rms, stats.percentile(99)
+    """
+
+    def __init__(self, sample_size=SAMPLE_SIZE, seed=None):
+        self.sample_size = sample_size
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sum_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.nan_count = 0
+
+        self._random = np.random.RandomState(seed)
+        self._keys = np.zeros(0)
+        self._values = np.zeros(0)
+
+    def update(self, values):
+        """
+        Add a chunk of values (NaNs are counted separately and skipped)
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        nan = np.isnan(values)
+        if nan.any():
+            self.nan_count += int(np.count_nonzero(nan))
+            values = values[~nan]
+
+        n = len(values)
+        if not n:
+            return self
+
+        mean = values.mean()
+        m2 = np.sum((values - mean) ** 2)
+        self._combine(n, mean, m2, np.dot(values, values), values.min(),
+                      values.max())
+
+        keys = self._random.random_sample(n)
+        self._add_samples(keys, values)
+        return self
+
+    def _combine(self, n, mean, m2, sum_sq, min_, max_):
+        # Chan et al. parallel variance
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.count * n / total
+        self.count = total
+        self.sum_sq += sum_sq
+        self.min = min(self.min, min_)
+        self.max = max(self.max, max_)
+
+    def _add_samples(self, keys, values):
+        # Bottom-k sampling: keeping the values with the k smallest random
+        # keys gives a uniform sample, and merges by the same rule
+        keys = np.concatenate((self._keys, keys))
+        values = np.concatenate((self._values, values))
+        if len(keys) > self.sample_size:
+            keep = np.argpartition(keys, self.sample_size)[:self.sample_size]
+            keys, values = keys[keep], values[keep]
+
+        self._keys, self._values = keys, values
+
+    def merge(self, other):
+        """
+        Combine the statistics of another ColumnStats into this one
+        """
+        if other.count:
+            self._combine(other.count, other.mean, other.m2, other.sum_sq,
+                          other.min, other.max)
+            self._add_samples(other._keys, other._values)
+
+        self.nan_count += other.nan_count
+        return self
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def rms(self):
+        if not self.count:
+            return np.nan
+        return np.sqrt(self.sum_sq / self.count)
+
+    @property
+    def peak_to_peak(self):
+        if not self.count:
+            return np.nan
+        return self.max - self.min
+
+    @property
+    def exact_percentiles(self):
+        """
+        True if the percentiles are computed from all of the values
+        """
+        return self.count <= self.sample_size
+
+    def percentile(self, q):
+        """
+        Percentile(s) q (0-100), approximate when more values were added
+        than the sample size
+        """
+        if not len(self._values):
+            return np.nan
+        return np.percentile(self._values, q)
+
+    def to_dict(self, percentiles=(1, 50, 99)):
+        result = {'count': self.count,
+                  'mean': self.mean if self.count else np.nan,
+                  'rms': self.rms,
+                  'std': self.std,
+                  'min': self.min if self.count else np.nan,
+                  'max': self.max if self.count else np.nan,
+                  'peak_to_peak': self.peak_to_peak,
+                  }
+        for q in percentiles:
+            result['p%g' % q] = self.percentile(q)
+        return result
+
+    def __repr__(self):
+        return ('<ColumnStats count=%d mean=%g rms=%g min=%g max=%g>' %
+                (self.count, self.mean, self.rms, self.min, self.max))
+
+
+def following_error_pairs(addresses):
+    """
+    Find motors with both DesPos and ActPos in a list of addresses
+
+    Returns: {'Motor[n].FollowingError': (despos address, actpos address)}
+    """
+    found = {}
+    for addr in addresses:
+        m = _MOTOR_POS_RE.match(addr)
+        if m:
+            motor, kind, suffix = m.groups()
+            found.setdefault(motor, {})[kind.lower()] = addr
+
+    pairs = {}
+    for motor, kinds in found.items():
+        if 'despos' in kinds and 'actpos' in kinds:
+            name = '%s.FollowingError' % motor.capitalize()
+            pairs[name] = (kinds['despos'], kinds['actpos'])
+    return pairs
+
+
+class GatherStats(object):
+    """
+    Streaming statistics of all columns of a gather
+
+    >> stats = GatherStats()
+    >> for block in stream.iter_blocks(duration=10.0):
+    ..     stats.update(block)
+    >> stats['Motor[1].FollowingError'].rms
+
+    Following errors (DesPos - ActPos) are added for each motor with both
+    addresses gathered. The time column is skipped.
+
+    addresses: columns to include (defaults to all, set on the first update)
+    """
+
+    def __init__(self, addresses=None, following_error=True,
+                 sample_size=SAMPLE_SIZE):
+        self.addresses = addresses
+        self.following_error = following_error
+        self.sample_size = sample_size
+        self.columns = {}
+        self.pairs = {}
+        self.chunks = 0
+
+    @classmethod
+    def from_chunks(cls, chunks, **kwargs):
+        """
+        Statistics of an iterable of chunks (e.g., GatherStore.iter_chunks)
+        """
+        stats = cls(**kwargs)
+        for chunk in chunks:
+            stats.update(chunk)
+        return stats
+
+    def _setup(self, frame):
+        if self.addresses is None:
+            self.addresses = [addr for addr in frame.addresses
+                              if frame.time_address is None or
+                              addr.lower() != frame.time_address.lower()]
+
+        if self.following_error:
+            self.pairs = following_error_pairs(self.addresses)
+
+        for name in list(self.addresses) + sorted(self.pairs):
+            self.columns[name] = ColumnStats(self.sample_size)
+
+    def update(self, frame):
+        """
+        Add a chunk: a GatherFrame (or a (samples x addresses) array, if
+        addresses were given)
+        """
+        if not isinstance(frame, GatherFrame):
+            if self.addresses is None:
+                raise ValueError('Addresses required for non-frame data')
+            frame = GatherFrame.from_array(self.addresses, frame,
+                                           time_address=None)
+
+        if not self.columns:
+            self._setup(frame)
+
+        for addr in self.addresses:
+            self.columns[addr].update(frame.column(addr))
+
+        for name, (despos, actpos) in self.pairs.items():
+            error = (frame.column(despos).astype(float) -
+                     frame.column(actpos).astype(float))
+            self.columns[name].update(error)
+
+        self.chunks += 1
+        return self
+
+    def merge(self, other):
+        """
+        Combine the statistics of another GatherStats (e.g., from another
+        worker) into this one
+        """
+        if not self.columns:
+            self.addresses = other.addresses
+            self.pairs = dict(other.pairs)
+            self.columns = dict((name, ColumnStats(self.sample_size))
+                                for name in other.columns)
+
+        for name, stats in other.columns.items():
+            if name not in self.columns:
+                self.columns[name] = ColumnStats(self.sample_size)
+            self.columns[name].merge(stats)
+
+        self.chunks += other.chunks
+        return self
+
+    def __getitem__(self, name):
+        try:
+            return self.columns[name]
+        except KeyError:
+            pass
+
+        key = name.lower()
+        for column, stats in self.columns.items():
+            column = column.lower()
+            if key in (column, column + '.a') or key + '.a' == column:
+                return stats
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def to_dict(self, percentiles=(1, 50, 99)):
+        return dict((name, stats.to_dict(percentiles))
+                    for name, stats in self.columns.items())
+
+    def report(self, f=sys.stdout, percentiles=(1, 50, 99)):
+        """
+        Print a table of the statistics
+        """
+        keys = ['count', 'mean', 'rms', 'std', 'min', 'max', 'peak_to_peak']
+        keys += ['p%g' % q for q in percentiles]
+        print('%-30s' % 'Column' + ''.join('%14s' % key for key in keys),
+              file=f)
+
+        for name in list(self.addresses or []) + sorted(self.pairs):
+            info = self.columns[name].to_dict(percentiles)
+            print('%-30s' % name +
+                  ''.join('%14.6g' % info[key] for key in keys), file=f)
+
+
+def combine(stats_list):
+    """
+    Combine a list of GatherStats (or ColumnStats) into a new instance
+    """
+    stats_list = list(stats_list)
+    if not stats_list:
+        return GatherStats()
+
+    first = stats_list[0]
+    if isinstance(first, ColumnStats):
+        result = ColumnStats(first.sample_size)
+    else:
+        result = GatherStats(following_error=first.following_error,
+                             sample_size=first.sample_size)
+
+    for stats in stats_list:
+        result.merge(stats)
+    return result
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.gather_store` -- Chunked columnar gather storage
+============================================================
+
+.. module:: ppmac.gather_store
+   :synopsis: Binary on-disk format for gathered data. A store is a
+              directory holding an index (index.json) and one file per
+              column per chunk:
+
+                  index.json      addresses, dtypes, servo/gather period,
+                                  creation timestamp and, for each chunk,
+                                  its sample count and time range
+                  c000000_0.npy   chunk 0, column 0
+                  c000000_1.npy   chunk 0, column 1
+                  ...
+
+              Uncompressed chunks are standard .npy files, read lazily by
+              memory mapping. Compressed chunks (.npy.z) are zlib-compressed
+              raw arrays, decompressed only when needed. The per-chunk time
+              ranges (from Sys.ServoCount, in seconds) allow reading a time
+              window and/or a subset of columns without loading the rest.
+
+              Stores can be appended to, e.g., by a streaming gather.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import os
+import json
+import time
+import zlib
+import logging
+
+import numpy as np
+
+from .gather_frame import GatherFrame
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+FORMAT_VERSION = 1
+
+
+class GatherStore(object):
+    """
+    Chunked columnar gather store
+
+    >> store = GatherStore.create('scan1', frame.addresses,
+                                  servo_period=frame.servo_period)
+    >> store.append(frame)
+    >> store.close()
+
+    >> store = GatherStore('scan1')
+    >> store.read(['Motor[1].ActPos'], start=1.0, stop=2.0)
+    <GatherFrame ...>
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), 'rt') as f:
+            self.index = json.load(f)
+
+        self.addresses = self.index['addresses']
+        self.dtypes = [np.dtype(dtype) for dtype in self.index['dtypes']]
+        self._pending = []
+        self._pending_samples = 0
+        self._lookup = GatherFrame(self.addresses,
+                                   np.zeros(0, dtype=self._record_dtype()))
+
+    @classmethod
+    def create(cls, path, addresses, dtypes=None, servo_period=None,
+               gather_period=1, compress=False, chunk_size=65536,
+               timestamp=None, time_address='Sys.ServoCount.a'):
+        """
+        Create a new, empty store
+
+        dtypes: column dtypes (defaults to float64); may be left as None and
+                set by the first append
+        """
+        if os.path.exists(os.path.join(path, INDEX_FILE)):
+            raise IOError('Store already exists: %s' % path)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        if dtypes is None:
+            dtypes = [np.float64] * len(addresses)
+
+        index = {'version': FORMAT_VERSION,
+                 'addresses': list(addresses),
+                 'dtypes': [np.dtype(dtype).str for dtype in dtypes],
+                 'servo_period': servo_period,
+                 'gather_period': gather_period,
+                 'timestamp': timestamp,
+                 'compress': bool(compress),
+                 'chunk_size': int(chunk_size),
+                 'time_address': time_address,
+                 'chunks': [],
+                 }
+
+        _write_index(path, index)
+        return cls(path)
+
+    @classmethod
+    def from_frame(cls, path, frame, compress=False, chunk_size=65536,
+                   timestamp=None):
+        """
+        Create a store holding the data of a GatherFrame
+        """
+        store = cls.create(path, frame.addresses, dtypes=frame.dtypes,
+                           servo_period=frame.servo_period,
+                           gather_period=frame.gather_period,
+                           compress=compress, chunk_size=chunk_size,
+                           timestamp=timestamp)
+        store.append(frame)
+        store.close()
+        return store
+
+    def _record_dtype(self):
+        return np.dtype([('f%d' % i, dtype)
+                         for i, dtype in enumerate(self.dtypes)])
+
+    @property
+    def servo_period(self):
+        return self.index['servo_period']
+
+    @property
+    def gather_period(self):
+        return self.index['gather_period']
+
+    @property
+    def timestamp(self):
+        return self.index['timestamp']
+
+    @property
+    def chunks(self):
+        return self.index['chunks']
+
+    @property
+    def samples(self):
+        return sum(chunk['samples'] for chunk in self.chunks)
+
+    def __len__(self):
+        return self.samples
+
+    def __repr__(self):
+        return ('<GatherStore %s samples=%d chunks=%d addresses=%s>' %
+                (self.path, self.samples, len(self.chunks), self.addresses))
+
+    def _time_column(self):
+        address = self.index.get('time_address')
+        if address is not None and address in self._lookup:
+            return self._lookup.index(address)
+        return None
+
+    def _column_fn(self, chunk_num, col):
+        ext = '.npy.z' if self.index['compress'] else '.npy'
+        return os.path.join(self.path, 'c%06d_%d%s' % (chunk_num, col, ext))
+
+    def append(self, data):
+        """
+        Append samples: a GatherFrame (or anything GatherFrame.from_array
+        accepts) with the store's addresses, in order
+
+        Samples are buffered until a full chunk is available; call `flush`
+        to write out a partial chunk.
+        """
+        frame = GatherFrame.from_array(self.addresses, data)
+        if len(frame.addresses) != len(self.addresses):
+            raise ValueError('Address count mismatch')
+
+        if not self.chunks and not self._pending:
+            # Column types follow the first data appended
+            self.dtypes = frame.dtypes
+            self.index['dtypes'] = [dtype.str for dtype in self.dtypes]
+
+        if len(frame):
+            self._pending.append(frame.to_records(self._record_dtype()))
+            self._pending_samples += len(frame)
+
+        chunk_size = self.index['chunk_size']
+        if self._pending_samples >= chunk_size:
+            pending = np.concatenate(self._pending)
+            full = (len(pending) // chunk_size) * chunk_size
+            for i in range(0, full, chunk_size):
+                self._write_chunk(pending[i:i + chunk_size])
+
+            self._pending = [pending[full:]] if full < len(pending) else []
+            self._pending_samples = len(pending) - full
+            _write_index(self.path, self.index)
+
+    def flush(self):
+        """
+        Write out any buffered samples as a (possibly short) chunk
+        """
+        if self._pending_samples:
+            self._write_chunk(np.concatenate(self._pending))
+            self._pending = []
+            self._pending_samples = 0
+
+        _write_index(self.path, self.index)
+
+    close = flush
+
+    def _write_chunk(self, records):
+        chunk_num = len(self.chunks)
+        for col in range(len(self.addresses)):
+            column = np.ascontiguousarray(records['f%d' % col])
+            fn = self._column_fn(chunk_num, col)
+            if self.index['compress']:
+                with open(fn, 'wb') as f:
+                    f.write(zlib.compress(column.tobytes()))
+            else:
+                np.save(fn, column)
+
+        time_col = self._time_column()
+        if time_col is not None and len(records):
+            times = records['f%d' % time_col]
+            t0, t1 = float(times[0]), float(times[-1])
+        else:
+            start = self.samples
+            period = (self.servo_period or 1.0) * self.gather_period
+            t0 = start * period
+            t1 = (start + len(records) - 1) * period
+
+        self.chunks.append({'samples': len(records),
+                            'start': t0,
+                            'stop': t1,
+                            })
+
+    def _read_column_chunk(self, chunk_num, col):
+        fn = self._column_fn(chunk_num, col)
+        if self.index['compress']:
+            with open(fn, 'rb') as f:
+                return np.frombuffer(zlib.decompress(f.read()),
+                                     dtype=self.dtypes[col])
+        return np.load(fn, mmap_mode='r')
+
+    def _select_chunks(self, start, stop):
+        for chunk_num, chunk in enumerate(self.chunks):
+            if start is not None and chunk['stop'] < start:
+                continue
+            if stop is not None and chunk['start'] >= stop:
+                continue
+            yield chunk_num, chunk
+
+    def _chunk_times(self, chunk_num):
+        time_col = self._time_column()
+        if time_col is not None:
+            return self._read_column_chunk(chunk_num, time_col)
+
+        chunk = self.chunks[chunk_num]
+        return np.linspace(chunk['start'], chunk['stop'], chunk['samples'])
+
+    def iter_chunks(self, columns=None, start=None, stop=None):
+        """
+        Lazily iterate over chunks overlapping a time window
+
+        columns: addresses (or indices) to read; defaults to all
+        start, stop: time window (start <= t < stop), in seconds
+
+        Yields: GatherFrame per chunk, trimmed to the window
+        """
+        if columns is None:
+            indices = list(range(len(self.addresses)))
+        else:
+            indices = [self._lookup.index(column) for column in columns]
+
+        addresses = [self.addresses[i] for i in indices]
+        time_address = self.index.get('time_address')
+        for chunk_num, chunk in self._select_chunks(start, stop):
+            if start is not None or stop is not None:
+                times = self._chunk_times(chunk_num)
+                i0 = (0 if start is None
+                      else np.searchsorted(times, start, 'left'))
+                i1 = (len(times) if stop is None
+                      else np.searchsorted(times, stop, 'left'))
+            else:
+                i0, i1 = 0, chunk['samples']
+
+            data = [self._read_column_chunk(chunk_num, col)[i0:i1]
+                    for col in indices]
+            yield GatherFrame.from_columns(addresses, data,
+                                           servo_period=self.servo_period,
+                                           gather_period=self.gather_period,
+                                           time_address=time_address)
+
+    def read(self, columns=None, start=None, stop=None):
+        """
+        Read a time window and/or subset of columns
+
+        columns: addresses (or indices) to read; defaults to all
+        start, stop: time window (start <= t < stop), in seconds
+
+        Returns: GatherFrame
+        """
+        frames = list(self.iter_chunks(columns, start, stop))
+        if columns is None:
+            addresses = list(self.addresses)
+        else:
+            addresses = [self.addresses[self._lookup.index(column)]
+                         for column in columns]
+
+        if frames:
+            data = [np.concatenate([frame.column(i) for frame in frames])
+                    for i in range(len(addresses))]
+        else:
+            data = [np.zeros(0, dtype=self.dtypes[self._lookup.index(address)])
+                    for address in addresses]
+
+        return GatherFrame(addresses, data, servo_period=self.servo_period,
+                           gather_period=self.gather_period,
+                           time_address=self.index.get('time_address'))
+
+    def read_column(self, address, start=None, stop=None):
+        """
+        Read a single column, optionally limited to a time window
+        """
+        return self.read([address], start, stop).column(0)
+
+
+def _write_index(path, index):
+    """
+    Write the index atomically (write to a temporary file, then rename)
+    """
+    fn = os.path.join(path, INDEX_FILE)
+    tmp_fn = fn + '.tmp'
+    with open(tmp_fn, 'wt') as f:
+        json.dump(index, f, indent=1)
+
+    if os.path.exists(fn) and os.name == 'nt':
+        os.unlink(fn)
+    os.rename(tmp_fn, fn)
+
+
+def save_gather(path, frame, compress=False, chunk_size=65536):
+    """
+    Save a GatherFrame to a new store
+    """
+    return GatherStore.from_frame(path, frame, compress=compress,
+                                  chunk_size=chunk_size)
+
+
+def load_gather(path, columns=None, start=None, stop=None):
+    """
+    Load a GatherFrame (or a time window/subset of columns) from a store
+    """
+    return GatherStore(path).read(columns, start, stop)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.gather_stream` -- Continuous streaming gather
+=========================================================
+
+.. module:: ppmac.gather_stream
+   :synopsis: Gather continuously, beyond the size of the controller's
+              gather buffer. The buffer is run as a ring (gather.enable=3)
+              and drained through the fast_gather server ("ring" request)
+              while gathering, producing an unbounded stream of sample
+              blocks which can be written to disk and/or passed to a
+              callback.
+
+              Sys.ServoCount is always gathered, and its continuity is
+              checked across and within blocks: any gap (samples lost to a
+              ring overrun, i.e. the buffer wrapping before it was drained)
+              is logged and recorded.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import json
+import time
+import logging
+import threading
+
+import numpy as np
+
+from . import gather as gather_mod
+from .fast_gather import GatherClient
+from .gather_frame import GatherFrame
+from .gather_store import GatherStore
+from .unwrap import (CounterUnwrapper, FrameUnwrapper)
+from .util import InsList
+
+
+logger = logging.getLogger(__name__)
+
+SERVO_COUNT_MODULUS = 2 ** 32
+
+
+class GatherOverrun(Exception):
+    pass
+
+
+class StreamWriter(object):
+    """
+    Append gathered blocks to a binary file of records, with a JSON header
+    file (fn + '.json') describing the addresses and record dtype
+
+    Read back with `read_stream_file`.
+    """
+
+    def __init__(self, fn, addresses, servo_period, gather_period):
+        self.fn = fn
+        self.addresses = list(addresses)
+        self.servo_period = servo_period
+        self.gather_period = gather_period
+        self.samples = 0
+        self._f = open(fn, 'wb')
+        self._dtype = None
+
+    def write(self, block):
+        if self._dtype is None:
+            self._dtype = block.to_records().dtype
+            self._write_header()
+
+        block.to_records(self._dtype).tofile(self._f)
+        self.samples += len(block)
+
+    def _write_header(self):
+        header = {'addresses': self.addresses,
+                  'dtype': self._dtype.descr,
+                  'servo_period': self.servo_period,
+                  'gather_period': self.gather_period,
+                  }
+        with open(self.fn + '.json', 'wt') as f:
+            json.dump(header, f)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+def read_stream_file(fn, mmap=False):
+    """
+    Read a file written by `StreamWriter`
+
+    Returns: GatherFrame
+    """
+    with open(fn + '.json', 'rt') as f:
+        header = json.load(f)
+
+    dtype = np.dtype([tuple(field) for field in header['dtype']])
+    if mmap:
+        data = np.memmap(fn, dtype=dtype, mode='r')
+    else:
+        data = np.fromfile(fn, dtype=dtype)
+
+    return GatherFrame(header['addresses'], data,
+                       servo_period=header['servo_period'],
+                       gather_period=header['gather_period'])
+
+
+class GatherStream(object):
+    """
+    Continuous gather, draining the controller's gather buffer as a ring
+
+    >> stream = GatherStream(comm, ['Motor[1].ActPos.a'],
+                             output_file='scan.bin')
+    >> stream.run(duration=60.0)
+    >> stream.gaps
+    []
+
+    comm: PPComm instance, with the fast_gather server available
+    addresses: addresses to gather (Sys.ServoCount.a is added)
+    period: gather period, in servo cycles
+    ring_size: ring size in samples (defaults to gather.maxlines)
+    callback: called with each block, as a GatherFrame
+    output_file: blocks are appended to this file (see `StreamWriter`)
+    store: path of a new gather store (see `gather_store.GatherStore`) to
+           append blocks to
+    poll_period: time between drains
+    raise_overrun: raise GatherOverrun on the first gap instead of
+                   recording it and continuing
+    counters: {address: bit width} of counter columns (e.g., encoder
+              ServoCapt) to unwrap continuously across blocks
+    """
+
+    def __init__(self, comm, addresses, period=1, ring_size=None,
+                 callback=None, output_file=None, poll_period=0.05,
+                 raise_overrun=False, store=None, counters=None):
+        if comm.fast_gather is None:
+            raise ValueError('Streaming gather requires the fast_gather '
+                             'server')
+
+        self.comm = comm
+        self.gpascii = comm.gpascii
+        self.client = comm.fast_gather
+
+        addresses = InsList(addresses)
+        if 'sys.servocount.a' in addresses:
+            addresses.remove(addresses[addresses.index('sys.servocount.a')])
+        addresses.insert(0, 'Sys.ServoCount.a')
+
+        self.addresses = list(addresses)
+        self.period = int(period)
+        self.ring_size = ring_size
+        self.callback = callback
+        self.output_file = output_file
+        self.store_path = store
+        self.poll_period = poll_period
+        self.raise_overrun = raise_overrun
+
+        self.servo_period = None
+        self.types = None
+        self.samples = 0
+        self.blocks = 0
+        self.gaps = []
+        self.max_fill = 0.0
+
+        self._index = 0
+        self._last_count = None
+        self._start_count = 0
+        self._unwrapper = CounterUnwrapper(bits=32)
+        if counters:
+            self._counters = FrameUnwrapper(counters, defaults=False)
+        else:
+            self._counters = None
+        self._writer = None
+        self._store = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def lost_samples(self):
+        return sum(missing for position, missing in self.gaps)
+
+    def setup(self):
+        """
+        Configure the gather as a ring and start gathering
+        """
+        gpascii = self.gpascii
+        self.servo_period = gpascii.servo_period
+
+        # The ring size is limited by gather.maxlines
+        config = gather_mod.get_gather_config(gpascii)
+        self.ring_size = config.configure(self.addresses, self.period,
+                                          samples=self.ring_size)
+
+        self.client.set_servo_mode()
+        self.types = self.client.query_types()
+
+        if self.output_file is not None:
+            self._writer = StreamWriter(self.output_file, self.addresses,
+                                        self.servo_period, self.period)
+
+        if self.store_path is not None:
+            self._store = GatherStore.create(self.store_path, self.addresses,
+                                             dtypes=None,
+                                             servo_period=self.servo_period,
+                                             gather_period=self.period)
+
+        # Samples gathered before this count are left over from a previous
+        # gather, and are discarded on the first drain
+        self._index = 0
+        self._last_count = None
+        self._unwrapper.reset()
+        if self._counters is not None:
+            self._counters.reset()
+        self._start_count = gpascii.get_variable('Sys.ServoCount', type_=int)
+        gpascii.set_variable('gather.enable', 3, check=False)
+
+    def _check_continuity(self, counts):
+        """
+        Check that servo counts increment by the gather period, recording
+        any gaps
+
+        Returns: number of samples lost
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        if self._last_count is not None:
+            counts = np.concatenate(([self._last_count], counts))
+            offset = self.samples - 1
+        else:
+            offset = self.samples
+
+        if len(counts) < 2:
+            return 0
+
+        deltas = np.diff(counts) % SERVO_COUNT_MODULUS
+        bad = np.nonzero(deltas != self.period)[0]
+        lost = 0
+        for i in bad:
+            missing = int(deltas[i] // self.period) - 1
+            position = offset + int(i) + 1
+            self.gaps.append((position, missing))
+            lost += missing
+            logger.warning('Gather overrun: %d samples lost at sample %d '
+                           '(servo count %d -> %d)', missing, position,
+                           counts[i], counts[i + 1])
+
+        if lost and self.raise_overrun:
+            raise GatherOverrun('%d samples lost at sample %d' %
+                                (lost, self.gaps[-1][0]))
+        return lost
+
+    def drain(self):
+        """
+        Read all samples gathered since the last drain
+
+        Returns: GatherFrame block (or None if no new samples)
+        """
+        index, wrap, lines, raw = self.client.query_ring_data(self._index)
+        self._index = index
+        if lines == 0:
+            return None
+
+        self.max_fill = max(self.max_fill, float(lines) / wrap)
+
+        columns = GatherClient._parse_columns(self.types, raw)
+        counts = columns[0].astype(np.int64)
+        if self._last_count is None:
+            elapsed = (counts - self._start_count) % SERVO_COUNT_MODULUS
+            valid = elapsed < (SERVO_COUNT_MODULUS // 2)
+            if not valid.all():
+                counts = counts[valid]
+                columns = [np.asarray(column)[valid] for column in columns]
+                if not len(counts):
+                    return None
+
+        self._check_continuity(counts)
+        self._last_count = counts[-1]
+
+        # Times keep increasing across servo count rollovers
+        columns[0] = self._unwrapper(counts) * self.servo_period
+        block = GatherFrame.from_columns(self.addresses, columns,
+                                         servo_period=self.servo_period,
+                                         gather_period=self.period)
+        if self._counters is not None:
+            block = self._counters(block)
+
+        self.samples += len(block)
+        self.blocks += 1
+
+        if self._writer is not None:
+            self._writer.write(block)
+
+        if self._store is not None:
+            self._store.append(block)
+
+        if self.callback is not None:
+            self.callback(block)
+
+        return block
+
+    def stop_gather(self):
+        """
+        Stop gathering, draining the remaining samples
+        """
+        self.gpascii.set_variable('gather.enable', 0, check=False)
+        try:
+            self.drain()
+        finally:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+
+    def iter_blocks(self, duration=None):
+        """
+        Generator yielding blocks of samples as they are gathered
+
+        Gathering stops when the generator is closed, after `duration`
+        seconds or when `stop` is called.
+        """
+        self._stop_event.clear()
+        self.setup()
+        t0 = time.time()
+        try:
+            while not self._stop_event.is_set():
+                if duration is not None and (time.time() - t0) >= duration:
+                    break
+
+                block = self.drain()
+                if block is not None:
+                    yield block
+
+                self._stop_event.wait(self.poll_period)
+        finally:
+            self.stop_gather()
+
+    def run(self, duration=None):
+        """
+        Gather for `duration` seconds (or until stopped or interrupted)
+
+        Returns: statistics dictionary
+        """
+        try:
+            for block in self.iter_blocks(duration=duration):
+                pass
+        except KeyboardInterrupt:
+            pass
+
+        return self.stats
+
+    def start(self, duration=None):
+        """
+        Gather in a background thread
+        """
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self.run, args=(duration, ))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def stats(self):
+        return {'samples': self.samples,
+                'blocks': self.blocks,
+                'gaps': len(self.gaps),
+                'lost_samples': self.lost_samples,
+                'max_fill': self.max_fill,
+                'ring_size': self.ring_size,
+                }
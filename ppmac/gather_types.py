@@ -61,3 +61,15 @@ GATHER_TYPES = {
     UBITS: (4, 'I', None),
     SBITS: (4, 'I', None),
 }
+
+NUMPY_TYPES = {
+    # type index : (big-endian numpy dtype, vectorized conversion function)
+    UINT32: ('>u4', None),
+    INT32: ('>i4', None),
+    UINT24: ('>u4', None),
+    INT24: ('>i4', lambda values: ((values & 0xFFFFFF) ^ 0x800000) - 0x800000),
+    FLOAT: ('>f4', None),
+    DOUBLE: ('>f8', None),
+    UBITS: ('>u4', None),
+    SBITS: ('>u4', None),
+}
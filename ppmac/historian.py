@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.historian` -- Low-rate variable historian
+=====================================================
+
+.. module:: ppmac.historian
+   :synopsis: Log a set of variables at fixed rates (one polling group per
+              rate) to a local, rotating, compressed columnar store.
+
+              Each group is buffered in memory and written out as a
+              segment (a compressed .npz file) every `segment_duration`
+              seconds. Sample times are delta-encoded, and each variable
+              only stores the samples at which its value changed. Old
+              segments are removed once `max_segments` per group exist.
+
+              `Historian.query` returns numpy arrays for a time window,
+              reading the segments that overlap it plus the data not yet
+              written out.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import os
+import re
+import glob
+import time
+import logging
+import threading
+
+import numpy as np
+
+from . import config
+
+
+logger = logging.getLogger(__name__)
+
+# Sample times are stored as microsecond deltas
+TIME_SCALE = 1e6
+SEGMENT_RE = re.compile(r'^(?P<group>.+)_(?P<start>\d+)_(?P<end>\d+)\.npz$')
+
+
+def encode_times(times):
+    """
+    Delta-encode sample times (in seconds)
+
+    Returns: (start time in microseconds, int64 array of deltas)
+    """
+    ticks = np.round(np.asarray(times, dtype=float) * TIME_SCALE)
+    ticks = ticks.astype(np.int64)
+    if not len(ticks):
+        return 0, ticks
+
+    return ticks[0], np.diff(ticks)
+
+
+def decode_times(start, deltas):
+    ticks = np.empty(len(deltas) + 1, dtype=np.int64)
+    ticks[0] = start
+    np.cumsum(deltas, out=ticks[1:])
+    ticks[1:] += start
+    return ticks / TIME_SCALE
+
+
+def encode_changes(values):
+    """
+    Change-only encoding of a column of samples
+
+    Returns: (indices at which the value changed, values at those indices)
+    The first sample is always included.
+    """
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return np.zeros(0, dtype=np.uint32), values
+
+    # NaN (failed reads) compare unequal to themselves; treat NaN->NaN as
+    # unchanged
+    changed = np.ones(len(values), dtype=bool)
+    prev, cur = values[:-1], values[1:]
+    changed[1:] = ~((prev == cur) | (np.isnan(prev) & np.isnan(cur)))
+    indices = np.nonzero(changed)[0].astype(np.uint32)
+    return indices, values[indices]
+
+
+def decode_changes(indices, values, count):
+    """
+    Expand change-only data back into `count` samples (sample-and-hold)
+    """
+    if not len(indices):
+        return np.full(count, np.nan)
+
+    which = np.searchsorted(indices, np.arange(count), side='right') - 1
+    return np.asarray(values)[which]
+
+
+class HistorianGroup(object):
+    """
+    Variables polled at a single rate
+    """
+
+    def __init__(self, name, variables, period):
+        self.name = name
+        self.variables = list(variables)
+        self.period = float(period)
+        self.next_time = 0.0
+        self._times = []
+        self._rows = []
+        self.lock = threading.Lock()
+
+    def add_sample(self, t, values):
+        with self.lock:
+            self._times.append(t)
+            self._rows.append(values)
+
+    def take(self):
+        """
+        Take all buffered samples
+
+        Returns: (times, 2D array of samples x variables)
+        """
+        with self.lock:
+            times, rows = self._times, self._rows
+            self._times, self._rows = [], []
+
+        return (np.array(times, dtype=float),
+                np.array(rows, dtype=float).reshape(-1, len(self.variables)))
+
+    def peek(self):
+        with self.lock:
+            times, rows = list(self._times), list(self._rows)
+
+        return (np.array(times, dtype=float),
+                np.array(rows, dtype=float).reshape(-1, len(self.variables)))
+
+
+def write_segment(fn, variables, times, data):
+    """
+    Write a segment of samples (times, samples x variables) to a compressed
+    .npz file
+    """
+    start, deltas = encode_times(times)
+    arrays = {'variables': np.array(variables),
+              'start': np.int64(start),
+              'deltas': deltas,
+              }
+
+    for i in range(len(variables)):
+        indices, values = encode_changes(data[:, i])
+        arrays['idx%d' % i] = indices
+        arrays['val%d' % i] = values
+
+    np.savez_compressed(fn, **arrays)
+
+
+def read_segment(fn, variables=None):
+    """
+    Read a segment written by `write_segment`
+
+    Returns: (times, {variable: values})
+    """
+    with np.load(fn) as npz:
+        stored = [str(var) for var in npz['variables']]
+        times = decode_times(int(npz['start']), npz['deltas'])
+        if variables is None:
+            variables = stored
+
+        lower = [var.lower() for var in stored]
+        columns = {}
+        for var in variables:
+            try:
+                i = lower.index(var.lower())
+            except ValueError:
+                continue
+
+            columns[var] = decode_changes(npz['idx%d' % i], npz['val%d' % i],
+                                          len(times))
+
+    return times, columns
+
+
+class Historian(object):
+    """
+    Poll variables at fixed rates and log them to a rotating store
+
+    >> hist = Historian(comm.gpascii, {1.0: ['Motor[1].ActPos'],
+                                       10.0: ['Motor[1].Status[0]']})
+    >> hist.start()
+    >> times, values = hist.query('Motor[1].ActPos', time.time() - 3600)
+
+    groups: {period in seconds: [variables]}
+    path: directory for segment files
+    segment_duration: seconds of data per segment file
+    max_segments: number of segments kept per group (0 = unlimited)
+    """
+
+    def __init__(self, gpascii, groups, path=config.historian_path,
+                 segment_duration=3600.0, max_segments=24, timeout=2.0):
+        self.gpascii = gpascii
+        self.path = path
+        self.segment_duration = float(segment_duration)
+        self.max_segments = max_segments
+        self.timeout = timeout
+        self.groups = [HistorianGroup('rate%g' % period, variables, period)
+                       for period, variables in sorted(groups.items())]
+
+        self._segment_start = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @property
+    def variables(self):
+        return [var for group in self.groups for var in group.variables]
+
+    def _find_group(self, variable):
+        for group in self.groups:
+            for var in group.variables:
+                if var.lower() == variable.lower():
+                    return group
+
+        raise KeyError('Variable not logged: %s' % variable)
+
+    def poll(self, group, t=None):
+        """
+        Read one sample of a group's variables
+
+        Failed reads are recorded as NaN
+        """
+        if t is None:
+            t = time.time()
+
+        values = self.gpascii.get_variables_batch(group.variables,
+                                                  type_=float,
+                                                  timeout=self.timeout,
+                                                  raise_errors=False)
+        values = [value if isinstance(value, float) else np.nan
+                  for value in values]
+        group.add_sample(t, values)
+
+    def _segments(self, group):
+        """
+        Segment files of a group, sorted by start time
+
+        Returns: list of (start, end, filename)
+        """
+        pattern = os.path.join(self.path, '%s_*.npz' % group.name)
+        segments = []
+        for fn in glob.glob(pattern):
+            m = SEGMENT_RE.match(os.path.basename(fn))
+            if m is None or m.group('group') != group.name:
+                continue
+
+            segments.append((int(m.group('start')) / TIME_SCALE,
+                             int(m.group('end')) / TIME_SCALE, fn))
+
+        return sorted(segments)
+
+    def flush(self):
+        """
+        Write buffered samples of all groups out as new segments, and remove
+        the oldest segments beyond max_segments
+        """
+        for group in self.groups:
+            times, data = group.take()
+            if not len(times):
+                continue
+
+            fn = os.path.join(self.path, '%s_%d_%d.npz' %
+                              (group.name, times[0] * TIME_SCALE,
+                               times[-1] * TIME_SCALE))
+            write_segment(fn, group.variables, times, data)
+            logger.debug('Wrote segment %s (%d samples)', fn, len(times))
+
+            if self.max_segments:
+                segments = self._segments(group)
+                for start, end, old_fn in segments[:-self.max_segments]:
+                    logger.debug('Removing old segment %s', old_fn)
+                    os.unlink(old_fn)
+
+        self._segment_start = time.time()
+
+    def _run(self):
+        self._segment_start = time.time()
+        for group in self.groups:
+            group.next_time = self._segment_start
+
+        while not self._stop_event.is_set():
+            now = time.time()
+            for group in self.groups:
+                if now >= group.next_time:
+                    try:
+                        self.poll(group, now)
+                    except Exception as ex:
+                        logger.error('Historian poll failed', exc_info=ex)
+
+                    group.next_time += group.period
+
+                    # Skip slots missed by an overrun, keeping the schedule
+                    missed = time.time() - group.next_time
+                    if missed >= 0.0:
+                        skipped = int(missed // group.period) + 1
+                        logger.debug('Historian group %s overran; skipping '
+                                     '%d poll(s)', group.name, skipped)
+                        group.next_time += skipped * group.period
+
+            if (time.time() - self._segment_start) >= self.segment_duration:
+                self.flush()
+
+            next_time = min(group.next_time for group in self.groups)
+            self._stop_event.wait(max(next_time - time.time(), 0.0))
+
+        self.flush()
+
+    def start(self):
+        """
+        Start polling in a background thread
+        """
+        if self._thread is not None:
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop polling, writing out any buffered samples
+        """
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def query(self, variable, t_start=None, t_end=None):
+        """
+        Logged values of a variable in a time window
+
+        t_start, t_end: time.time()-style timestamps (None = unbounded)
+
+        Returns: (times, values) numpy arrays
+        """
+        group = self._find_group(variable)
+        if t_start is None:
+            t_start = -np.inf
+        if t_end is None:
+            t_end = np.inf
+
+        all_times, all_values = [], []
+        for start, end, fn in self._segments(group):
+            if end < t_start or start > t_end:
+                continue
+
+            times, columns = read_segment(fn, [variable])
+            all_times.append(times)
+            all_values.append(columns[variable])
+
+        times, data = group.peek()
+        if len(times):
+            all_times.append(times)
+            all_values.append(data[:, self._column(group, variable)])
+
+        if not all_times:
+            return np.zeros(0), np.zeros(0)
+
+        times = np.concatenate(all_times)
+        values = np.concatenate(all_values)
+        mask = (times >= t_start) & (times <= t_end)
+        return times[mask], values[mask]
+
+    def query_many(self, variables, t_start=None, t_end=None):
+        """
+        Query several variables
+
+        Returns: {variable: (times, values)}
+        """
+        return dict((var, self.query(var, t_start, t_end))
+                    for var in variables)
+
+    def _column(self, group, variable):
+        lower = [var.lower() for var in group.variables]
+        return lower.index(variable.lower())
+
+
+def main():
+    import argparse
+    from .pp_comm import PPComm
+
+    parser = argparse.ArgumentParser(description='Power PMAC variable '
+                                     'historian')
+    parser.add_argument('variables', nargs='+',
+                        help='Variables to log, optionally with a period in '
+                             'seconds (e.g., Motor[1].ActPos@0.5)')
+    parser.add_argument('--host', default=config.hostname)
+    parser.add_argument('--path', default=config.historian_path)
+    parser.add_argument('--period', type=float, default=1.0,
+                        help='Default period (seconds)')
+    parser.add_argument('--segment', type=float, default=3600.0,
+                        help='Segment duration (seconds)')
+    parser.add_argument('--keep', type=int, default=24,
+                        help='Segments kept per group')
+    args = parser.parse_args()
+
+    groups = {}
+    for var in args.variables:
+        if '@' in var:
+            var, period = var.rsplit('@', 1)
+            period = float(period)
+        else:
+            period = args.period
+        groups.setdefault(period, []).append(var)
+
+    comm = PPComm(host=args.host)
+    hist = Historian(comm.gpascii, groups, path=args.path,
+                     segment_duration=args.segment, max_segments=args.keep)
+    hist.start()
+    print('Logging %d variables to %s (Ctrl-C to stop)' %
+          (len(hist.variables), args.path))
+    try:
+        while True:
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        hist.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.interp_table` -- Interpolated table files
+=====================================================
+
+.. module:: ppmac.interp_table
+   :synopsis: Gathered data resampled onto a regular time grid and stored in
+              big-endian binary tables, as used by misc/dac_read.
+
+              Version 1 ('INT' magic) holds a single 32-bit integer channel:
+
+                  uint32 magic, uint32 points, uint32 point_time (usec)
+                  points * int32/uint32
+
+              Version 2 ('INT2' magic) holds several channels, each with its
+              own type (signed/unsigned integer or float) and scale factor:
+
+                  uint32 magic, uint32 version, uint32 points,
+                  uint32 point_time (usec), uint32 channels
+                  per channel: char[4] type code (e.g. 'i4', 'f8'),
+                               float64 scale, char[32] name
+                  (padding to a 16-byte boundary)
+                  per channel: points * value (channel-major)
+
+              Version 2 stores the data multiplied by the channel scale
+              (rounded and clipped for integer types); version 1 values are
+              truncated, as they always were. Tables are read by memory
+              mapping and written in chunks, so neither requires the whole
+              interpolated table in memory.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import struct
+import logging
+
+import numpy as np
+import six
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC_V1 = (ord('I') << 16) + (ord('N') << 8) + ord('T')
+MAGIC_V2 = (MAGIC_V1 << 8) + ord('2')
+
+HEADER_V1 = struct.Struct('>III')
+HEADER_V2 = struct.Struct('>IIIII')
+CHANNEL_V2 = struct.Struct('>4sd32s')
+ALIGNMENT = 16
+
+CHUNK_POINTS = 65536
+
+# Type codes accepted for version 1 (struct format characters, as in the
+# original save_interp)
+V1_FORMATS = {'I': '>u4', 'i': '>i4'}
+
+
+def _type_code(dtype):
+    """
+    Type code for a channel dtype, e.g. 'i4' for int32
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'iuf':
+        raise ValueError('Unsupported channel type: %s' % dtype)
+    return '%s%d' % (dtype.kind, dtype.itemsize)
+
+
+def _big_endian(dtype):
+    return np.dtype(dtype).newbyteorder('>')
+
+
+def grid_points(start, stop, point_time):
+    """
+    Number of points on the grid start, start + step, ... < stop
+    (point_time in usec)
+    """
+    step = 1e-6 * point_time
+    if stop <= start:
+        return 0
+    return int(np.ceil((stop - start) / step))
+
+
+def iter_interpolated(x, y, point_time, chunk_points=CHUNK_POINTS):
+    """
+    Resample y(x) onto a regular grid (point_time in usec) in chunks
+
+    Yields: arrays of up to chunk_points values
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    step = 1e-6 * point_time
+    points = grid_points(x[0], x[-1], point_time)
+    for i in range(0, points, chunk_points):
+        n = min(chunk_points, points - i)
+        grid = x[0] + step * np.arange(i, i + n)
+        yield np.interp(grid, x, y)
+
+
+def _store(values, dtype, scale):
+    """
+    Scale values and convert them to the (big-endian) storage dtype
+    """
+    values = values * scale
+    if dtype.kind in 'iu':
+        info = np.iinfo(dtype)
+        values = np.clip(np.round(values), info.min, info.max)
+    return values.astype(dtype)
+
+
+def write_table_v1(fn, x, y, point_time=1000, format_='I',
+                   chunk_points=CHUNK_POINTS):
+    """
+    Write a single-channel version 1 table (readable by misc/dac_read)
+    """
+    point_time = int(point_time)
+    dtype = np.dtype(V1_FORMATS[format_])
+    points = grid_points(x[0], x[-1], point_time)
+    with open(fn, 'wb') as f:
+        f.write(HEADER_V1.pack(MAGIC_V1, points, point_time))
+        for chunk in iter_interpolated(x, y, point_time, chunk_points):
+            # Plain conversion (truncation), as in the original save_interp,
+            # so that the same data gives the same file
+            chunk.astype(dtype).tofile(f)
+
+
+def write_table(fn, x, columns, point_time=1000, dtypes='f8', scales=1.0,
+                names=None, chunk_points=CHUNK_POINTS):
+    """
+    Write a version 2 table
+
+    x: sample times (seconds)
+    columns: list of channel data, sampled at x
+    dtypes: storage type per channel (or one for all), e.g. 'i4' or 'f8'
+    scales: scale factor per channel (or one for all)
+    names: channel names (at most 32 characters)
+    """
+    point_time = int(point_time)
+    n_channels = len(columns)
+    if isinstance(dtypes, (six.string_types, type, np.dtype)):
+        dtypes = [dtypes] * n_channels
+    if np.isscalar(scales):
+        scales = [scales] * n_channels
+    if names is None:
+        names = ['channel%d' % i for i in range(n_channels)]
+
+    dtypes = [_big_endian(dtype) for dtype in dtypes]
+    points = grid_points(x[0], x[-1], point_time)
+
+    header = [HEADER_V2.pack(MAGIC_V2, 2, points, point_time, n_channels)]
+    for dtype, scale, name in zip(dtypes, scales, names):
+        header.append(CHANNEL_V2.pack(_type_code(dtype).encode('ascii'),
+                                      float(scale),
+                                      name[:32].encode('ascii')))
+
+    header = b''.join(header)
+    header += b'\0' * (-len(header) % ALIGNMENT)
+
+    with open(fn, 'wb') as f:
+        f.write(header)
+        for column, dtype, scale in zip(columns, dtypes, scales):
+            for chunk in iter_interpolated(x, column, point_time,
+                                           chunk_points):
+                _store(chunk, dtype, scale).tofile(f)
+
+
+class InterpTable(object):
+    """
+    Memory-mapped interpolated table (version 1 or 2)
+
+    >> table = InterpTable('table.int')
+    >> table.channel(0)            # scaled values
+    >> table.channel(0, raw=True)  # stored values (memory mapped)
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, 'rb') as f:
+            header = f.read(HEADER_V2.size)
+            magic, = struct.unpack('>I', header[:4])
+            if magic == MAGIC_V1:
+                self._read_v1(header)
+            elif magic == MAGIC_V2:
+                self._read_v2(f, header)
+            else:
+                raise RuntimeError('Invalid file (magic=%x should be=%x or '
+                                   '%x)' % (magic, MAGIC_V1, MAGIC_V2))
+
+    def _read_v1(self, header, format_='I'):
+        magic, self.points, self.point_time = HEADER_V1.unpack(
+            header[:HEADER_V1.size])
+        self.version = 1
+        self.names = ['channel0']
+        self.dtypes = [np.dtype(V1_FORMATS[format_])]
+        self.scales = [1.0]
+        self.offsets = [HEADER_V1.size]
+
+    def _read_v2(self, f, header):
+        (magic, self.version, self.points, self.point_time,
+         n_channels) = HEADER_V2.unpack(header)
+
+        self.names, self.dtypes, self.scales = [], [], []
+        for i in range(n_channels):
+            code, scale, name = CHANNEL_V2.unpack(f.read(CHANNEL_V2.size))
+            code = code.rstrip(b'\0').decode('ascii')
+            self.dtypes.append(np.dtype('>' + code))
+            self.scales.append(scale)
+            self.names.append(name.rstrip(b'\0').decode('ascii'))
+
+        offset = HEADER_V2.size + n_channels * CHANNEL_V2.size
+        offset += -offset % ALIGNMENT
+        self.offsets = []
+        for dtype in self.dtypes:
+            self.offsets.append(offset)
+            offset += dtype.itemsize * self.points
+
+    @property
+    def channels(self):
+        return len(self.names)
+
+    @property
+    def times(self):
+        return 1e-6 * self.point_time * np.arange(self.points)
+
+    def _index(self, channel):
+        if isinstance(channel, six.string_types):
+            return self.names.index(channel)
+        return channel
+
+    def channel(self, channel, raw=False):
+        """
+        Values of a channel (by index or name)
+
+        raw: return the stored (memory-mapped) values, without applying the
+             scale factor
+        """
+        i = self._index(channel)
+        if self.points == 0:
+            data = np.zeros(0, dtype=self.dtypes[i])
+        else:
+            data = np.memmap(self.fn, dtype=self.dtypes[i], mode='r',
+                             offset=self.offsets[i], shape=(self.points, ))
+
+        if raw:
+            return data
+        elif self.scales[i] == 1.0:
+            return np.asarray(data)
+        return data / self.scales[i]
+
+    def __repr__(self):
+        return ('<InterpTable %s v%d points=%d point_time=%dus channels=%s>' %
+                (self.fn, self.version, self.points, self.point_time,
+                 self.names))
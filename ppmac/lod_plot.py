@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.lod_plot` -- Level-of-detail plotting
+=================================================
+
+.. module:: ppmac.lod_plot
+   :synopsis: Plot long gathers without handing every sample to matplotlib.
+              The visible x-range of each line is reduced to a min/max
+              envelope with (at most) one bin per horizontal pixel, which
+              is recomputed whenever the axes are zoomed or panned. Every
+              peak in the data is kept in the envelope, and redraws cost
+              about the same regardless of the number of samples.
+
+              A min/max pyramid (halving the sample count at each level) is
+              built once per line, so each update only reduces a few
+              thousand pre-aggregated values. Short lines are plotted as
+              usual.
+
+              >> lod_plot.plot(ax, times, values, 'b', label='ActPos')
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# Lines with fewer samples than this are plotted in full
+MIN_SAMPLES = 10000
+# Smallest pyramid level kept
+MIN_LEVEL_SIZE = 1024
+
+
+class MinMaxPyramid(object):
+    """
+    Min/max envelope of a series at successive halvings of its resolution
+
+    Level k holds the min and max of blocks of 2 ** k samples.
+    """
+
+    def __init__(self, y):
+        y = np.asarray(y, dtype=float)
+        self.levels = [(y, y)]
+        mins, maxs = y, y
+        while len(mins) > MIN_LEVEL_SIZE:
+            if len(mins) % 2:
+                mins = np.append(mins, mins[-1])
+                maxs = np.append(maxs, maxs[-1])
+
+            mins = np.fmin(mins[0::2], mins[1::2])
+            maxs = np.fmax(maxs[0::2], maxs[1::2])
+            self.levels.append((mins, maxs))
+
+    def envelope(self, i0, i1, bins):
+        """
+        Min/max of each of `bins` bins over samples [i0, i1)
+
+        Returns: (bin start indices, bin end indices, mins, maxs)
+        """
+        per_bin = float(i1 - i0) / bins
+        level = int(np.clip(np.floor(np.log2(max(per_bin, 1.0))), 0,
+                            len(self.levels) - 1))
+        block = 2 ** level
+        mins, maxs = self.levels[level]
+
+        j0 = i0 // block
+        j1 = min(-(-i1 // block), len(mins))
+
+        edges = np.unique(np.linspace(j0, j1, bins + 1).astype(int))
+        starts = edges[:-1]
+        bin_mins = np.fmin.reduceat(mins[:j1], starts)
+        bin_maxs = np.fmax.reduceat(maxs[:j1], starts)
+
+        sample_starts = np.maximum(starts * block, i0)
+        sample_ends = np.minimum(edges[1:] * block, i1) - 1
+        return sample_starts, sample_ends, bin_mins, bin_maxs
+
+
+class LODLine(object):
+    """
+    A matplotlib line showing the min/max envelope of the visible data
+
+    x must be sorted (increasing).
+    """
+
+    def __init__(self, ax, x, y, *args, **kwargs):
+        self.ax = ax
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.pyramid = MinMaxPyramid(self.y)
+
+        xe, ye = self.envelope(self.x[0], self.x[-1])
+        self.line, = ax.plot(xe, ye, *args, **kwargs)
+        self._view = None
+
+        # Update the envelope just before drawing: xlim_changed callbacks
+        # are not called for twinned axes sharing the x-axis
+        line_draw = self.line.draw
+
+        def draw(renderer):
+            self.update()
+            return line_draw(renderer)
+
+        self.line.draw = draw
+
+    def _bins(self):
+        try:
+            return max(int(self.ax.bbox.width), 100)
+        except Exception:
+            return 1000
+
+    def envelope(self, x0, x1):
+        """
+        Envelope of the data between x0 and x1, as plottable (x, y)
+        """
+        x, y = self.x, self.y
+        # Include one sample on either side, so lines reach the edges
+        i0 = max(np.searchsorted(x, x0, 'left') - 1, 0)
+        i1 = min(np.searchsorted(x, x1, 'right') + 1, len(x))
+
+        bins = self._bins()
+        if (i1 - i0) <= 2 * bins:
+            return x[i0:i1], y[i0:i1]
+
+        starts, ends, mins, maxs = self.pyramid.envelope(i0, i1, bins)
+
+        xe = np.empty(2 * len(starts))
+        ye = np.empty(2 * len(starts))
+        xe[0::2] = x[starts]
+        xe[1::2] = x[ends]
+        ye[0::2] = mins
+        ye[1::2] = maxs
+        return xe, ye
+
+    def update(self):
+        """
+        Recompute the envelope if the visible range or axes size changed
+        """
+        x0, x1 = self.ax.get_xlim()
+        view = (min(x0, x1), max(x0, x1), self._bins())
+        if view == self._view:
+            return
+
+        self._view = view
+        xe, ye = self.envelope(view[0], view[1])
+        self.line.set_data(xe, ye)
+
+
+def _is_sorted(x):
+    return len(x) < 2 or bool(np.all(np.diff(x) >= 0))
+
+
+def plot(ax, x, y, *args, **kwargs):
+    """
+    Plot y(x) on `ax`, as with ax.plot, using a level-of-detail envelope
+    for long lines
+
+    min_samples: lines shorter than this are plotted in full
+
+    Returns: matplotlib Line2D
+    """
+    min_samples = kwargs.pop('min_samples', MIN_SAMPLES)
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if len(x) < min_samples or not _is_sorted(x):
+        line, = ax.plot(x, y, *args, **kwargs)
+        return line
+
+    lod = LODLine(ax, x, y, *args, **kwargs)
+    # Keep a reference on the line for the lifetime of the plot
+    lod.line._lod = lod
+    return lod.line
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.multi_gather` -- Synchronized multi-controller gather
+=================================================================
+
+.. module:: ppmac.multi_gather
+   :synopsis: Gather from several Power PMACs at once. All controllers are
+              configured, armed and read back in parallel (one thread per
+              controller), so the total setup and transfer time is roughly
+              that of a single controller.
+
+              Each controller is armed with a small PLC which starts its
+              gather either at a pre-computed Sys.ServoCount (the servo
+              count at a common host time, estimated by a
+              `timebase.ClockCorrelator` per controller) or when a trigger
+              variable becomes non-zero (e.g., set by a motion program or
+              mapped to a shared hardware input).
+
+              The gathered data is merged onto one time base: each
+              controller's times are converted to wall clock time using its
+              own clock correlation, correcting for per-controller clock
+              offset and drift.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import time
+import logging
+import threading
+
+import numpy as np
+
+from . import gather as gather_mod
+from . import pp_comm
+from .gather_frame import GatherFrame
+from .timebase import (ClockCorrelator, merge_timelines, SERVO_COUNT_MODULUS)
+from .util import InsList
+
+
+logger = logging.getLogger(__name__)
+
+TIME_ADDRESS = 'Time'
+
+ARM_PLC_SERVO_COUNT = '''open plc {plc}
+if (Sys.ServoCount >= {start_count}) {{
+    Gather.Enable = 2
+    disable plc {plc}
+}}
+close'''
+
+ARM_PLC_TRIGGER = '''open plc {plc}
+if ({variable} != 0) {{
+    Gather.Enable = 2
+    disable plc {plc}
+}}
+close'''
+
+
+def _parallel(fn, items):
+    """
+    Call fn(item) for each item in its own thread
+
+    Returns: list of results, in order. The first exception raised (if
+             any) is re-raised once all threads finish.
+    """
+    results = [None] * len(items)
+    errors = [None] * len(items)
+
+    def run(i, item):
+        try:
+            results[i] = fn(item)
+        except Exception as ex:
+            errors[i] = ex
+
+    threads = [threading.Thread(target=run, args=(i, item))
+               for i, item in enumerate(items)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    for ex in errors:
+        if ex is not None:
+            raise ex
+
+    return results
+
+
+class _Controller(object):
+    def __init__(self, name, comm, addresses):
+        self.name = name
+        self.comm = comm
+        self.gpascii = comm.gpascii
+
+        addresses = InsList(addresses)
+        if 'sys.servocount.a' not in addresses:
+            addresses.insert(0, 'Sys.ServoCount.a')
+
+        self.addresses = list(addresses)
+        self.correlator = None
+        self.servo_period = None
+        self.samples = None
+        self.start_count = None
+        self.frame = None
+
+    def __repr__(self):
+        return '<Controller %s>' % self.name
+
+
+class MultiGather(object):
+    """
+    Synchronized gather across controllers
+
+    >> mg = MultiGather({'pmac1': comm1, 'pmac2': comm2},
+                        {'pmac1': ['Motor[1].ActPos.a'],
+                         'pmac2': ['Motor[3].ActPos.a']}, plc=31)
+    >> frame = mg.run(duration=1.0)
+    >> frame['pmac2:Motor[3].ActPos']
+
+    comms: {name: PPComm}, or a list of PPComm instances (named by index)
+    addresses: {name: addresses} or a single list used for all controllers
+    period: gather period, in servo cycles
+    trigger_variable: if set, gathers start when this variable becomes
+                      non-zero on each controller, instead of at a common
+                      start time
+    plc: PLC number used to arm the gathers (required). Its program is
+         replaced on every controller, so it must not be one in use; arming
+         fails if it is running.
+    arm_delay: time from arming until the common start time, in seconds;
+               must cover the time to arm all controllers
+    """
+
+    def __init__(self, comms, addresses, period=1, trigger_variable=None,
+                 plc=None, arm_delay=0.5):
+        if plc is None:
+            raise ValueError('A PLC number for arming the gathers is '
+                             'required (its program will be replaced)')
+
+        if not hasattr(comms, 'items'):
+            comms = dict(('%d' % i, comm) for i, comm in enumerate(comms))
+
+        self.controllers = []
+        for name, comm in sorted(comms.items()):
+            if hasattr(addresses, 'items'):
+                ctrl_addresses = addresses.get(name, [])
+            else:
+                ctrl_addresses = addresses
+
+            if comm.fast_gather is None:
+                logger.warning('%s: fast_gather server unavailable; '
+                               'transfers will be slower', name)
+
+            self.controllers.append(_Controller(name, comm, ctrl_addresses))
+
+        self.period = int(period)
+        self.trigger_variable = trigger_variable
+        self.plc = int(plc)
+        self.arm_delay = arm_delay
+        self.start_time = None
+        self.timing = {}
+
+    @property
+    def names(self):
+        return [ctrl.name for ctrl in self.controllers]
+
+    def _timed(self, stage, fn):
+        t0 = time.time()
+        try:
+            return _parallel(fn, self.controllers)
+        finally:
+            self.timing[stage] = time.time() - t0
+
+    def setup(self, duration=0.1):
+        """
+        Configure all controllers and correlate their clocks, in parallel
+        """
+        period = self.period
+
+        def setup_one(ctrl):
+            gpascii = ctrl.gpascii
+            ctrl.servo_period = gpascii.servo_period
+            requested = gather_mod.get_sample_count(ctrl.servo_period,
+                                                    period, duration)
+
+            config = gather_mod.get_gather_config(gpascii)
+            ctrl.samples = config.configure(ctrl.addresses, period,
+                                            samples=requested)
+            if ctrl.samples < requested:
+                logger.warning('%s: gather buffer limited to %d samples',
+                               ctrl.name, ctrl.samples)
+
+            ctrl.correlator = ClockCorrelator(gpascii,
+                                              servo_period=ctrl.servo_period)
+            for i in range(8):
+                ctrl.correlator.sample()
+
+        self._timed('setup', setup_one)
+
+    def arm(self):
+        """
+        Arm all controllers, in parallel
+
+        With no trigger variable, the gathers start at the servo count
+        matching a common host time, `arm_delay` seconds from now.
+        """
+        if self.trigger_variable is None:
+            self.start_time = time.time() + self.arm_delay
+            for ctrl in self.controllers:
+                count = ctrl.correlator.wall_to_servo(self.start_time)
+                ctrl.start_count = int(count) % SERVO_COUNT_MODULUS
+
+        def arm_one(ctrl):
+            active = ctrl.gpascii.get_variable('Plc[%d].Active' % self.plc,
+                                               type_=int)
+            if active:
+                raise ValueError('%s: PLC %d is running; choose an unused '
+                                 'PLC' % (ctrl.name, self.plc))
+
+            if self.trigger_variable is None:
+                script = ARM_PLC_SERVO_COUNT.format(
+                    plc=self.plc, start_count=ctrl.start_count)
+            else:
+                script = ARM_PLC_TRIGGER.format(
+                    plc=self.plc, variable=self.trigger_variable)
+
+            lines = script.split('\n')
+            lines.append('enable plc %d' % self.plc)
+            ctrl.gpascii.send_lines(lines, sync=True)
+
+        self._timed('arm', arm_one)
+
+        if self.start_time is not None:
+            late = time.time() - self.start_time
+            if late > 0:
+                logger.warning('Arming took longer than arm_delay (%.3f s '
+                               'late); some gathers may start late', late)
+
+    def trigger(self):
+        """
+        Set the trigger variable on all controllers (software trigger)
+        """
+        if self.trigger_variable is None:
+            raise ValueError('No trigger variable configured')
+
+        def trigger_one(ctrl):
+            ctrl.gpascii.set_variable(self.trigger_variable, 1, check=False)
+
+        self._timed('trigger', trigger_one)
+
+    def wait(self, timeout=None, poll_period=0.1):
+        """
+        Wait for all gathers to complete
+
+        A gather is complete once the arming PLC has run (disabling itself
+        as it sets Gather.Enable=2) and the gather has then stopped or
+        filled. Gather.Samples alone may still hold the count of a previous
+        run, before the PLC starts the new gather.
+        """
+        t0 = time.time()
+        active_var = 'Plc[%d].Active' % self.plc
+
+        def wait_one(ctrl):
+            gpascii = ctrl.gpascii
+            while True:
+                active, enable, samples = gpascii.get_variables_batch(
+                    [active_var, 'gather.enable', 'gather.samples'],
+                    type_=int)
+                if not active and (enable < 2 or samples >= ctrl.samples):
+                    break
+
+                if timeout is not None and (time.time() - t0) > timeout:
+                    gpascii.send_lines(['disable plc %d' % self.plc,
+                                        'gather.enable=0'])
+                    if active:
+                        status = 'gather not started'
+                    else:
+                        status = 'gathered %d of %d samples' % (samples,
+                                                                ctrl.samples)
+                    raise pp_comm.TimeoutError('%s: %s' % (ctrl.name, status))
+
+                time.sleep(poll_period)
+
+            gpascii.set_variable('gather.enable', 0, check=False)
+
+        self._timed('wait', wait_one)
+
+    def download(self):
+        """
+        Read back all gathered data, in parallel
+
+        Returns: {name: GatherFrame}
+        """
+        def download_one(ctrl):
+            ctrl.frame = gather_mod.get_gather_results(ctrl.comm,
+                                                       ctrl.addresses)
+            return ctrl.frame
+
+        frames = self._timed('download', download_one)
+        return dict(zip(self.names, frames))
+
+    def wall_times(self, ctrl):
+        """
+        Wall clock time of each sample gathered by a controller
+        """
+        return ctrl.correlator.gather_to_wall(ctrl.frame.times)
+
+    def merge(self, reference=None):
+        """
+        Merge the gathered data of all controllers onto one time base
+
+        reference: name of the controller whose sample times are used as the
+                   time base (defaults to the first); other controllers'
+                   data is interpolated onto it
+
+        Returns: GatherFrame, with a 'Time' column (wall clock time, in
+                 seconds) and one column per controller address, named
+                 '<controller>:<address>'
+        """
+        if reference is None:
+            reference = self.controllers[0].name
+
+        series = {}
+        names = []
+        times = None
+        for ctrl in self.controllers:
+            wall = self.wall_times(ctrl)
+            if ctrl.name == reference:
+                times = wall
+
+            for i, addr in enumerate(ctrl.frame.addresses):
+                if addr.lower() == 'sys.servocount.a':
+                    continue
+
+                name = '%s:%s' % (ctrl.name, addr)
+                names.append(name)
+                series[name] = (wall, ctrl.frame.column(i))
+
+        if times is None:
+            raise ValueError('Unknown reference controller: %s' % reference)
+
+        times, merged = merge_timelines(series, times=times)
+        columns = [times] + [merged[name] for name in names]
+
+        ref = self.controllers[self.names.index(reference)]
+        return GatherFrame.from_columns([TIME_ADDRESS] + names, columns,
+                                        servo_period=ref.servo_period,
+                                        gather_period=self.period,
+                                        time_address=TIME_ADDRESS)
+
+    @property
+    def start_offsets(self):
+        """
+        Start time of each controller's gather relative to the reference
+        (first) controller, in seconds
+        """
+        starts = [(ctrl.name, self.wall_times(ctrl)[0])
+                  for ctrl in self.controllers
+                  if ctrl.frame is not None and len(ctrl.frame)]
+        if not starts:
+            return {}
+
+        t0 = starts[0][1]
+        return dict((name, start - t0) for name, start in starts)
+
+    def run(self, duration=0.1, timeout=None, reference=None):
+        """
+        Set up, arm, gather, download and merge
+
+        Returns: merged GatherFrame (see `merge`)
+        """
+        self.setup(duration)
+        self.arm()
+        if self.trigger_variable is not None:
+            self.trigger()
+
+        if timeout is None:
+            timeout = self.arm_delay + 2.0 * duration + 5.0
+
+        self.wait(timeout=timeout)
+        self.download()
+        return self.merge(reference=reference)
+
+
+def test():
+    from .pp_comm import PPComm
+    from . import config
+
+    hosts = config.hostname.split(',')
+    comms = dict((host, PPComm(host=host)) for host in hosts)
+    mg = MultiGather(comms, ['Motor[1].ActPos.a'], plc=31)
+    frame = mg.run(duration=0.5)
+    print(frame)
+    print('Start offsets: %s' % mg.start_offsets)
+    print('Timing: %s' % mg.timing)
+    print('Max time step: %g' % np.max(np.diff(frame.times)))
+
+
+if __name__ == '__main__':
+    test()
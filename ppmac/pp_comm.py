@@ -13,6 +13,8 @@
 
 from __future__ import print_function
 import re
+import contextlib
+import hashlib
 import sys
 import time
 import logging
@@ -35,6 +37,13 @@ except ImportError as ex:
     logger.warning('Unable to load the fast gather module', exc_info=ex)
 
 
+try:
+    from . import var_server as var_server_mod
+except ImportError as ex:
+    var_server_mod = None
+    logger.warning('Unable to load the variable server module', exc_info=ex)
+
+
 class PPCommError(Exception):
     pass
 
@@ -59,6 +68,87 @@ class ScriptCancelled(ScriptFailed):
     pass
 
 
+# The hash of the program last downloaded to each buffer (see `send_script`)
+# is recorded host-side, in PPComm.program_hashes, shared by all of the
+# channels of a connection. Optionally (PPComm program_hash_base, off by
+# default), the records are also kept on the controller, in
+# Sys.Udata[program_hash_base + program number], so that they are shared by
+# other connections and cleared when the controller is reset or
+# reinitialized. Only enable this with a range of Sys.Udata which the
+# controller project does not use; programs numbered PROGRAM_HASH_SLOTS and
+# above are then always downloaded.
+#
+# An `open prog` sent through a GpasciiChannel (including the broker) marks
+# the program as changed for that connection; outgoing lines are never
+# modified, so its controller record is only cleared by `send_script` or
+# PPComm.gpascii_file. Programs downloaded by other means (e.g., the IDE or
+# another gpascii session) are not detected; use force=True after such
+# downloads.
+PROGRAM_HASH_VARIABLE = 'Sys.Udata[%d]'
+PROGRAM_HASH_SLOTS = 512
+
+OPEN_PROG_RE = re.compile(r'^\s*open\s+prog\s*(\d+)', re.IGNORECASE)
+CLOSE_RE = re.compile(r'^\s*close\b', re.IGNORECASE)
+
+
+def program_hash(lines):
+    """
+    Hash of the (stripped, non-blank) lines of a program, as a positive
+    31-bit integer (to fit in a Sys.Udata element)
+    """
+    text = '\n'.join(line.strip() for line in lines if line.strip())
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    return (int(digest[:8], 16) & 0x7FFFFFFF) or 1
+
+
+def program_hash_variable(prog_num, base):
+    """
+    Controller variable holding the recorded hash of program `prog_num`, or
+    None if the records are kept host-side only (base is None) or the
+    program is outside of the range
+    """
+    if base is not None and 0 <= prog_num < PROGRAM_HASH_SLOTS:
+        return PROGRAM_HASH_VARIABLE % (base + prog_num)
+    return None
+
+
+def opened_programs(lines):
+    """
+    Numbers of the program buffers opened in script lines
+    """
+    return [int(m.group(1)) for m in (OPEN_PROG_RE.match(line)
+                                      for line in lines)
+            if m is not None]
+
+
+def split_programs(lines):
+    """
+    Split script lines into program buffer downloads and other lines
+
+    Returns: list of (program number or None, lines), in order. Program
+             entries run from `open prog` through the following `close`.
+    """
+    segments = []
+    prog = None
+    for line in lines:
+        m = OPEN_PROG_RE.match(line)
+        if prog is None and m is not None:
+            prog = int(m.group(1))
+            segments.append((prog, [line]))
+            continue
+
+        if prog is None:
+            if not segments or segments[-1][0] is not None:
+                segments.append((None, []))
+            segments[-1][1].append(line)
+        else:
+            segments[-1][1].append(line)
+            if CLOSE_RE.match(line):
+                prog = None
+
+    return segments
+
+
 PPMAC_MESSAGES = [re.compile('.*\/\/ \*\*\* exit'),
                   re.compile('^UnlinkGatherThread:.*'),
                   re.compile('^\/\/ \*\*\* EOF'),
@@ -122,16 +212,28 @@ def _wait_for(generator, wait_pattern,
 class ShellChannel(object):
     """
     An interactive SSH shell channel
+
+    Optionally, consecutive lines sent can be combined into larger writes
+    (see `set_coalescing`). Buffered lines are sent when the buffer reaches
+    `coalesce_size` bytes, `coalesce_delay` seconds after the first buffered
+    line, on `flush`, or before anything is read from the channel.
     """
 
     def __init__(self, comm, command=None, single=False,
-                 disable_readline=False, verbose=False):
+                 disable_readline=False, verbose=False,
+                 coalesce=False, coalesce_size=8192, coalesce_delay=0.05):
         self.lock = threading.RLock()
         self._comm = comm
         self._client = comm._client
         self._channel = comm._client.invoke_shell()
         self._verbose = verbose
 
+        self._send_buffer = []
+        self._send_buffer_size = 0
+        self._flush_timer = None
+        self.set_coalescing(coalesce, size=coalesce_size,
+                            delay=coalesce_delay)
+
         if disable_readline:
             self.send_line('/bin/bash --noediting')
 
@@ -194,6 +296,7 @@ class ShellChannel(object):
             raise PPCommChannelClosed()
 
         with self.lock:
+            self.flush()
             t0 = time.time()
             buf = ''
 
@@ -230,21 +333,151 @@ class ShellChannel(object):
             if not check_timeout():
                 raise TimeoutError('Elapsed %.2f s' % (time.time() - t0))
 
-    def send_line(self, line, delim='\n', sync=False):
+    def set_coalescing(self, enabled, size=None, delay=None):
         """
-        Send a single line of text (with a delimiter at the end)
+        Enable or disable combining of consecutive sent lines
+
+        size: flush once this many bytes are buffered
+        delay: flush this many seconds after the first line is buffered
+        """
+        with self.lock:
+            if not enabled:
+                self.flush()
+
+            self._coalesce = bool(enabled)
+            if size is not None:
+                self.coalesce_size = size
+            if delay is not None:
+                self.coalesce_delay = delay
+
+    @contextlib.contextmanager
+    def coalescing(self, size=None, delay=None):
+        """
+        Context manager which combines all lines sent in the block into as
+        few writes as possible, flushing on exit
+        """
+        with self.lock:
+            previous = (self._coalesce, self.coalesce_size,
+                        self.coalesce_delay)
+            self.set_coalescing(True, size=size, delay=delay)
+            try:
+                yield self
+            finally:
+                self.flush()
+                self.set_coalescing(*previous)
+
+    def flush(self):
+        """
+        Send any buffered lines
+        """
+        with self.lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+            if not self._send_buffer:
+                return
+
+            data = ''.join(self._send_buffer)
+            self._send_buffer = []
+            self._send_buffer_size = 0
+
+            channel = self._channel
+            if channel is None:
+                raise PPCommChannelClosed()
+
+            logger.debug('Flushing %d bytes', len(data))
+            channel.sendall(data)
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except PPCommChannelClosed:
+            pass
+
+    def _write(self, data):
+        """
+        Send data now, or buffer it if coalescing is enabled
         """
         channel = self._channel
         if channel is None:
             raise PPCommChannelClosed()
 
+        with self.lock:
+            if not self._coalesce:
+                channel.sendall(data)
+                return
+
+            self._send_buffer.append(data)
+            self._send_buffer_size += len(data)
+
+            if self._send_buffer_size >= self.coalesce_size:
+                self.flush()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.coalesce_delay,
+                                                    self._timed_flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def send_line(self, line, delim='\n', sync=False):
+        """
+        Send a single line of text (with a delimiter at the end)
+        """
         with self.lock:
             vlog(self._verbose, '-> %s' % line)
-            channel.send('%s%s' % (line, delim))
+            self._write('%s%s' % (line, delim))
 
         if sync:
             self.sync()
 
+    def send_lines(self, lines, delim='\n', sync=False):
+        """
+        Send several lines of text in a single write
+        """
+        lines = list(lines)
+        if not lines:
+            return
+
+        with self.lock:
+            for line in lines:
+                vlog(self._verbose, '-> %s' % line)
+            self._write(''.join('%s%s' % (line, delim) for line in lines))
+
+        if sync:
+            self.sync()
+
+
+def _parse_value(value, type_=str):
+    """
+    Typecast a gpascii value, converting hex ($ prefix) values to integers
+    """
+    if value.startswith('$'):
+        value = int(value[1:], 16)
+
+    return type_(value)
+
+
+def _value_matches(requested, actual, rel_tol=1e-6):
+    """
+    Compare a requested value against one read back from gpascii
+
+    Numeric values (including hex) are compared numerically, as gpascii
+    does not necessarily format them the same as they were written.
+    """
+    def to_number(value):
+        value = str(value).strip()
+        if value.startswith('$'):
+            return int(value[1:], 16)
+        return float(value)
+
+    try:
+        requested, actual = to_number(requested), to_number(actual)
+    except ValueError:
+        return str(requested).strip().lower() == str(actual).strip().lower()
+
+    return abs(requested - actual) <= rel_tol * max(abs(requested),
+                                                    abs(actual))
+
 
 class GpasciiChannel(ShellChannel):
     """
@@ -254,13 +487,15 @@ class GpasciiChannel(ShellChannel):
 
     CMD_GPASCII = 'gpascii -2 2>&1'
     EOT = '\04'
+    # Queried at the start and end of a batch to delimit its responses
+    BATCH_SENTINEL = 'sys.servocount'
 
-    def __init__(self, comm, command=None, verbose=False):
+    def __init__(self, comm, command=None, verbose=False, **kwargs):
         if command is None:
             command = self.CMD_GPASCII
 
         ShellChannel.__init__(self, comm, command=command,
-                              verbose=verbose)
+                              verbose=verbose, **kwargs)
 
         if not self.wait_for('.*(STDIN Open for ASCII Input)$'):
             raise ValueError('GPASCII startup string not found')
@@ -278,6 +513,30 @@ class GpasciiChannel(ShellChannel):
 
     __del__ = close
 
+    def _note_opened(self, lines):
+        """
+        Mark programs opened by outgoing lines as changed (see
+        `send_script`). The lines themselves are sent unmodified.
+        """
+        progs = opened_programs(lines)
+        if progs:
+            self._comm.program_hashes.update((prog, None) for prog in progs)
+
+    def send_line(self, line, delim='\n', sync=False):
+        """
+        Send a single line of text (with a delimiter at the end)
+        """
+        self._note_opened([line])
+        ShellChannel.send_line(self, line, delim=delim, sync=sync)
+
+    def send_lines(self, lines, delim='\n', sync=False):
+        """
+        Send several lines of text in a single write
+        """
+        lines = list(lines)
+        self._note_opened(lines)
+        ShellChannel.send_lines(self, lines, delim=delim, sync=sync)
+
     def set_variable(self, var, value, check=True):
         """
         Set a Power PMAC variable to value
@@ -347,6 +606,133 @@ class GpasciiChannel(ShellChannel):
 
         return ret
 
+    def get_variables_batch(self, variables, type_=str, timeout=2.0,
+                            raise_errors=True):
+        """
+        Get Power PMAC variables with a single pipelined request, typecasting
+        them to type_
+
+        All queries are sent at once, between queries of BATCH_SENTINEL
+        marking the start and end of the responses, which are matched to
+        the variables by position. Unlike `get_variables`, the
+        number of round trips does not depend on the number of variables.
+
+        If raise_errors is False, variables that could not be read have a
+        GPError instance in place of their value. Otherwise, the first error
+        is raised, including errors in output left over from earlier
+        commands (e.g., writes with `send_lines`), which are logged in
+        either case.
+
+        >> comm.get_variables_batch(['i100', 'i200'], type_=int)
+        [0, 1]
+        """
+        variables = [var.lower() for var in variables]
+        if not variables:
+            return []
+
+        values = [GPError('%s: no response' % var) for var in variables]
+        sentinel = self.BATCH_SENTINEL
+
+        # Each query is answered by one line, either a value or an error, in
+        # the order sent. Responses are matched by position only, as the
+        # names in replies may differ from the query (aliases, .a suffix).
+        # A leading sentinel separates them from any output left over from
+        # earlier commands; if the number of responses does not match, no
+        # value can be trusted.
+        started = False
+        earlier_errors = []
+        index = 0
+        with self.lock:
+            self.send_lines([sentinel] + variables + [sentinel])
+
+            for line in self.read_timeout(timeout=timeout):
+                if not started:
+                    if 'error' in line:
+                        logger.warning('Batch read: error from an earlier '
+                                       'command: %s', line)
+                        earlier_errors.append(GPError(line))
+                    elif line.lower().startswith(sentinel + '='):
+                        started = True
+                    elif line:
+                        logger.debug('Batch read: skipping earlier output: '
+                                     '%s', line)
+                    continue
+
+                error = ('error' in line)
+                if not error and '=' not in line:
+                    continue
+
+                vname = line.split('=', 1)[0].lower()
+                is_sentinel = (not error and vname == sentinel)
+                if index == len(variables) and is_sentinel:
+                    break
+
+                if (index >= len(variables) or
+                        (is_sentinel and variables[index] != sentinel)):
+                    logger.warning('Batch read: response count mismatch')
+                    values = [GPError('%s: response count mismatch' % var)
+                              for var in variables]
+                    break
+
+                if error:
+                    values[index] = GPError('%s: %s' % (variables[index],
+                                                        line))
+                    index += 1
+                    continue
+
+                value = line.split('=', 1)[1]
+                try:
+                    values[index] = _parse_value(value, type_)
+                except ValueError as ex:
+                    values[index] = GPError('%s: %s' % (variables[index],
+                                                        ex))
+                index += 1
+
+        if raise_errors:
+            for value in earlier_errors + values:
+                if isinstance(value, GPError):
+                    raise value
+
+        return values
+
+    def set_variables(self, mapping, verify=True, timeout=2.0):
+        """
+        Set several Power PMAC variables in a single write
+
+        mapping: a dictionary of {variable: value} or a sequence of
+                 (variable, value) pairs (to preserve the order)
+
+        If verify is set, all variables are read back in a single pipelined
+        request (see `get_variables_batch`).
+
+        Returns: a dictionary of mismatches {variable: (requested, actual)},
+                 where actual may be a GPError if the readback failed
+        """
+        if hasattr(mapping, 'items'):
+            mapping = mapping.items()
+
+        pairs = [(var.lower(), value) for var, value in mapping]
+        if not pairs:
+            return {}
+
+        with self.lock:
+            self.send_lines('%s=%s' % (var, value) for var, value in pairs)
+
+            if not verify:
+                return {}
+
+            variables = [var for var, value in pairs]
+            actual = self.get_variables_batch(variables, timeout=timeout,
+                                              raise_errors=False)
+
+        mismatches = {}
+        for (var, requested), value in zip(pairs, actual):
+            if isinstance(value, GPError) or not _value_matches(requested,
+                                                                value):
+                mismatches[var] = (requested, value)
+
+        return mismatches
+
     def kill_motor(self, motor):
         """
         Kill a specific motor
@@ -640,15 +1026,148 @@ class GpasciiChannel(ShellChannel):
 
         return errno
 
-    def send_program(self, coord, prog_num, motors={},
-                     macros={}, filename=None, script=None, run=False,
-                     verbose=False,
-                     **kwargs):
+    def get_program_hash(self, prog_num):
         """
-        Send a program and (optionally) run it in a coordinate system.
+        Get the recorded hash of the program in buffer `prog_num` (see
+        `program_hash`), or None if unknown
         """
-        self.send_line('&%dabort' % (coord, ))
+        return self.get_program_hashes([prog_num])[prog_num]
+
+    def get_program_hashes(self, prog_nums):
+        """
+        Get the recorded hashes of several programs, with controller records
+        (if enabled, see PROGRAM_HASH_VARIABLE) read in a single request
+
+        Returns: {prog_num: hash or None}
+        """
+        known = self._comm.program_hashes
+        base = self._comm.program_hash_base
+        hashes = dict((prog_num, known.get(prog_num))
+                      for prog_num in prog_nums)
+
+        # Programs opened since their hash was recorded are known to differ
+        variables = [(prog_num, program_hash_variable(prog_num, base))
+                     for prog_num in hashes
+                     if prog_num not in known or known[prog_num] is not None]
+        variables = [(prog_num, var) for prog_num, var in variables
+                     if var is not None]
+        if not variables:
+            return hashes
+
+        values = self.get_variables_batch([var for prog_num, var
+                                           in variables],
+                                          type_=int, raise_errors=False)
+        for (prog_num, var), value in zip(variables, values):
+            if isinstance(value, GPError):
+                logger.warning('Unable to read program hash: %s', value)
+                hashes[prog_num] = None
+            else:
+                hashes[prog_num] = value or None
+
+        return hashes
+
+    def set_program_hash(self, prog_num, hash_):
+        """
+        Record the hash of the program in buffer `prog_num`. If hash_ is
+        None, the record is cleared.
+        """
+        self.set_program_hashes({prog_num: hash_})
+
+    def set_program_hashes(self, hashes, confirm=False):
+        """
+        Record the hashes of several programs {prog_num: hash or None}
+
+        confirm: wait until the controller has processed the change (only
+                 applies to controller records)
+        """
+        self._comm.program_hashes.update(hashes)
+
+        base = self._comm.program_hash_base
+        pairs = [(program_hash_variable(prog_num, base), hash_ or 0)
+                 for prog_num, hash_ in hashes.items()]
+        pairs = [(var, hash_) for var, hash_ in pairs if var is not None]
+        if pairs:
+            self.set_variables(pairs, verify=confirm)
+
+    def program_changed(self, prog_num, lines):
+        """
+        Check if the program text `lines` differs from the recorded hash of
+        buffer `prog_num`
+
+        Returns: (changed, hash of lines)
+        """
+        hash_ = program_hash(lines)
+        return (self.get_program_hash(prog_num) != hash_), hash_
+
+    def send_script(self, lines, force=False, verbose=False):
+        """
+        Send script lines, skipping program buffers (`open prog` through
+        `close`) which are unchanged since they were last downloaded, unless
+        `force` is set. All other lines are always sent.
+
+        The hash of each downloaded program is recorded only after all
+        responses have been read back without an error; a failed download
+        leaves the program unrecorded (see PROGRAM_HASH_VARIABLE).
+
+        Returns: {program number: True if downloaded, False if skipped}
+        """
+        segments = split_programs([line.strip() for line in lines])
+        hashes = dict((prog, program_hash(seg_lines))
+                      for prog, seg_lines in segments if prog is not None)
 
+        if force or not hashes:
+            recorded = {}
+        else:
+            recorded = self.get_program_hashes(list(hashes))
+
+        downloaded = dict((prog, recorded.get(prog) != hash_)
+                          for prog, hash_ in hashes.items())
+        with self.lock:
+            with self.coalescing():
+                # Clear the records of the programs about to be downloaded,
+                # so that a failed download is not taken as current
+                self.set_program_hashes(dict((prog, None)
+                                             for prog, changed
+                                             in downloaded.items()
+                                             if changed))
+
+                for prog, seg_lines in segments:
+                    if prog is not None and not downloaded[prog]:
+                        vlog(verbose, 'Program %d unchanged, skipping '
+                             'download' % prog)
+                        continue
+
+                    for line in seg_lines:
+                        if line:
+                            vlog(verbose, line)
+                            logger.debug('Script line: %s', line)
+                    self.send_lines(seg_lines)
+
+            # A round trip reads back the responses to all lines sent,
+            # raising GPError on the first error
+            try:
+                self.get_variable(self.BATCH_SENTINEL)
+            except GPError as ex:
+                logger.error('Failed to send script: %s', ex)
+                raise
+
+            self.set_program_hashes(dict((prog, hashes[prog])
+                                         for prog, done in downloaded.items()
+                                         if done))
+
+        return downloaded
+
+    def download_program(self, prog_num, macros={}, filename=None,
+                         script=None, force=False):
+        """
+        Download a program to buffer `prog_num`, without running it
+
+        The download is skipped if the program (after macro expansion) is
+        the same as the one last sent to buffer `prog_num`, unless `force`
+        is set (see `send_script`).
+
+        Returns: the program lines
+        """
         opening_lines = ['close all buffers',
                          'open prog %d' % prog_num]
         closing_lines = ['close']
@@ -672,16 +1191,25 @@ class GpasciiChannel(ShellChannel):
             script = script.format(**macros)
             script = script.split('\n')
 
-        for line in script:
-            if line.rstrip():
-                logger.debug('Script line: %s', line.rstrip())
-            try:
-                self.send_line(line.strip())
-            except GPError as ex:
-                logger.error('Failed to send script: %s', ex)
-                raise
+        self.send_script(script, force=force)
+        return script
 
-        self.sync()
+    def send_program(self, coord, prog_num, motors={},
+                     macros={}, filename=None, script=None, run=False,
+                     verbose=False, force=False,
+                     **kwargs):
+        """
+        Send a program and (optionally) run it in a coordinate system.
+
+        The download is skipped if the program (after macro expansion) is
+        the same as the one last sent to buffer `prog_num`, unless `force`
+        is set.
+        """
+        self.send_line('&%dabort' % (coord, ))
+
+        script = self.download_program(prog_num, macros=macros,
+                                       filename=filename, script=script,
+                                       force=force)
 
         if motors:
             self.set_coords({coord: motors},
@@ -796,7 +1324,9 @@ class PPComm(object):
 
     def __init__(self, host=config.hostname, port=config.port,
                  user=config.username, password=config.password,
-                 fast_gather=False, fast_gather_port=config.fast_gather_port):
+                 fast_gather=False, fast_gather_port=config.fast_gather_port,
+                 var_server=False, var_server_port=config.var_server_port,
+                 program_hash_base=config.program_hash_base):
         self._host = host
         self._port = port
         self._user = user
@@ -806,6 +1336,13 @@ class PPComm(object):
         self._fast_gather_port = fast_gather_port
         self._gather_client = None
 
+        self._var_server = var_server and (var_server_mod is not None)
+        self._var_server_port = var_server_port
+
+        # Recorded hashes of downloaded programs (see PROGRAM_HASH_VARIABLE)
+        self.program_hash_base = program_hash_base
+        self.program_hashes = {}
+
         self._client = paramiko.SSHClient()
         self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self._client.connect(self._host, self._port,
@@ -817,7 +1354,10 @@ class PPComm(object):
     def __copy__(self):
         return PPComm(host=self._host, port=self._port, user=self._user,
                       password=self._pass, fast_gather=self._fast_gather,
-                      fast_gather_port=self._fast_gather_port)
+                      fast_gather_port=self._fast_gather_port,
+                      var_server=self._var_server,
+                      var_server_port=self._var_server_port,
+                      program_hash_base=self.program_hash_base)
 
     def gpascii_channel(self, cmd=None, verbose=False):
         """
@@ -829,7 +1369,20 @@ class PPComm(object):
     def gpascii_file(self, filename, check_errors=True, **kwargs):
         """
         Execute a gpascii script by remote filename
+
+        The programs the script opens are marked as changed beforehand (see
+        PROGRAM_HASH_VARIABLE). Files it includes are not checked.
         """
+        try:
+            progs = opened_programs(self.read_file(filename))
+        except (IOError, UnicodeDecodeError) as ex:
+            logger.warning('Unable to check %s for program downloads: %s',
+                           filename, ex)
+        else:
+            if progs:
+                self.gpascii.set_program_hashes(
+                    dict((prog, None) for prog in progs), confirm=True)
+
         ret = self.shell_command('gpascii -i"%s" 2>&1' % filename, **kwargs)
         if not check_errors:
             return ret
@@ -974,6 +1527,33 @@ class PPComm(object):
     def fast_gather_port(self):
         return self._fast_gather_port
 
+    def var_client(self, variables=None, types='double'):
+        """
+        Create a new client connected to the var_server on the remote
+        machine, optionally resolving and registering `variables`
+
+        Returns None if the variable server is disabled or unavailable
+        """
+        if not self._var_server:
+            return None
+
+        client = var_server_mod.VariableClient()
+        try:
+            client.connect((self._host, self._var_server_port))
+        except Exception as ex:
+            logger.error('Variable server client disabled', exc_info=ex)
+            self._var_server = False
+            return None
+
+        if variables:
+            client.resolve(self.gpascii, variables, types=types)
+
+        return client
+
+    @property
+    def var_server_port(self):
+        return self._var_server_port
+
 
 class CoordinateSave(object):
     """
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.rotary` -- Rotary buffer streaming
+==============================================
+
+.. module:: ppmac.rotary
+   :synopsis: Stream arbitrarily long motion programs (e.g., point lists for
+              scanning trajectories) through a Power PMAC rotary buffer.
+              Points are sent in chunks, keeping the buffer filled between
+              a low and a high water mark, so that throughput is bounded by
+              the link rather than by per-line round trips.
+
+              While a buffer is open, gpascii stores program lines instead of
+              executing them. Status queries are therefore made on a second
+              gpascii channel. Progress is tracked with a coordinate system
+              Q-variable that the program itself sets to the number of points
+              executed after each chunk.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import time
+import logging
+
+import numpy as np
+import six
+
+from . import const
+from .pp_comm import (vlog, GPError, ScriptFailed, TimeoutError)
+
+
+logger = logging.getLogger(__name__)
+
+
+class RotaryUnderrun(ScriptFailed):
+    pass
+
+
+def format_points(points, axes, precision=6):
+    """
+    Format rows of a 2D array (points x axes) as motion program lines
+
+    >> format_points(np.array([[1, 2], [3, 4]]), 'XY', precision=1)
+    ['X1.0 Y2.0', 'X3.0 Y4.0']
+    """
+    points = np.asarray(points, dtype=float)
+    if points.ndim == 1:
+        points = points.reshape(-1, 1)
+
+    if points.shape[1] != len(axes):
+        raise ValueError('Expected %d columns (axes %s), got %d' %
+                         (len(axes), ''.join(axes), points.shape[1]))
+
+    fmt = ' '.join('%s%%.%df' % (axis, precision) for axis in axes)
+    return [fmt % tuple(row) for row in points]
+
+
+class RotaryStreamer(object):
+    """
+    Stream motion program lines through a rotary buffer in a coordinate
+    system
+
+    gpascii: channel used to send program lines
+    coord: coordinate system number
+    axes: axis names corresponding to columns of the points
+    buffer_size: rotary buffer size (see `define rotary`)
+    low_water, high_water: buffer fill levels, in points. Chunks are sent
+                           whenever the fill level drops below high_water;
+                           falling below low_water while running is logged.
+    chunk_size: maximum number of points sent at once
+    progress_q: coordinate system Q-variable used for progress tracking
+    preamble: lines sent to the buffer before any points
+              (e.g., ['linear', 'abs', 'TM10'])
+    status_channel: gpascii channel used for status queries; if None, one
+                    is opened (and closed by `close`)
+    """
+
+    def __init__(self, gpascii, coord, axes='X', buffer_size=1048576,
+                 low_water=500, high_water=5000, chunk_size=500,
+                 progress_q=1000, preamble=None, precision=6,
+                 status_channel=None):
+        self.gpascii = gpascii
+        self.coord = coord
+        self.axes = list(axes)
+        self.buffer_size = buffer_size
+        self.low_water = low_water
+        self.high_water = high_water
+        self.chunk_size = chunk_size
+        self.progress_q = progress_q
+        self.precision = precision
+
+        if preamble is None:
+            preamble = ['linear', 'abs']
+
+        self.preamble = list(preamble)
+
+        self._owns_status = (status_channel is None)
+        self.status = status_channel
+        self._get_status_channel()
+
+        self.progress_var = 'Coord[%d].Q[%d]' % (coord, progress_q)
+        self._status_vars = [self.progress_var,
+                             'Coord[%d].ProgActive' % coord,
+                             'Coord[%d].ErrorStatus' % coord,
+                             ]
+
+    def _chunks(self, points):
+        """
+        Split points (a 2D array, an iterable of rows, or an iterable of
+        program line strings) into chunks of program lines
+        """
+        if isinstance(points, np.ndarray):
+            for i in range(0, len(points), self.chunk_size):
+                yield format_points(points[i:i + self.chunk_size],
+                                    self.axes, precision=self.precision)
+            return
+
+        chunk = []
+        for point in points:
+            if isinstance(point, six.string_types):
+                chunk.append(point)
+            else:
+                chunk.extend(format_points([point], self.axes,
+                                           precision=self.precision))
+
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    def _get_status_channel(self):
+        if self.status is None:
+            self.status = self.gpascii._comm.gpascii_channel()
+        return self.status
+
+    def _send_chunk(self, lines, total):
+        """
+        Send a chunk of lines followed by the progress marker, then check
+        for errors reported so far (e.g., rejected program lines)
+        """
+        self.gpascii.send_lines(list(lines) + ['Q%d=%d' % (self.progress_q,
+                                                          total)])
+        self._check_errors()
+
+    def _check_errors(self, timeout=0.0):
+        """
+        Raise ScriptFailed if gpascii reported an error on the streaming
+        channel, waiting at most `timeout` seconds for further output
+        """
+        try:
+            self.gpascii.sync(timeout=timeout)
+        except GPError as ex:
+            raise ScriptFailed('Rotary buffer error: %s' % ex)
+
+    def get_status(self):
+        """
+        Query progress, program active and error status in one pipelined
+        request
+
+        Returns: (points executed, program active, error status)
+        """
+        status = self._get_status_channel()
+        progress, active, error = status.get_variables_batch(
+            self._status_vars, type_=float)
+        return int(progress), bool(active), int(error)
+
+    def open(self):
+        """
+        (Re)define and open the rotary buffer, and reset progress
+        """
+        coord = self.coord
+        status = self._get_status_channel()
+        status.send_line('&%dabort' % coord, sync=True)
+        status.send_line('%s=0' % self.progress_var, sync=True)
+
+        self.gpascii.send_lines(['close all buffers',
+                                 '&%ddelete rotary' % coord,
+                                 '&%ddefine rotary %d' % (coord,
+                                                          self.buffer_size),
+                                 '&%dopen rotary' % coord,
+                                 ] + self.preamble)
+        self._check_errors(timeout=0.01)
+
+    def close(self):
+        """
+        Close the rotary buffer, and the status channel if it was opened by
+        the streamer (it is reopened as needed)
+        """
+        try:
+            self.gpascii.send_line('close', sync=True)
+        finally:
+            if self._owns_status and self.status is not None:
+                self.status.close()
+                self.status = None
+
+    def stream(self, points, run=True, poll_period=0.005, timeout=10.0,
+               verbose=False, raise_underrun=False):
+        """
+        Stream points through the rotary buffer, running the rotary program
+        once the buffer is first filled to the high water mark
+
+        points: 2D array (points x axes), or an iterable of rows or of
+                motion program lines
+        timeout: maximum time without progress
+
+        Returns: dictionary of statistics (points sent, underruns,
+                 minimum/maximum fill level, elapsed time, rate)
+        """
+        self.open()
+
+        chunks = self._chunks(points)
+        sent = 0
+        executed = 0
+        started = not run
+        exhausted = False
+        underruns = 0
+        low_events = 0
+        min_fill = None
+        max_fill = 0
+        t0 = time.time()
+        last_progress = t0
+
+        try:
+            while True:
+                fill = sent - executed
+                while not exhausted and fill < self.high_water:
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+
+                    sent += len(chunk)
+                    self._send_chunk(chunk, sent)
+                    fill = sent - executed
+
+                max_fill = max(max_fill, fill)
+
+                if not started:
+                    # Start once the buffer is primed (or everything is sent)
+                    self.gpascii.flush()
+                    self._get_status_channel().send_line(
+                        '&%db0r' % self.coord, sync=True)
+                    started = True
+                    vlog(verbose, 'Rotary program started (%d points buffered)'
+                         % sent)
+
+                time.sleep(poll_period)
+                new_executed, active, error = self.get_status()
+                if new_executed != executed:
+                    last_progress = time.time()
+
+                executed = new_executed
+                fill = sent - executed
+                if min_fill is None or fill < min_fill:
+                    min_fill = fill
+
+                if error in const.coord_errors:
+                    raise ScriptFailed('(%d) %s' % (error,
+                                                    const.coord_errors[error]))
+
+                if exhausted and executed >= sent:
+                    break
+
+                if not active:
+                    if run:
+                        raise ScriptFailed('Rotary program stopped after %d of '
+                                           '%d points' % (executed, sent))
+                elif not exhausted and fill == 0:
+                    underruns += 1
+                    logger.warning('Rotary buffer underrun after %d points',
+                                   executed)
+                    if raise_underrun:
+                        raise RotaryUnderrun('Underrun after %d points' %
+                                             executed)
+                elif not exhausted and fill < self.low_water:
+                    low_events += 1
+
+                if (time.time() - last_progress) > timeout:
+                    raise TimeoutError('No progress in %.1f s (%d/%d points)' %
+                                       (timeout, executed, sent))
+
+                vlog(verbose, 'Sent %d executed %d fill %d' %
+                     (sent, executed, fill), end='\r')
+        except KeyboardInterrupt:
+            self._get_status_channel().send_line('&%dabort' % self.coord)
+            raise
+        finally:
+            self.close()
+
+        elapsed = time.time() - t0
+        return {'points': sent,
+                'underruns': underruns,
+                'low_water_events': low_events,
+                'min_fill': min_fill,
+                'max_fill': max_fill,
+                'elapsed': elapsed,
+                'rate': sent / elapsed if elapsed > 0 else 0.0,
+                }
+
+
+def stream_points(gpascii, coord, points, axes='X', run=True, verbose=False,
+                  **kwargs):
+    """
+    Stream a point list through a rotary buffer in a coordinate system
+
+    See `RotaryStreamer` for keyword arguments
+    """
+    streamer = RotaryStreamer(gpascii, coord, axes=axes, **kwargs)
+    return streamer.stream(points, run=run, verbose=verbose)
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.timebase` -- Controller-to-host clock correlation
+=============================================================
+
+.. module:: ppmac.timebase
+   :synopsis: Correlate the controller servo clock (Sys.ServoCount) with
+              host time, so that gathered data (timestamped in servo cycles)
+              and polled values (timestamped on the host) from one or more
+              controllers can be placed on a single timeline.
+
+              Sys.ServoCount is sampled regularly, bracketed by host
+              monotonic timestamps. The midpoint of each request is taken as
+              the host time of the sample and its round-trip time as its
+              uncertainty. Offset and drift are fit over a sliding window,
+              using only the samples with the lowest round-trip times, as
+              SSH latency is highly variable but bounded below.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import time
+import logging
+import threading
+from collections import deque
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+SERVO_COUNT_MODULUS = 2 ** 32
+
+
+class ClockCorrelator(object):
+    """
+    Online estimate of the relationship between Sys.ServoCount and host
+    monotonic time:
+
+        host_time = offset + servo_count * servo_period * (1 + drift)
+
+    >> corr = ClockCorrelator(comm.gpascii)
+    >> corr.start(period=1.0)
+    >> corr.servo_to_host(gathered_servo_counts)
+
+    window: number of samples kept for the fit
+    fit_fraction: fraction of the window (lowest round-trip times) used for
+                  the fit
+    """
+
+    def __init__(self, gpascii, servo_period=None, window=64,
+                 fit_fraction=0.5, variable='Sys.ServoCount'):
+        self.gpascii = gpascii
+        if servo_period is None:
+            servo_period = gpascii.servo_period
+
+        self.servo_period = float(servo_period)
+        self.variable = variable
+        self.fit_fraction = fit_fraction
+        self.samples = deque(maxlen=window)
+
+        # Offset between wall clock and monotonic time, for conversions to
+        # time.time()-style timestamps
+        self.wall_offset = time.time() - monotonic()
+
+        self.offset = None
+        self.drift = 0.0
+        self.latency = None
+        self.min_rtt = None
+
+        self._raw_last = None
+        self._count_base = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def unwrap(self, raw_count):
+        """
+        Extend a raw 32-bit servo count past rollover, relative to the last
+        sampled count
+        """
+        raw_count = int(raw_count) % SERVO_COUNT_MODULUS
+        if self._raw_last is not None and raw_count < self._raw_last:
+            self._count_base += SERVO_COUNT_MODULUS
+
+        self._raw_last = raw_count
+        return self._count_base + raw_count
+
+    def sample(self):
+        """
+        Take one (host time, servo count, round trip time) sample and update
+        the estimate
+
+        Returns: (host time, servo count, round trip time)
+        """
+        t0 = monotonic()
+        raw = self.gpascii.get_variable(self.variable, type_=int)
+        t1 = monotonic()
+
+        with self._lock:
+            count = self.unwrap(raw)
+            rtt = t1 - t0
+            host_time = t0 + rtt / 2.0
+            self.samples.append((host_time, count, rtt))
+            self._update()
+
+        return host_time, count, rtt
+
+    def _update(self):
+        samples = np.array(self.samples, dtype=float)
+        host, counts, rtts = samples.T
+
+        self.min_rtt = rtts.min()
+        self.latency = np.median(rtts) / 2.0
+
+        n_fit = max(int(len(samples) * self.fit_fraction), 1)
+        best = np.argsort(rtts)[:n_fit]
+        servo_time = counts[best] * self.servo_period
+        if n_fit >= 2 and np.ptp(servo_time) > 0:
+            # Center the data for a well-conditioned fit
+            t_mean, h_mean = servo_time.mean(), host[best].mean()
+            slope, intercept = np.polyfit(servo_time - t_mean,
+                                          host[best] - h_mean, 1)
+            self.drift = slope - 1.0
+            self.offset = h_mean + intercept - slope * t_mean
+        else:
+            self.drift = 0.0
+            self.offset = np.mean(host[best] - servo_time)
+
+    @property
+    def ready(self):
+        return self.offset is not None
+
+    @property
+    def uncertainty(self):
+        """
+        Bound on the error of the offset (half of the best round-trip time)
+        """
+        if self.min_rtt is None:
+            return None
+        return self.min_rtt / 2.0
+
+    def _check_ready(self):
+        if self.offset is None:
+            raise RuntimeError('No clock samples taken yet')
+
+    def servo_to_host(self, counts):
+        """
+        Convert (unwrapped) servo counts to host monotonic time
+        """
+        self._check_ready()
+        counts = np.asarray(counts, dtype=float)
+        return (self.offset +
+                counts * self.servo_period * (1.0 + self.drift))
+
+    def host_to_servo(self, times):
+        """
+        Convert host monotonic times to (fractional) servo counts
+        """
+        self._check_ready()
+        times = np.asarray(times, dtype=float)
+        return ((times - self.offset) /
+                (self.servo_period * (1.0 + self.drift)))
+
+    def servo_to_wall(self, counts):
+        """
+        Convert servo counts to wall clock (time.time()) timestamps
+        """
+        return self.servo_to_host(counts) + self.wall_offset
+
+    def wall_to_servo(self, times):
+        """
+        Convert wall clock (time.time()) timestamps to servo counts
+        """
+        return self.host_to_servo(np.asarray(times, dtype=float) -
+                                  self.wall_offset)
+
+    def gather_to_wall(self, times):
+        """
+        Convert gathered times (in seconds, as rewritten from Sys.ServoCount
+        by gather._check_times) to wall clock timestamps
+        """
+        counts = np.asarray(times, dtype=float) / self.servo_period
+        if self._raw_last is not None:
+            # Gathered counts are raw 32-bit values; place them in the
+            # rollover period closest to the last sample
+            last = self._count_base + self._raw_last
+            counts = counts + np.round((last - counts) /
+                                       SERVO_COUNT_MODULUS) * \
+                SERVO_COUNT_MODULUS
+
+        return self.servo_to_wall(counts)
+
+    def _run(self, period):
+        while not self._stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as ex:
+                logger.error('Clock sample failed', exc_info=ex)
+
+            self._stop_event.wait(period)
+
+    def start(self, period=1.0, initial_samples=8):
+        """
+        Sample periodically in a background thread
+
+        initial_samples: samples taken back-to-back before returning, so that
+                         an estimate is available immediately
+        """
+        if self._thread is not None:
+            return
+
+        for i in range(initial_samples):
+            self.sample()
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(period, ))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+
+    def __repr__(self):
+        if self.offset is None:
+            return '<ClockCorrelator (no samples)>'
+
+        return ('<ClockCorrelator drift=%.3fppm latency=%.2fms '
+                'uncertainty=%.2fms samples=%d>' %
+                (self.drift * 1e6, self.latency * 1000.,
+                 self.uncertainty * 1000., len(self.samples)))
+
+
+def merge_timelines(series, times=None):
+    """
+    Merge several timestamped series onto a single timeline
+
+    series: {name: (times, values)}, all times in the same base (e.g., wall
+            clock, after conversion with ClockCorrelator.servo_to_wall)
+    times: timeline to interpolate onto; defaults to the sorted union of all
+           series' times
+
+    Returns: (times, {name: values}), with NaN outside of each series' range
+    """
+    series = dict((name, (np.asarray(t, dtype=float),
+                          np.asarray(v, dtype=float)))
+                  for name, (t, v) in series.items())
+
+    if times is None:
+        times = np.unique(np.concatenate([t for t, v in series.values()]))
+
+    merged = {}
+    for name, (t, v) in series.items():
+        if not len(t):
+            merged[name] = np.full(len(times), np.nan)
+            continue
+
+        order = np.argsort(t, kind='mergesort')
+        t, v = t[order], v[order]
+        merged[name] = np.interp(times, t, v, left=np.nan, right=np.nan)
+
+    return times, merged
+
+
+def test():
+    from .pp_comm import PPComm
+
+    comm = PPComm()
+    corr = ClockCorrelator(comm.gpascii)
+    for i in range(32):
+        corr.sample()
+        time.sleep(0.05)
+
+    print(corr)
+    count = corr.host_to_servo(monotonic())
+    print('Estimated servo count now: %d' % count)
+    print('Read servo count: %d' %
+          comm.gpascii.get_variable('Sys.ServoCount', type_=int))
+
+
+if __name__ == '__main__':
+    test()
@@ -17,6 +17,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 from .gather import get_gather_results
 from . import gather as gather_mod
+from .gather_stats import GatherStats
+from . import lod_plot
 from . import pp_comm
 
 
@@ -36,7 +38,7 @@ def custom_tune(gpascii, script_file, motor1=3, distance=0.01, velocity=0.01,
     """
     Run a tuning script and return the gathered data
 
-    Returns: gathered_variables, data
+    Returns: GatherFrame
     """
 
     if motor2 is None:
@@ -135,8 +137,8 @@ def plot_tune_results(columns, data,
     x_axis, desired, actual, servo = [data[:, i] for i in idx]
 
     fig, ax1 = plt.subplots()
-    ax1.plot(x_axis, desired, color='black', label='Desired')
-    ax1.plot(x_axis, actual, color='b', label='Actual')
+    lod_plot.plot(ax1, x_axis, desired, color='black', label='Desired')
+    lod_plot.plot(ax1, x_axis, actual, color='b', label='Actual')
     ax1.set_xlabel('Time (s)')
     ax1.set_ylabel('Position (motor units)')
     for tl in ax1.get_yticklabels():
@@ -144,7 +146,8 @@ def plot_tune_results(columns, data,
 
     error = desired - actual
     ax2 = ax1.twinx()
-    ax2.plot(x_axis, error, color='r', alpha=0.4, label='Following error')
+    lod_plot.plot(ax2, x_axis, error, color='r', alpha=0.4,
+                  label='Following error')
     ax2.set_ylabel('Error (motor units)')
     for tl in ax2.get_yticklabels():
         tl.set_color('r')
@@ -235,14 +238,30 @@ def copy_settings(gpascii, motor_from, motor_to, settings=None, completer=None):
     if settings is None:
         settings = get_settings_variables(completer)
 
-    for setting in settings:
-        from_ = 'Motor[%d].%s' % (motor_from, setting)
-        to_ = 'Motor[%d].%s' % (motor_to, setting)
-
-        old_value = gpascii.get_variable(to_)
-        new_value = gpascii.get_variable(from_)
-        if old_value != new_value:
-            gpascii.set_variable(to_, new_value)
+    from_vars = ['Motor[%d].%s' % (motor_from, setting)
+                 for setting in settings]
+    to_vars = ['Motor[%d].%s' % (motor_to, setting)
+               for setting in settings]
+
+    values = gpascii.get_variables_batch(from_vars + to_vars,
+                                         raise_errors=False)
+    new_values, old_values = values[:len(settings)], values[len(settings):]
+
+    changes = [(to_, new_value, old_value)
+               for to_, new_value, old_value in zip(to_vars, new_values,
+                                                    old_values)
+               if old_value != new_value
+               and not isinstance(new_value, pp_comm.GPError)]
+
+    mismatches = gpascii.set_variables([(to_, new_value)
+                                        for to_, new_value, old_value
+                                        in changes])
+
+    for to_, new_value, old_value in changes:
+        if to_.lower() in mismatches:
+            requested, actual = mismatches[to_.lower()]
+            print('Failed to set %s to %s (is: %s)' % (to_, new_value, actual))
+        else:
             print('Set %s to %s (was: %s)' % (to_, new_value, old_value))
 
 BIN_PATH = '/opt/ppmac'
@@ -297,6 +316,12 @@ def plot_custom(columns, data, left_indices=[], right_indices=[],
                 left_colors='bgc', right_colors='rmk',
                 fft=False, fft_remove_dc=True):
 
+    if isinstance(data, gather_mod.GatherFrame):
+        # Indices may be given as addresses
+        x_index = data.index(x_index)
+        left_indices = [data.index(idx) for idx in left_indices]
+        right_indices = [data.index(idx) for idx in right_indices]
+
     data = np.array(data)
 
     x_axis = data[:, x_index]
@@ -331,8 +356,8 @@ def plot_custom(columns, data, left_indices=[], right_indices=[],
     fig, ax1 = plt.subplots()
     if left_indices:
         for idx, color in zip(left_indices, left_colors):
-            ax1.plot(x_axis, data[:, idx], color, label=columns[idx],
-                     alpha=0.7)
+            lod_plot.plot(ax1, x_axis, data[:, idx], color,
+                          label=columns[idx], alpha=0.7)
         ax1.set_xlabel(xlabel)
         ax1.set_ylabel(left_label)
         for tl in ax1.get_yticklabels():
@@ -342,8 +367,8 @@ def plot_custom(columns, data, left_indices=[], right_indices=[],
     if right_indices:
         ax2 = ax1.twinx()
         for idx, color in zip(right_indices, right_colors):
-            ax2.plot(x_axis, data[:, idx], color, label=columns[idx],
-                     alpha=0.4)
+            lod_plot.plot(ax2, x_axis, data[:, idx], color,
+                          label=columns[idx], alpha=0.4)
         ax2.set_ylabel(right_label)
         for tr in ax2.get_yticklabels():
             tr.set_color(right_colors[0])
@@ -357,15 +382,11 @@ def tune_range(gpascii, script_file, parameter, values, **kwargs):
     if '.' not in parameter:
         parameter = 'Motor[%d].Servo.%s' % (int(motor), parameter)
 
-    def calc_rms(addrs, data):
-        desired_addr = 'motor[%d].despos.a' % motor
-        actual_addr = 'motor[%d].actpos.a' % motor
-
-        desired, actual = gather_mod.get_columns(addrs, data,
-                                                 desired_addr, actual_addr)
-
-        err = desired - actual
-        return np.sqrt(np.sum(err ** 2) / len(desired))
+    def calc_rms(frame):
+        stats = GatherStats(['motor[%d].despos' % motor,
+                             'motor[%d].actpos' % motor])
+        stats.update(frame)
+        return stats['motor[%d].followingerror' % motor].rms
 
     rms_results = []
     try:
@@ -375,10 +396,9 @@ def tune_range(gpascii, script_file, parameter, values, **kwargs):
             gpascii.set_variable(parameter, value)
             print('%s = %s' % (parameter, gpascii.get_variable(parameter)))
 
-            addrs, data = custom_tune(gpascii._comm, script_file, **kwargs)
-            data = np.array(data)
+            frame = custom_tune(gpascii, script_file, **kwargs)
 
-            rms_ = calc_rms(addrs, data)
+            rms_ = calc_rms(frame)
             print('\tDesired/actual position error (RMS): %g' % rms_)
             rms_results.append(rms_)
     except KeyboardInterrupt:
@@ -402,13 +422,14 @@ def main():
     print('Servo period is', servo_period)
 
     if 1:
-        labels, data = custom_tune(comm, 'tune/ramp.txt', 3, 0.01, 0.01, iterations=3,
-                                   gather=['Acc24E3[1].Chan[0].ServoCapt.a'])
+        frame = custom_tune(comm.gpascii, 'tune/ramp.txt', 3, 0.01, 0.01,
+                            iterations=3,
+                            gather=['Acc24E3[1].Chan[0].ServoCapt.a'])
 
-        data = np.array(data)
+        data = np.array(frame)
         data[:, 4] /= 4096 * 512
-        # gather_mod.plot(gather_vars, data)
-        ax1, ax2 = plot_custom(labels, data, left_indices=[1, 2], right_indices=[4],
+        # gather_mod.plot(frame.addresses, frame)
+        ax1, ax2 = plot_custom(frame.addresses, data, left_indices=[1, 2], right_indices=[4],
                                left_label='Position [um]', right_label='Raw encoder [um]')
 
         plt.title('10nm ramp move')
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+:mod:`ppmac.unwrap` -- Counter rollover unwrapping
+==================================================
+
+.. module:: ppmac.unwrap
+   :synopsis: Vectorized unwrapping of gathered counters (Sys.ServoCount,
+              encoder ServoCapt registers, ...) which roll over at a fixed
+              bit width.
+
+              Rollovers are found from the sample-to-sample differences:
+              any step larger than the threshold (half the modulus, by
+              default) is taken to be a wrap, and the cumulative sum of the
+              corrections is added to the raw values. Counters without a
+              known modulus can still be joined, by removing the step at
+              each jump.
+
+              `CounterUnwrapper` and `FrameUnwrapper` carry the last value
+              and accumulated offset between calls, for streamed data.
+.. moduleauthor:: Ken Lauer <klauer@bnl.gov>
+"""
+
+from __future__ import print_function
+import logging
+
+import numpy as np
+
+from .gather_frame import GatherFrame
+
+
+logger = logging.getLogger(__name__)
+
+# Counters unwrapped by default, by address (without the .a suffix)
+COUNTER_BITS = {'sys.servocount': 32,
+                }
+
+
+def _modulus(bits=None, modulus=None):
+    if modulus is None and bits is not None:
+        modulus = 2 ** int(bits)
+    return modulus
+
+
+def _as_counter_array(values):
+    """
+    Counters are unwrapped in int64 (exact) or float64
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'iub':
+        return values.astype(np.int64)
+    return values.astype(np.float64)
+
+
+def unwrap_counter(values, bits=None, modulus=None, threshold=None,
+                   last=None, offset=0):
+    """
+    Unwrap a counter which rolls over
+
+    values: raw counter values
+    bits, modulus: counter width (modulus = 2 ** bits). Without either, each
+                   jump larger than `threshold` is removed (the counter is
+                   joined with a zero step), as check_servocapt_rollover did.
+    threshold: steps larger than this are rollovers (default: modulus / 2)
+    last, offset: raw value preceding `values` and offset accumulated so far,
+                  when unwrapping a stream in chunks
+
+    Returns: (unwrapped values, offset after the last value)
+    """
+    modulus = _modulus(bits, modulus)
+    if threshold is None:
+        if modulus is None:
+            raise ValueError('Either the counter width or the threshold must '
+                             'be specified')
+        threshold = modulus / 2
+
+    raw = _as_counter_array(values)
+    if not len(raw):
+        return raw, offset
+
+    if last is None:
+        steps = np.diff(raw)
+        corrections = np.zeros(len(raw), dtype=raw.dtype)
+        jumps = corrections[1:]
+    else:
+        steps = np.diff(np.concatenate(([last], raw)).astype(raw.dtype))
+        corrections = np.zeros(len(raw), dtype=raw.dtype)
+        jumps = corrections
+
+    wrapped = np.abs(steps) > threshold
+    if wrapped.any():
+        if modulus is None:
+            jumps[wrapped] = -steps[wrapped]
+        else:
+            # Counting up past the modulus (negative step) or down past zero
+            jumps[wrapped] = -np.sign(steps[wrapped]) * modulus
+        np.cumsum(corrections, out=corrections)
+
+    unwrapped = raw + corrections + offset
+    return unwrapped, offset + corrections[-1]
+
+
+class CounterUnwrapper(object):
+    """
+    Unwrap a counter across consecutive chunks
+
+    >> unwrapper = CounterUnwrapper(bits=32)
+    >> for chunk in chunks:
+    ..     counts = unwrapper(chunk)
+    """
+
+    def __init__(self, bits=None, modulus=None, threshold=None):
+        self.modulus = _modulus(bits, modulus)
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.offset = 0
+
+    def __call__(self, values):
+        unwrapped, offset = unwrap_counter(values, modulus=self.modulus,
+                                           threshold=self.threshold,
+                                           last=self.last,
+                                           offset=self.offset)
+        if len(unwrapped):
+            self.last = unwrapped[-1] - offset
+            self.offset = offset
+        return unwrapped
+
+
+def _counter_spec(spec):
+    """
+    Counter specification: bit width (int) or a dictionary of
+    CounterUnwrapper keyword arguments
+    """
+    if isinstance(spec, dict):
+        return spec
+    return {'bits': spec}
+
+
+class FrameUnwrapper(object):
+    """
+    Unwrap the counter columns of gathered frames, all in one pass
+
+    counters: {address: bit width (or dict of CounterUnwrapper arguments)};
+              Sys.ServoCount (32 bits) is included by default, pass
+              defaults=False to disable
+
+    Calling the instance with consecutive frames (e.g., streamed blocks)
+    unwraps continuously across them.
+    """
+
+    def __init__(self, counters=None, defaults=True):
+        specs = {}
+        if defaults:
+            specs.update(COUNTER_BITS)
+
+        if counters is not None:
+            for address, spec in counters.items():
+                key = address.lower()
+                if key.endswith('.a'):
+                    key = key[:-2]
+                specs[key] = spec
+
+        self.unwrappers = dict((key, CounterUnwrapper(**_counter_spec(spec)))
+                               for key, spec in specs.items())
+
+    def reset(self):
+        for unwrapper in self.unwrappers.values():
+            unwrapper.reset()
+
+    def __call__(self, frame):
+        """
+        Returns: new GatherFrame with the counter columns unwrapped (as int64
+                 or float64); other columns are unchanged
+        """
+        columns = []
+        unwrapped = 0
+        for i, address in enumerate(frame.addresses):
+            key = address.lower()
+            if key.endswith('.a'):
+                key = key[:-2]
+
+            column = frame.column(i)
+            if key in self.unwrappers:
+                column = self.unwrappers[key](column)
+                unwrapped += 1
+            columns.append(column)
+
+        if not unwrapped:
+            return frame
+
+        return GatherFrame.from_columns(frame.addresses, columns,
+                                        servo_period=frame.servo_period,
+                                        gather_period=frame.gather_period,
+                                        time_address=frame.time_address)
+
+
+def unwrap_frame(frame, counters=None, defaults=True):
+    """
+    Unwrap the counter columns of a frame (see `FrameUnwrapper`)
+    """
+    return FrameUnwrapper(counters, defaults=defaults)(frame)
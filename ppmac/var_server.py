@@ -0,0 +1,410 @@
+"""
+:mod:`ppmac.var_server` -- var_server client
+============================================
+
+.. module:: var_server
+   :synopsis: VariableClient connects to a TCP server running on the Power PMAC
+       called var_server. Variable addresses are resolved once (through
+       gpascii, by way of the `.a` suffix) and registered with the server.
+       After that, snapshots of all registered values are sent in binary,
+       either on request or periodically, without any gpascii text parsing.
+
+       SimulatedVariableServer is a pure-Python stand-in for var_server which
+       speaks the same protocol, serving values from a dictionary. It can be
+       used for testing clients without a Power PMAC.
+.. moduleauthor:: K Lauer <klauer@bnl.gov>
+
+"""
+
+from __future__ import print_function
+import socket
+import struct
+import threading
+import time
+import logging
+
+import numpy as np
+import six
+
+from . import config
+from .fast_gather import TCPSocket
+from .gather_types import (UINT32, INT32, FLOAT, DOUBLE)
+
+
+logger = logging.getLogger(__name__)
+
+TYPE_NAMES = {'uint32': UINT32,
+              'int32': INT32,
+              'float': FLOAT,
+              'double': DOUBLE,
+              }
+
+# numpy dtypes of the raw (big-endian) values, by gather type
+RAW_DTYPES = {UINT32: '>u4',
+              INT32: '>i4',
+              FLOAT: '>f4',
+              DOUBLE: '>f8',
+              }
+
+ERROR_CODES = {1: 'Unknown request',
+               2: 'Too many items',
+               3: 'Address out of range',
+               4: 'Bad packet',
+               }
+
+MAX_ITEMS = 1024
+
+
+class VarServerError(Exception):
+    pass
+
+
+def _get_type(type_):
+    """
+    Gather type index from a type name or index
+    """
+    if isinstance(type_, six.string_types):
+        return TYPE_NAMES[type_.lower()]
+    return type_
+
+
+def _get_dtype(types):
+    """
+    Structured numpy dtype for one snapshot of values
+    """
+    return np.dtype([('f%d' % i, RAW_DTYPES.get(type_, '>u4'))
+                     for i, type_ in enumerate(types)])
+
+
+class VariableClient(TCPSocket):
+    """
+    Power PMAC var_server client
+
+    >> client = VariableClient(host_port=('10.3.2.115', 2333))
+    >> client.resolve(comm.gpascii, ['Motor[1].ActPos', 'Motor[1].DesPos'])
+    >> client.read()
+    (123456, (0.1, 0.1))
+    """
+
+    def __init__(self, *args, **kwargs):
+        TCPSocket.__init__(self, *args, **kwargs)
+        self.variables = []
+        self.addresses = []
+        self.types = []
+        self._dtype = _get_dtype([])
+        self._periodic = False
+
+    def connect(self, host_port):
+        self.sock.connect(host_port)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _send_packet(self, code, payload=b''):
+        self.send(struct.pack('>I', len(payload) + 1) + code + payload)
+
+    def _recv_any_packet(self):
+        """
+        Receive a packet, whatever its code
+
+        Returns: (code, packet)
+        Raises RuntimeError upon disconnection
+        Raises VarServerError upon receiving an error code from the server
+        """
+        packet_len, = struct.unpack('>I', self.recv_fixed(4))
+        packet = self.recv_fixed(packet_len)
+        code, packet = packet[:1], packet[1:]
+
+        if code == b'E':
+            error_code, = struct.unpack('>I', packet[:4])
+            raise VarServerError('Error %d: %s' %
+                                 (error_code,
+                                  ERROR_CODES.get(error_code, 'Unknown')))
+        return code, packet
+
+    def _recv_packet(self, expected_code):
+        """
+        Receive a packet, with an expected code
+
+        Raises RuntimeError upon receiving an unexpected code or disconnection
+        Raises VarServerError upon receiving an error code from the server
+        """
+        code, packet = self._recv_any_packet()
+        if expected_code == code:
+            return packet
+
+        raise RuntimeError('Unexpected code %s (expected %s)' %
+                           (code, expected_code))
+
+    def set_items(self, addresses, types, variables=None):
+        """
+        Register raw addresses (and their gather types) with the server
+
+        types may be type indices (see gather_types) or names such as
+        'double' or 'int32'.
+        """
+        if len(addresses) != len(types):
+            raise ValueError('Number of addresses and types differ')
+        if len(addresses) > MAX_ITEMS:
+            raise ValueError('Too many items (max=%d)' % MAX_ITEMS)
+
+        if self._periodic:
+            self.stop_periodic()
+
+        types = [_get_type(type_) for type_ in types]
+        payload = [struct.pack('>H', len(addresses))]
+        payload.extend(struct.pack('>IH', addr, type_)
+                       for addr, type_ in zip(addresses, types))
+
+        self._send_packet(b'I', b''.join(payload))
+        self._recv_packet(b'K')
+
+        if variables is None:
+            variables = ['$%x' % addr for addr in addresses]
+
+        self.variables = list(variables)
+        self.addresses = list(addresses)
+        self.types = types
+        self._dtype = _get_dtype(types)
+
+    def resolve(self, gpascii, variables, types='double'):
+        """
+        Resolve the addresses of variables through gpascii (`var.a`) and
+        register them with the server
+
+        types may be a single type for all variables or one per variable
+        """
+        if isinstance(types, six.string_types) or isinstance(types, int):
+            types = [types] * len(variables)
+
+        addresses = [gpascii.get_variable('%s.a' % var, type_=int)
+                     for var in variables]
+        self.set_items(addresses, types, variables=variables)
+        return addresses
+
+    def _parse_snapshot(self, packet, as_numpy=False):
+        servo_count, = struct.unpack('>I', packet[:4])
+        values = np.frombuffer(packet[4:], dtype=self._dtype, count=1)[0]
+        if as_numpy:
+            return servo_count, values
+
+        return servo_count, tuple(values.tolist())
+
+    def read(self, as_numpy=False):
+        """
+        Read a single snapshot of all registered values
+
+        Returns: (servo count, values)
+        """
+        self._send_packet(b'R')
+        return self._parse_snapshot(self._recv_packet(b'V'),
+                                    as_numpy=as_numpy)
+
+    def read_dict(self):
+        """
+        Read a single snapshot, as a dictionary of {variable: value}
+        """
+        servo_count, values = self.read()
+        return dict(zip(self.variables, values))
+
+    def start_periodic(self, period, count=0):
+        """
+        Request a snapshot every `period` seconds, `count` times (0=forever)
+        """
+        period_us = int(period * 1e6)
+        self._send_packet(b'P', struct.pack('>II', period_us, count))
+        self._periodic = True
+
+    def stop_periodic(self):
+        """
+        Stop periodic snapshots, discarding any still in transit
+        """
+        self._send_packet(b'H')
+        while True:
+            code, packet = self._recv_any_packet()
+            if code == b'K':
+                break
+            elif code != b'V':
+                raise RuntimeError('Unexpected code %s (expected K)' % code)
+            # Skip snapshots sent before the halt was received
+
+        self._periodic = False
+
+    def iter_periodic(self, period, count=0, as_numpy=False):
+        """
+        Generator yielding periodic snapshots: (servo count, values)
+
+        Periodic mode is halted when the generator is closed
+        """
+        self.start_periodic(period, count)
+        try:
+            received = 0
+            while count == 0 or received < count:
+                packet = self._recv_packet(b'V')
+                received += 1
+                yield self._parse_snapshot(packet, as_numpy=as_numpy)
+        finally:
+            if count == 0 or received < count:
+                self.stop_periodic()
+            self._periodic = False
+
+    def read_block(self, period, count):
+        """
+        Read `count` periodic snapshots into arrays
+
+        Returns: (servo counts, structured array of values)
+        """
+        counts = np.zeros(count, dtype=np.uint32)
+        values = np.zeros(count, dtype=self._dtype)
+        for i, (servo_count, snapshot) in enumerate(
+                self.iter_periodic(period, count, as_numpy=True)):
+            counts[i] = servo_count
+            values[i] = snapshot
+
+        return counts, values
+
+
+class SimulatedVariableServer(object):
+    """
+    A pure-Python stand-in for var_server
+
+    Values are served from `values`, a dictionary of {address: value}. The
+    servo count increments by one per snapshot, unless `servo_count` is
+    set to a callable.
+
+    >> server = SimulatedVariableServer({0x1000: 1.0, 0x1008: 2})
+    >> server.start()
+    >> client = VariableClient(host_port=server.address)
+    """
+
+    def __init__(self, values=None, host='127.0.0.1', port=0,
+                 servo_count=None):
+        if values is None:
+            values = {}
+
+        self.values = values
+        self.servo_count = servo_count
+        self._count = 0
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(4)
+        self._thread = None
+        self._running = False
+
+    @property
+    def address(self):
+        return self._sock.getsockname()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._accept_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        try:
+            self._sock.close()
+        except Exception:
+            pass
+
+    def _next_count(self):
+        if self.servo_count is not None:
+            return self.servo_count()
+
+        self._count += 1
+        return self._count
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                client, addr = self._sock.accept()
+            except Exception:
+                break
+
+            thread = threading.Thread(target=self._handle_client,
+                                      args=(TCPSocket(sock=client), ))
+            thread.daemon = True
+            thread.start()
+
+    def _send_packet(self, client, code, payload=b''):
+        client.send(struct.pack('>I', len(payload) + 1) + code + payload)
+
+    def _snapshot(self, items):
+        values = [self.values.get(addr, 0) for addr, type_ in items]
+        data = np.array([tuple(values)],
+                        dtype=_get_dtype([type_ for addr, type_ in items]))
+        return struct.pack('>I', self._next_count()) + data.tobytes()
+
+    def _handle_client(self, client):
+        items = []
+        period = None
+        remaining = 0
+        while self._running:
+            try:
+                if period is not None:
+                    client.settimeout(period)
+                else:
+                    client.settimeout(None)
+
+                try:
+                    packet_len, = struct.unpack('>I', client.recv_fixed(4))
+                except socket.timeout:
+                    self._send_packet(client, b'V', self._snapshot(items))
+                    remaining -= 1
+                    if remaining == 0:
+                        period = None
+                    continue
+
+                client.settimeout(None)
+                packet = client.recv_fixed(packet_len)
+            except Exception:
+                break
+
+            period = None
+            code, payload = packet[:1], packet[1:]
+            if code == b'I':
+                count, = struct.unpack('>H', payload[:2])
+                if count > MAX_ITEMS:
+                    self._send_packet(client, b'E', struct.pack('>I', 2))
+                    continue
+
+                items = [struct.unpack('>IH', payload[2 + 6 * i:8 + 6 * i])
+                         for i in range(count)]
+                self._send_packet(client, b'K')
+            elif code == b'R':
+                self._send_packet(client, b'V', self._snapshot(items))
+            elif code == b'P':
+                period_us, remaining = struct.unpack('>II', payload[:8])
+                period = max(period_us * 1e-6, 1e-6)
+            elif code == b'H':
+                self._send_packet(client, b'K')
+            else:
+                self._send_packet(client, b'E', struct.pack('>I', 1))
+
+        client.close()
+
+
+def test(host=config.hostname, port=config.var_server_port):
+    from .pp_comm import PPComm
+
+    comm = PPComm(host=host)
+    client = VariableClient(host_port=(host, int(port)))
+    variables = ['Motor[%d].ActPos' % i for i in range(1, 9)]
+    client.resolve(comm.gpascii, variables)
+
+    t0 = time.time()
+    counts, values = client.read_block(0.001, 1000)
+    t1 = time.time() - t0
+
+    print('1000 snapshots of %d variables in %.2fms' %
+          (len(variables), t1 * 1000))
+    print('servo counts %d to %d' % (counts[0], counts[-1]))
+
+
+if __name__ == '__main__':
+    import sys
+    # Simple test usage: var_server.py [ip] [port]
+    if len(sys.argv) > 1:
+        test(*sys.argv[1:])
+    else:
+        test()
@@ -0,0 +1,447 @@
+/*
+ * (relatively) fast variable server
+ * - a simple forking TCP server that sends raw Power PMAC shared memory
+ *   values, either on request or periodically
+ *
+ * Usage: var_server [port]
+ * Default port is 2333
+ *
+ * Variable addresses are resolved once by the client (i.e., the value of
+ * `Motor[1].ActPos.a`, the same value that would be put in Gather.Addr[])
+ * and registered with the server along with their gather-style type
+ * (see ppmac/gather_types.py). After that, each snapshot is a single memcpy
+ * per item - no text parsing on either end.
+ *
+ * Protocol (all integers big-endian):
+ *  Client requests: (packet length, uint32) (code, char) (payload)
+ *   'I' - set items: (count, uint16) count * [(address, uint32) (type, uint16)]
+ *         reply: 'K' or 'E'
+ *   'R' - read a single snapshot
+ *         reply: 'V' (servo count, uint32) (raw values)
+ *   'P' - periodic snapshots: (period, uint32 usec) (count, uint32; 0=forever)
+ *         reply: a 'V' packet every period until the count is reached or
+ *                any other request is received
+ *   'H' - halt periodic snapshots
+ *         reply: 'K'
+ *  Errors are sent as: 'E' (error code, uint32)
+ *
+ * Author: K Lauer (klauer@bnl.gov)
+ */
+
+// vi: sw=4 ts=4
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <unistd.h>
+#include <errno.h>
+#include <string.h>
+#include <sys/types.h>
+#include <sys/socket.h>
+#include <sys/select.h>
+#include <sys/time.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
+#include <netdb.h>
+#include <arpa/inet.h>
+#include <sys/wait.h>
+#include <signal.h>
+#include <gplib.h>  // Power PMAC-specific
+
+#define DEFAULT_PORT "2333"
+#define BACKLOG 4           // how many pending connections queue will hold
+
+#define MAX_ITEMS 1024
+#define MAX_PACKET (2 + MAX_ITEMS * 6 + 16)
+// Number of times to retry a snapshot if the servo count changes during it
+#define SNAPSHOT_RETRIES 3
+
+// Error codes
+#define ERR_UNKNOWN_REQUEST 1
+#define ERR_TOO_MANY_ITEMS  2
+#define ERR_BAD_ADDRESS     3
+#define ERR_BAD_PACKET      4
+
+// Gather types (see gather_server.c); all but double are 4 bytes
+#define TYPE_DOUBLE 5
+
+typedef struct {
+    char *address;
+    unsigned int size;
+} var_item;
+
+// Ensures that the full buffer is sent
+int send_all(int s, const char *buf, unsigned int len)
+{
+    unsigned int total = 0;        // how many bytes we've sent
+    unsigned int bytesleft = len; // how many we have left to send
+    int n = 0;
+
+    while(total < len) {
+        n = send(s, buf+total, bytesleft, 0);
+        if (n == -1) {
+            break;
+        }
+
+        total += n;
+        bytesleft -= n;
+    }
+
+    return n==-1?-1:0; // return -1 on failure, 0 on success
+}
+
+// Ensures that the full buffer is received
+int recv_all(int s, char *buf, unsigned int len)
+{
+    unsigned int total = 0;
+    int n;
+
+    while(total < len) {
+        n = recv(s, buf+total, len-total, 0);
+        if (n <= 0) {
+            return -1;
+        }
+
+        total += n;
+    }
+
+    return 0;
+}
+
+// Send a packet header: length (including the code) and the code
+int send_header(int client, char code, unsigned int payload_len) {
+    unsigned int length = htonl(payload_len + 1);
+
+    if (send_all(client, (char*)&length, sizeof(unsigned int)) == -1)
+        return -1;
+
+    return send_all(client, &code, 1);
+}
+
+int send_ok(int client) {
+    return send_header(client, 'K', 0);
+}
+
+int send_error(int client, unsigned int error_code) {
+    printf("client %d error %d\n", client, error_code);
+    error_code = htonl(error_code);
+    send_header(client, 'E', sizeof(unsigned int));
+    return send_all(client, (char*)&error_code, sizeof(unsigned int));
+}
+
+// Size of the value of a gather-type item, in bytes
+unsigned int type_size(unsigned short type) {
+    if (type == TYPE_DOUBLE)
+        return 8;
+    return 4;
+}
+
+// Check that an address lies entirely in the shared memory structure
+bool valid_address(char *address, unsigned int size) {
+    char *start = (char*)pshm;
+    char *end = start + sizeof(*pshm);
+    return (address >= start && (address + size) <= end);
+}
+
+// Parse an item registration packet
+int set_items(int client, const char *buf, unsigned int len,
+              var_item *items, unsigned int *n_items, unsigned int *line_length)
+{
+    unsigned short count;
+    unsigned int i, addr;
+    unsigned short type;
+    const char *p;
+
+    if (len < 2)
+        return send_error(client, ERR_BAD_PACKET);
+
+    memcpy(&count, buf, 2);
+    count = ntohs(count);
+    if (count > MAX_ITEMS)
+        return send_error(client, ERR_TOO_MANY_ITEMS);
+
+    if (len < (unsigned int)(2 + 6 * count))
+        return send_error(client, ERR_BAD_PACKET);
+
+    *n_items = 0;
+    *line_length = 0;
+
+    p = buf + 2;
+    for (i = 0; i < count; i++) {
+        memcpy(&addr, p, 4);
+        memcpy(&type, p + 4, 2);
+        p += 6;
+
+        addr = ntohl(addr);
+        type = ntohs(type);
+
+        items[i].address = (char*)addr;
+        items[i].size = type_size(type);
+        if (!valid_address(items[i].address, items[i].size)) {
+            return send_error(client, ERR_BAD_ADDRESS);
+        }
+
+        *line_length += items[i].size;
+    }
+
+    *n_items = count;
+    printf("client %d registered %d items (%d bytes/snapshot)\n",
+           client, count, *line_length);
+    return send_ok(client);
+}
+
+// Copy all registered values into buf, prefixed by the servo count.
+// The copy is repeated if the servo count changed while copying, such that
+// all values are (very likely) from the same servo cycle.
+unsigned int take_snapshot(var_item *items, unsigned int n_items, char *buf) {
+    unsigned int i, attempt, count_before, count_after=0;
+    char *p;
+
+    for (attempt = 0; attempt < SNAPSHOT_RETRIES; attempt++) {
+        count_before = pshm->ServoCount;
+        p = buf + sizeof(unsigned int);
+        for (i = 0; i < n_items; i++) {
+            memcpy(p, items[i].address, items[i].size);
+            p += items[i].size;
+        }
+
+        count_after = pshm->ServoCount;
+        if (count_before == count_after)
+            break;
+    }
+
+    count_after = htonl(count_after);
+    memcpy(buf, &count_after, sizeof(unsigned int));
+    return (unsigned int)(p - buf);
+}
+
+int send_snapshot(int client, var_item *items, unsigned int n_items,
+                  char *buf) {
+    unsigned int len = take_snapshot(items, n_items, buf);
+    if (send_header(client, 'V', len) == -1)
+        return -1;
+    return send_all(client, buf, len);
+}
+
+int handle_client(int client) {
+    static char buf[MAX_PACKET];
+    var_item items[MAX_ITEMS];
+    unsigned int n_items=0, line_length=0;
+    char *snapshot;
+    unsigned int length, period=0, remaining=0;
+    bool periodic=false;
+    struct timeval timeout;
+    fd_set read_fds;
+    char code;
+
+    snapshot = (char*)malloc(sizeof(unsigned int) + MAX_ITEMS * 8);
+
+    while (1) {
+        if (periodic) {
+            FD_ZERO(&read_fds);
+            FD_SET(client, &read_fds);
+            timeout.tv_sec = period / 1000000;
+            timeout.tv_usec = period % 1000000;
+
+            if (select(client + 1, &read_fds, NULL, NULL, &timeout) == 0) {
+                if (send_snapshot(client, items, n_items, snapshot) == -1)
+                    break;
+
+                if (remaining > 0 && --remaining == 0)
+                    periodic = false;
+                continue;
+            }
+
+            // A request halts periodic mode
+            periodic = false;
+        }
+
+        if (recv_all(client, (char*)&length, sizeof(unsigned int)) == -1) {
+            perror("recv");
+            break;
+        }
+
+        length = ntohl(length);
+        if (length < 1 || length > MAX_PACKET) {
+            send_error(client, ERR_BAD_PACKET);
+            break;
+        }
+
+        if (recv_all(client, buf, length) == -1) {
+            perror("recv");
+            break;
+        }
+
+        code = buf[0];
+        switch (code) {
+        case 'I':
+            set_items(client, buf + 1, length - 1, items, &n_items,
+                      &line_length);
+            break;
+
+        case 'R':
+            send_snapshot(client, items, n_items, snapshot);
+            break;
+
+        case 'P':
+            if (length < 9) {
+                send_error(client, ERR_BAD_PACKET);
+                break;
+            }
+
+            memcpy(&period, buf + 1, 4);
+            memcpy(&remaining, buf + 5, 4);
+            period = ntohl(period);
+            remaining = ntohl(remaining);
+            periodic = true;
+            printf("client %d periodic mode: period=%dus count=%d\n",
+                   client, period, remaining);
+            break;
+
+        case 'H':
+            send_ok(client);
+            break;
+
+        default:
+            send_error(client, ERR_UNKNOWN_REQUEST);
+            break;
+        }
+    }
+
+    free(snapshot);
+    printf("client %d closed\n", client);
+    return 0;
+}
+
+/// Handler for the child processes
+void sigchld_handler(int s)
+{
+    while(waitpid(-1, NULL, WNOHANG) > 0);
+}
+
+/// Get IPv4/IPv6 address info
+void *get_in_addr(struct sockaddr *sa)
+{
+    if (sa->sa_family == AF_INET) {
+        // IPv4
+        return &(((struct sockaddr_in*)sa)->sin_addr);
+    } else {
+        // IPv6
+        return &(((struct sockaddr_in6*)sa)->sin6_addr);
+    }
+}
+
+// Main server loop, listens on port
+int server_loop(const char *port) {
+    int sockfd, new_fd;  // listen on sock_fd, new connection on new_fd
+    struct addrinfo hints, *servinfo, *p;
+    struct sockaddr_storage their_addr; // connector's address information
+    socklen_t sin_size;
+    struct sigaction sa;
+    int yes=1;
+    char s[INET6_ADDRSTRLEN];
+    int rv;
+
+    // Initialize the Power PMAC gplib library
+    InitLibrary();
+
+    memset(&hints, 0, sizeof hints);
+    hints.ai_family = AF_UNSPEC;
+    hints.ai_socktype = SOCK_STREAM;
+    hints.ai_flags = AI_PASSIVE;
+
+    if ((rv = getaddrinfo(NULL, port, &hints, &servinfo)) != 0) {
+        fprintf(stderr, "getaddrinfo: %s\n", gai_strerror(rv));
+        return 1;
+    }
+
+    // Bind to the first result that works
+    for(p = servinfo; p != NULL; p = p->ai_next) {
+        if ((sockfd = socket(p->ai_family, p->ai_socktype,
+                p->ai_protocol)) == -1) {
+            perror("server: socket");
+            continue;
+        }
+
+        if (setsockopt(sockfd, SOL_SOCKET, SO_REUSEADDR, &yes,
+                sizeof(int)) == -1) {
+            perror("setsockopt");
+            exit(1);
+        }
+
+        if (bind(sockfd, p->ai_addr, p->ai_addrlen) == -1) {
+            close(sockfd);
+            perror("server: bind");
+            continue;
+        }
+
+        break;
+    }
+
+    if (p == NULL)  {
+        fprintf(stderr, "server: failed to bind\n");
+        return 2;
+    }
+
+    freeaddrinfo(servinfo);
+
+    if (listen(sockfd, BACKLOG) == -1) {
+        perror("listen");
+        exit(1);
+    }
+
+    // reap all dead processes -- set their handler to this function
+    sa.sa_handler = sigchld_handler;
+    sigemptyset(&sa.sa_mask);
+    sa.sa_flags = SA_RESTART;
+    if (sigaction(SIGCHLD, &sa, NULL) == -1) {
+        perror("sigaction");
+        exit(1);
+    }
+
+    printf("server: listening on port %s\n", port);
+
+    while(1) {  // main accept() loop
+        sin_size = sizeof their_addr;
+        new_fd = accept(sockfd, (struct sockaddr *)&their_addr, &sin_size);
+        if (new_fd == -1) {
+            perror("accept");
+            continue;
+        }
+
+        // Snapshots are small; don't let Nagle's algorithm delay them
+        setsockopt(new_fd, IPPROTO_TCP, TCP_NODELAY, &yes, sizeof(int));
+
+        inet_ntop(their_addr.ss_family,
+            get_in_addr((struct sockaddr *)&their_addr),
+            s, sizeof s);
+        printf("server: got connection from %s\n", s);
+
+        if (fork() == 0) {
+            close(sockfd); // child doesn't need the listener
+            handle_client(new_fd);
+            close(new_fd);
+            exit(0);
+        }
+        close(new_fd);
+    }
+
+    // Close the Power PMAC gplib library
+    CloseLibrary();
+    return 0;
+}
+
+int main(int argc, char *argv[])
+{
+    if (argc == 2) {
+        int port = atoi(argv[1]);
+        if (port > 0 && port < 65536) {
+            return server_loop(argv[1]);
+        } else {
+            printf("Invalid port. Use %s [port_number]\n", argv[0]);
+        }
+    } else {
+        return server_loop(DEFAULT_PORT);
+    }
+
+    return 1;
+}